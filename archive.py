@@ -0,0 +1,263 @@
+## Copyright (c) 2022 Daniel Tabor
+##
+## Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions
+## are met:
+## 1. Redistributions of source code must retain the above copyright
+##    notice, this list of conditions and the following disclaimer.
+## 2. Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##
+## THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS "AS IS" AND
+## ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+## IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+## ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+## FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+## DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+## OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+## HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+## LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+## OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+## SUCH DAMAGE.
+##
+import concurrent.futures
+import collections
+import filecmp
+import tarfile
+import io
+import lzma
+import zlib
+import os
+import instrument
+
+#zstd is only available from Python 3.14 on, or with the zstandard module
+try:
+	from compression import zstd
+except ImportError:
+	zstd = None
+	try:
+		import zstandard
+	except ImportError:
+		zstandard = None
+
+#Amount of the archive compressed as one independent block
+BLOCK_SIZE = 4<<20
+
+#Reads of the archived files
+COPY_BUFSIZE = 1<<20
+
+def gzip_compressor(level):
+	#Each block becomes a gzip member; gzip reads the members of a file
+	#one after another
+	if level == None:
+		level = 6
+	def compress(data):
+		c = zlib.compressobj(level,zlib.DEFLATED,31)
+		return c.compress(data)+c.flush()
+	return compress
+
+def xz_compressor(level):
+	#Concatenated xz streams are a valid xz file
+	if level == None:
+		level = 6
+	def compress(data):
+		return lzma.compress(data,format=lzma.FORMAT_XZ,preset=level)
+	return compress
+
+def zstd_compressor(level):
+	#Concatenated zstd frames are a valid zstd file
+	if level == None:
+		level = 3
+	if zstd:
+		def compress(data):
+			return zstd.compress(data,level=level)
+	else:
+		def compress(data):
+			return zstandard.ZstdCompressor(level=level).compress(data)
+	return compress
+
+COMPRESSORS = {
+	"gzip" : gzip_compressor,
+	"xz"   : xz_compressor,
+	"zstd" : zstd_compressor,
+}
+
+def available_method(method):
+	#zstd falls back to gzip where this Python can not write it
+	if method == "zstd" and zstd == None and zstandard == None:
+		print("WARNING: zstd is not available, using gzip")
+		return "gzip"
+	return method
+
+class ParallelCompressor:
+	#File object that compresses what is written to it in independent
+	#blocks on a pool of threads.  The compressors release the GIL while
+	#they work, and the compressed blocks are written to fp in order.
+	def __init__(self, fp, method="gzip", level=None, workers=None):
+		self.fp = fp
+		self.compress = COMPRESSORS[method](level)
+		if workers == None:
+			workers = os.cpu_count() or 1
+		self.pool = concurrent.futures.ThreadPoolExecutor(workers)
+		#Bounds the memory held by blocks waiting to be written
+		self.max_pending = 2*workers
+		self.pending = collections.deque()
+		self.buf = []
+		self.buf_len = 0
+
+	def write(self, data):
+		self.buf.append(bytes(data))
+		self.buf_len += len(data)
+		if self.buf_len >= BLOCK_SIZE:
+			self.submit()
+		return len(data)
+
+	def submit(self):
+		block = b"".join(self.buf)
+		self.buf = []
+		self.buf_len = 0
+		self.pending.append(self.pool.submit(self.compress_block,block))
+		while len(self.pending) > self.max_pending:
+			self.write_block(self.pending.popleft().result())
+
+	def compress_block(self, block):
+		with instrument.stage("compress"):
+			return self.compress(block)
+
+	def write_block(self, data):
+		instrument.count("archive.blocks")
+		instrument.count("archive.bytes_out",len(data))
+		self.fp.write(data)
+
+	def close(self):
+		if self.buf_len:
+			self.submit()
+		while len(self.pending):
+			self.write_block(self.pending.popleft().result())
+		self.pool.shutdown()
+
+def walk_sorted(root_dir, names):
+	#Yield (path, arcname) for names in root_dir and everything below
+	#them, in sorted order, each directory before its contents
+	stack = [(os.path.join(root_dir,x),x) for x in sorted(names,reverse=True)]
+	while len(stack):
+		path, arcname = stack.pop()
+		yield path, arcname
+		if os.path.isdir(path) and not os.path.islink(path):
+			for x in sorted(os.listdir(path),reverse=True):
+				stack.append((os.path.join(path,x),os.path.join(arcname,x)))
+
+def normalize(tarinfo, mtime):
+	#Drop everything about an entry that depends on when and by whom the
+	#tree was built
+	tarinfo.mtime = mtime
+	tarinfo.uid = 0
+	tarinfo.gid = 0
+	tarinfo.uname = ""
+	tarinfo.gname = ""
+	if tarinfo.issym():
+		tarinfo.mode = 0o777
+	elif tarinfo.isdir() or tarinfo.mode & 0o111:
+		tarinfo.mode = 0o755
+	else:
+		tarinfo.mode = 0o644
+
+def source_date():
+	#The mtime of every entry of a deterministic archive
+	try:
+		return int(os.getenv("SOURCE_DATE_EPOCH","0"))
+	except ValueError:
+		return 0
+
+class ArchiveWriter:
+	#Writes a compressed tar archive to dst_path, by way of a temporary
+	#file that only replaces dst_path once the archive is complete.
+	#Files hardlinked to each other are stored once, with the others as
+	#hard links to them.
+	#
+	#A deterministic archive has its entries' mtime (SOURCE_DATE_EPOCH,
+	#or 0), owners and permissions normalized, so the same entries always
+	#give the same bytes; the compressed blocks do not depend on the
+	#number of workers either.  If dst_path already holds exactly those
+	#bytes it is left alone.
+	def __init__(self, dst_path, method="gzip", level=None, workers=None, verbose=False, deterministic=False):
+		self.dst_path = os.path.abspath(dst_path)
+		self.tmp_path = self.dst_path+".tmp"
+		self.verbose = verbose
+		self.deterministic = deterministic
+		self.mtime = source_date()
+		self.fp = open(self.tmp_path,"wb")
+		self.compressor = ParallelCompressor(self.fp,available_method(method),level,workers)
+		self.tar = tarfile.open(fileobj=self.compressor,mode="w|",format=tarfile.PAX_FORMAT,copybufsize=COPY_BUFSIZE)
+
+	def add(self, path, arcname):
+		#Add a single file system entry (not what is below it)
+		if os.path.abspath(path) in (self.dst_path,self.tmp_path):
+			#The archive is being written inside the tree
+			return
+		tarinfo = self.tar.gettarinfo(path,arcname)
+		if tarinfo == None:
+			#Sockets can not be archived
+			return
+		if self.deterministic:
+			normalize(tarinfo,self.mtime)
+		if self.verbose:
+			print(arcname)
+		instrument.count("archive.entries")
+		if tarinfo.isreg():
+			instrument.count("archive.bytes_in",tarinfo.size)
+			f = open(path,"rb")
+			self.tar.addfile(tarinfo,f)
+			f.close()
+		else:
+			self.tar.addfile(tarinfo)
+
+	def add_bytes(self, arcname, data, mode=0o644):
+		tarinfo = tarfile.TarInfo(arcname)
+		tarinfo.size = len(data)
+		tarinfo.mode = mode
+		tarinfo.mtime = self.mtime
+		if self.verbose:
+			print(arcname)
+		self.tar.addfile(tarinfo,io.BytesIO(data))
+
+	def add_dir(self, arcname):
+		tarinfo = tarfile.TarInfo(arcname)
+		tarinfo.type = tarfile.DIRTYPE
+		tarinfo.mode = 0o755
+		tarinfo.mtime = self.mtime
+		self.tar.addfile(tarinfo)
+
+	def close(self):
+		#Returns False if dst_path was left alone, else True
+		self.tar.close()
+		self.compressor.close()
+		self.fp.close()
+		if self.deterministic and os.path.exists(self.dst_path) and \
+			filecmp.cmp(self.tmp_path,self.dst_path,shallow=False):
+			os.unlink(self.tmp_path)
+			return False
+		os.replace(self.tmp_path,self.dst_path)
+		return True
+
+	def abort(self):
+		self.fp.close()
+		self.compressor.pool.shutdown()
+		os.unlink(self.tmp_path)
+
+def write_archive(dst_path, root_dir, names=None, method="gzip", level=None, workers=None, verbose=False, deterministic=False):
+	#Write the tree root_dir (or just names within it) to a compressed
+	#tar archive at dst_path, in sorted order.  See ArchiveWriter.
+	#Returns False if dst_path already held the same deterministic
+	#archive, else True.
+	if names == None:
+		names = os.listdir(root_dir)
+	writer = ArchiveWriter(dst_path,method,level,workers,verbose,deterministic)
+	try:
+		for path, arcname in walk_sorted(root_dir,names):
+			writer.add(path,arcname)
+	except:
+		writer.abort()
+		raise
+	return writer.close()
@@ -0,0 +1,551 @@
+#!/usr/bin/env python3
+## Copyright (c) 2022 Daniel Tabor
+##
+## Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions
+## are met:
+## 1. Redistributions of source code must retain the above copyright
+##    notice, this list of conditions and the following disclaimer.
+## 2. Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##
+## THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS "AS IS" AND
+## ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+## IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+## ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+## FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+## DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+## OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+## HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+## LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+## OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+## SUCH DAMAGE.
+##
+import subprocess
+import platform
+import random
+import shutil
+import struct
+import json
+import time
+import sys
+import os
+import elf_reader
+
+RESULT_VERSION = 1
+
+#Tool stages, in the order they run.  Each is run as its own process on
+#the synthetic tree, so that its peak RSS can be measured.
+STAGES = ["stripmine","config","create_package","build","package"]
+
+#Synthetic ELF files are 64-bit little endian, like the loader they name
+EHDR_SIZE = 64
+PHDR_SIZE = 56
+SYM_SIZE = 24
+DT_HASH = 4
+DT_SYMTAB = 6
+DT_SYMENT = 11
+
+#Symbols each synthetic library exports
+LIB_SYMBOLS = 16
+
+def usage(cmd):
+	print("Usage:")
+	print("%s [-h] [-e execs] [-l libs] [-f fanout] [-b lib_bytes]" % cmd)
+	print("     [-d depth] [-w width] [-n files] [-s strace_lines] [-j jobs]")
+	print("     [-r runs] [-k] [-o result_file] [-c baseline_file] work_dir")
+	print("")
+	print("  Generates a synthetic harvest in work_dir and times each tool on it.")
+	print("  -e : Number of executables (default 50)")
+	print("  -l : Number of shared libraries (default 400)")
+	print("  -f : DT_NEEDED entries of each executable and library (default 4)")
+	print("  -b : Size of each library in bytes (default 65536)")
+	print("  -d : Depth of the data tree (default 4)")
+	print("  -w : Subdirectories of each data directory (default 4)")
+	print("  -n : Files in each data directory (default 16)")
+	print("  -s : Lines of the recorded strace -f log (default 200000)")
+	print("  -j : Jobs given to the tools that take -j (default all cores)")
+	print("  -r : Run each stage this many times, and keep the fastest")
+	print("  -k : Keep the generated trees if they are already there")
+	print("  -o : Write the results (JSON) to result_file instead of stdout")
+	print("  -c : Compare with the results of an earlier run")
+	sys.exit(1)
+
+def host_loader():
+	#The program interpreter (and its ELF machine) of this Python, which
+	#the synthetic executables ask for
+	info = elf_reader.read_elf(os.path.realpath(sys.executable))
+	if info == None or info["interp"] == None or info["class"] != elf_reader.ELFCLASS64 \
+		or info["data"] != elf_reader.ELFDATA2LSB:
+		return None, None
+	return info["interp"], info["machine"]
+
+def make_elf(path, machine, needed, soname=None, interp=None, runpath=None,
+             exports=(), imports=(), size=0, rng=None):
+	#Write a minimal ELF file the harvester tools can read: one PT_LOAD
+	#mapping the whole file at address 0, a PT_DYNAMIC section, optional
+	#PT_INTERP, and a dynamic symbol table with a DT_HASH table
+	strtab = bytearray(b"\x00")
+	def add_str(s):
+		offset = len(strtab)
+		strtab.extend(s.encode()+b"\x00")
+		return offset
+
+	dynamic = [(elf_reader.DT_NEEDED,add_str(x)) for x in needed]
+	if soname:
+		dynamic.append((elf_reader.DT_SONAME,add_str(soname)))
+	if runpath:
+		dynamic.append((elf_reader.DT_RUNPATH,add_str(runpath)))
+	symbols = [(add_str(x),True) for x in exports]+[(add_str(x),False) for x in imports]
+
+	phnum = 3 if interp else 2
+	offset = EHDR_SIZE+phnum*PHDR_SIZE
+	interp_data = b""
+	if interp:
+		interp_data = interp.encode()+b"\x00"
+	interp_offset = offset
+	offset += len(interp_data)
+	str_offset = offset
+	offset += len(strtab)
+	offset = (offset+7) & ~7
+	sym_offset = offset
+	offset += (len(symbols)+1)*SYM_SIZE
+	hash_offset = offset
+	nsyms = len(symbols)+1
+	hash_data = struct.pack("<II",1,nsyms)+struct.pack("<I",0)+b"\x00"*(4*nsyms)
+	offset += len(hash_data)
+	offset = (offset+7) & ~7
+	dyn_offset = offset
+	dynamic += [(elf_reader.DT_STRTAB,str_offset),(elf_reader.DT_STRSZ,len(strtab)),
+	            (DT_SYMTAB,sym_offset),(DT_SYMENT,SYM_SIZE),(DT_HASH,hash_offset),
+	            (elf_reader.DT_NULL,0)]
+	dyn_data = b"".join(struct.pack("<qQ",t,v) for t, v in dynamic)
+	offset += len(dyn_data)
+	filler = b""
+	if size > offset and rng != None:
+		filler = rng.randbytes(size-offset)
+	total = offset+len(filler)
+
+	e_type = elf_reader.ET_EXEC if interp else elf_reader.ET_DYN
+	ident = elf_reader.ELF_MAGIC+bytes([elf_reader.ELFCLASS64,elf_reader.ELFDATA2LSB,1,0])+b"\x00"*8
+	out = [ident,struct.pack("<HHIQQQIHHHHHH",e_type,machine,1,0,EHDR_SIZE,0,0,
+	                         EHDR_SIZE,PHDR_SIZE,phnum,0,0,0)]
+	out.append(struct.pack("<IIQQQQQQ",1,5,0,0,0,total,total,0x1000))
+	out.append(struct.pack("<IIQQQQQQ",elf_reader.PT_DYNAMIC,6,dyn_offset,dyn_offset,dyn_offset,
+	                       len(dyn_data),len(dyn_data),8))
+	if interp:
+		out.append(struct.pack("<IIQQQQQQ",elf_reader.PT_INTERP,4,interp_offset,interp_offset,
+		                       interp_offset,len(interp_data),len(interp_data),1))
+	out.append(interp_data)
+	out.append(bytes(strtab))
+	out.append(b"\x00"*(sym_offset-str_offset-len(strtab)))
+	out.append(b"\x00"*SYM_SIZE)
+	for name, defined in symbols:
+		#Global functions; defined ones in a made up section
+		out.append(struct.pack("<IBBHQQ",name,(1<<4)|2,0,1 if defined else 0,0,0))
+	out.append(hash_data)
+	out.append(b"\x00"*(dyn_offset-hash_offset-len(hash_data)))
+	out.append(dyn_data)
+	out.append(filler)
+	f = open(path,"wb")
+	f.write(b"".join(out))
+	f.close()
+	if interp:
+		os.chmod(path,0o755)
+
+def lib_name(i):
+	return "libbench%d.so" % i
+
+def generate(work_dir, params):
+	#Create the synthetic tree in work_dir/src, the strace log that
+	#harvester_config reads, and the configuration harvester_build uses
+	rng = random.Random(1)
+	interp, machine = host_loader()
+	if interp == None:
+		raise ValueError("this host's Python is not a 64-bit little endian ELF program")
+	src_dir = os.path.join(work_dir,"src")
+	bin_dir = os.path.join(src_dir,"bin")
+	lib_dir = os.path.join(src_dir,"lib")
+	data_dir = os.path.join(src_dir,"data")
+	for d in [bin_dir,lib_dir,data_dir]:
+		os.makedirs(d)
+
+	#A forest of libraries: each one only needs libraries after it, so
+	#there are no cycles
+	libs = params["libs"]
+	fanout = params["fanout"]
+	for i in range(libs):
+		later = list(range(i+1,libs))
+		needed = rng.sample(later,min(fanout,len(later)))
+		make_elf(os.path.join(lib_dir,lib_name(i)),machine,[lib_name(x) for x in needed],
+		         soname=lib_name(i),runpath="$ORIGIN",
+		         exports=["bench%d_%d" % (i,x) for x in range(LIB_SYMBOLS)],
+		         imports=["bench%d_0" % x for x in needed],size=params["lib_bytes"],rng=rng)
+	execs = []
+	for i in range(params["execs"]):
+		needed = rng.sample(range(libs),min(fanout,libs))
+		path = os.path.join(bin_dir,"bench%d" % i)
+		make_elf(path,machine,[lib_name(x) for x in needed],interp=interp,
+		         runpath="$ORIGIN/../lib",imports=["bench%d_0" % x for x in needed])
+		execs.append(path)
+
+	#A deep data tree
+	data_files = []
+	level = [data_dir]
+	for depth in range(params["depth"]+1):
+		next_level = []
+		for d in level:
+			for i in range(params["files"]):
+				path = os.path.join(d,"file%d.dat" % i)
+				f = open(path,"wb")
+				f.write(rng.randbytes(rng.randint(64,4096)))
+				f.close()
+				data_files.append(path)
+			if depth < params["depth"]:
+				for i in range(params["width"]):
+					sub = os.path.join(d,"dir%d" % i)
+					os.mkdir(sub)
+					next_level.append(sub)
+		level = next_level
+
+	#A recorded strace -f log of the programs running: their execve, the
+	#libraries and data they open, failed lookups, and calls that are
+	#interrupted by other processes
+	lib_paths = [os.path.join(lib_dir,lib_name(i)) for i in range(libs)]
+	log_path = os.path.join(work_dir,"strace.log")
+	f = open(log_path,"w")
+	pid = 1000
+	unfinished = {}
+	for i in range(params["strace_lines"]):
+		choice = rng.random()
+		if pid in unfinished:
+			f.write('%d <... %s resumed>) = 3\n' % (pid,unfinished.pop(pid)))
+		elif choice < 0.02:
+			pid += 1
+			path = rng.choice(execs)
+			f.write('%d execve("%s", ["%s"], 0x7ffd5e8 /* 24 vars */) = 0\n' % (pid,path,os.path.basename(path)))
+		elif choice < 0.35:
+			f.write('%d openat(AT_FDCWD, "%s", O_RDONLY|O_CLOEXEC) = 3\n' % (pid,rng.choice(lib_paths)))
+		elif choice < 0.65:
+			path = rng.choice(data_files)
+			if rng.random() < 0.2:
+				f.write('%d openat(AT_FDCWD, "%s", O_RDONLY <unfinished ...>\n' % (pid,path))
+				unfinished[pid] = "openat"
+				pid = pid+1 if rng.random() < 0.5 else max(1000,pid-1)
+			else:
+				f.write('%d openat(AT_FDCWD, "%s", O_RDONLY) = 4\n' % (pid,path))
+		elif choice < 0.85:
+			f.write('%d openat(AT_FDCWD, "%s/missing%d.so", O_RDONLY|O_CLOEXEC) = -1 ENOENT (No such file or directory)\n' %
+			        (pid,rng.choice([lib_dir,"/usr/lib","/lib64"]),rng.randint(0,99)))
+		elif choice < 0.95:
+			f.write('%d newfstatat(AT_FDCWD, "%s", {st_mode=S_IFREG|0644, st_size=2048, ...}, 0) = 0\n' %
+			        (pid,rng.choice(data_files)))
+		else:
+			f.write('%d access("/etc/ld.so.preload", R_OK) = -1 ENOENT (No such file or directory)\n' % pid)
+	for p, call in unfinished.items():
+		f.write('%d <... %s resumed>) = 3\n' % (p,call))
+	f.write('%d +++ exited with 0 +++\n' % pid)
+	f.close()
+
+	#Stands in for strace by replaying the log
+	fake_strace = os.path.join(work_dir,"fake_strace")
+	f = open(fake_strace,"w")
+	f.write("#!/bin/sh\n")
+	f.write("while [ $# -gt 0 ]; do\n")
+	f.write("\tcase $1 in\n")
+	f.write("\t-o) out=$2; shift 2 ;;\n")
+	f.write("\t-e) shift 2 ;;\n")
+	f.write("\t-*) shift ;;\n")
+	f.write("\t*) break ;;\n")
+	f.write("\tesac\n")
+	f.write("done\n")
+	f.write("cat '%s' > \"$out\"\n" % log_path)
+	f.write("exec \"$@\"\n")
+	f.close()
+	os.chmod(fake_strace,0o755)
+
+	#What harvester_build packages
+	config_dir = os.path.join(work_dir,"config")
+	os.makedirs(config_dir)
+	f = open(os.path.join(config_dir,"HARVEST_EXEC"),"w")
+	f.write("".join(x+"\n" for x in execs))
+	f.close()
+	f = open(os.path.join(config_dir,"HARVEST_DATA"),"w")
+	f.write(data_dir+"\n")
+	f.close()
+
+	fp = open(os.path.join(work_dir,"params.json"),"w")
+	json.dump(params,fp,sort_keys=True)
+	fp.close()
+
+def tree_size(path):
+	#Number of regular files, and their total size, at or below path
+	if os.path.isfile(path):
+		return 1, os.path.getsize(path)
+	files = 0
+	size = 0
+	for root, dirs, names in os.walk(path):
+		for name in names:
+			st = os.lstat(os.path.join(root,name))
+			if not os.path.islink(os.path.join(root,name)):
+				files += 1
+				size += st.st_size
+	return files, size
+
+def line_count(path):
+	f = open(path,"rb")
+	lines = sum(data.count(b"\n") for data in iter(lambda: f.read(1<<20),b""))
+	f.close()
+	return lines
+
+def remove(path):
+	if os.path.isdir(path) and not os.path.islink(path):
+		shutil.rmtree(path)
+	elif os.path.lexists(path):
+		os.unlink(path)
+
+def run_stage(cmd, log_path):
+	#Run a tool and return its exit status, wall time and peak RSS (in
+	#KB, of the tool and the processes it waited for)
+	log = open(log_path,"w")
+	start = time.perf_counter()
+	proc = subprocess.Popen(cmd,stdout=log,stderr=subprocess.STDOUT,stdin=subprocess.DEVNULL)
+	pid, status, rusage = os.wait4(proc.pid,0)
+	wall = time.perf_counter()-start
+	proc.returncode = os.waitstatus_to_exitcode(status)
+	log.close()
+	return proc.returncode, wall, rusage.ru_maxrss
+
+def stage_commands(work_dir, jobs):
+	#For each stage: the command, what to remove before it runs, and
+	#what its files (or lines) and bytes per second are counted over
+	tool_dir = os.path.dirname(os.path.abspath(__file__))
+	def tool(name):
+		return [sys.executable,os.path.join(tool_dir,name)]
+	src_dir = os.path.join(work_dir,"src")
+	out_dir = os.path.join(work_dir,"out")
+	jobs_args = []
+	if jobs:
+		jobs_args = ["-j",str(jobs)]
+	stripmine_dir = os.path.join(out_dir,"stripmine")
+	config_dir = os.path.join(out_dir,"config")
+	package_dir = os.path.join(out_dir,"create_package")
+	root_dir = os.path.join(out_dir,"root")
+	tarball = os.path.join(out_dir,"root.tgz")
+	return {
+		"stripmine": {
+			"cmd":   tool("harvester_stripmine.py")+["-c",stripmine_dir]+jobs_args+[src_dir],
+			"clean": [stripmine_dir],
+			"mkdir": [stripmine_dir],
+			"count": src_dir,
+		},
+		"config": {
+			"cmd":   tool("harvester_config.py")+["-s",os.path.join(work_dir,"fake_strace"),
+			                                    "-c",config_dir,"/bin/true"],
+			"clean": [config_dir],
+			"mkdir": [config_dir],
+			"count": os.path.join(work_dir,"strace.log"),
+			"unit":  "lines",
+		},
+		"create_package": {
+			"cmd":   tool("create_package.py")+["-v","0","-d",package_dir,
+			                                   os.path.join(src_dir,"bin","bench0")],
+			"clean": [package_dir],
+			"mkdir": [package_dir],
+			"count": package_dir,
+		},
+		"build": {
+			"cmd":   tool("harvester_build.py")+["-c",os.path.join(work_dir,"config")]+jobs_args+
+			         [root_dir,os.path.join(root_dir,"dist")],
+			"clean": [root_dir],
+			"mkdir": [],
+			"count": root_dir,
+		},
+		"package": {
+			"cmd":   tool("harvester_package.py")+jobs_args+[root_dir,tarball],
+			"clean": [tarball],
+			"mkdir": [],
+			"count": root_dir,
+		},
+	}
+
+def git_commit():
+	tool_dir = os.path.dirname(os.path.abspath(__file__))
+	try:
+		out = subprocess.check_output(["git","-C",tool_dir,"rev-parse","HEAD"],
+		                              stderr=subprocess.DEVNULL)
+	except (OSError, subprocess.CalledProcessError):
+		return None
+	return out.decode().strip()
+
+def compare(results, baseline):
+	#Print how each stage did against an earlier run
+	print("%-16s %10s %10s %8s %10s %10s" % ("stage","wall","baseline","ratio","rss KB","baseline"))
+	for name in STAGES:
+		new = results["stages"].get(name)
+		old = baseline["stages"].get(name)
+		if new == None or old == None:
+			continue
+		ratio = new["wall"]/old["wall"] if old["wall"] else 0
+		print("%-16s %9.3fs %9.3fs %7.2fx %10d %10d" %
+		      (name,new["wall"],old["wall"],ratio,new["peak_rss_kb"],old["peak_rss_kb"]))
+
+def main(argv):
+	if "-h" in argv:
+		usage(argv[0])
+
+	params = {
+		"execs":        50,
+		"libs":         400,
+		"fanout":       4,
+		"lib_bytes":    65536,
+		"depth":        4,
+		"width":        4,
+		"files":        16,
+		"strace_lines": 200000,
+	}
+	for flag, name in [["-e","execs"],["-l","libs"],["-f","fanout"],["-b","lib_bytes"],
+	                   ["-d","depth"],["-w","width"],["-n","files"],["-s","strace_lines"]]:
+		try:
+			idx = argv.index(flag)
+		except:
+			continue
+		if len(argv) < idx+2 or not argv[idx+1].isdigit():
+			usage(argv[0])
+		params[name] = int(argv[idx+1])
+		del argv[idx]
+		del argv[idx]
+
+	try:
+		idx = argv.index("-j")
+	except:
+		jobs = None
+	else:
+		if len(argv) < idx+2 or not argv[idx+1].isdigit() or int(argv[idx+1]) < 1:
+			usage(argv[0])
+		jobs = int(argv[idx+1])
+		del argv[idx]
+		del argv[idx]
+
+	try:
+		idx = argv.index("-r")
+	except:
+		runs = 1
+	else:
+		if len(argv) < idx+2 or not argv[idx+1].isdigit() or int(argv[idx+1]) < 1:
+			usage(argv[0])
+		runs = int(argv[idx+1])
+		del argv[idx]
+		del argv[idx]
+
+	try:
+		idx = argv.index("-k")
+	except:
+		keep = False
+	else:
+		keep = True
+		del argv[idx]
+
+	try:
+		idx = argv.index("-o")
+	except:
+		result_path = None
+	else:
+		if len(argv) < idx+2:
+			usage(argv[0])
+		result_path = argv[idx+1]
+		del argv[idx]
+		del argv[idx]
+
+	try:
+		idx = argv.index("-c")
+	except:
+		baseline = None
+	else:
+		if len(argv) < idx+2:
+			usage(argv[0])
+		fp = open(argv[idx+1],"r")
+		baseline = json.load(fp)
+		fp.close()
+		del argv[idx]
+		del argv[idx]
+
+	if len(argv) < 2:
+		usage(argv[0])
+	work_dir = os.path.abspath(argv[1])
+
+	#Generate the synthetic harvest, unless the same one is there
+	params_path = os.path.join(work_dir,"params.json")
+	existing = None
+	if keep and os.path.exists(params_path):
+		fp = open(params_path,"r")
+		existing = json.load(fp)
+		fp.close()
+	if existing != params:
+		for name in ["src","out","config","logs","strace.log","fake_strace","params.json"]:
+			remove(os.path.join(work_dir,name))
+		os.makedirs(work_dir,exist_ok=True)
+		start = time.perf_counter()
+		try:
+			generate(work_dir,params)
+		except ValueError as e:
+			print("ERROR: %s" % e)
+			return 1
+		print("Generated %s in %.1fs" % (work_dir,time.perf_counter()-start),file=sys.stderr)
+
+	results = {
+		"version":  RESULT_VERSION,
+		"commit":   git_commit(),
+		"python":   platform.python_version(),
+		"machine":  platform.machine(),
+		"cpus":     os.cpu_count(),
+		"jobs":     jobs,
+		"runs":     runs,
+		"params":   params,
+		"stages":   {},
+	}
+	os.makedirs(os.path.join(work_dir,"out"),exist_ok=True)
+	os.makedirs(os.path.join(work_dir,"logs"),exist_ok=True)
+	commands = stage_commands(work_dir,jobs)
+	for name in STAGES:
+		stage = commands[name]
+		best = None
+		for run in range(runs):
+			for path in stage["clean"]:
+				remove(path)
+			for path in stage["mkdir"]:
+				os.makedirs(path)
+			log_path = os.path.join(work_dir,"logs","%s.log" % name)
+			status, wall, rss = run_stage(stage["cmd"],log_path)
+			if best == None or wall < best["wall"]:
+				best = {"status":status, "wall":wall, "peak_rss_kb":rss}
+			if status != 0:
+				print("ERROR: %s failed, see %s" % (name,log_path),file=sys.stderr)
+				break
+		files, size = tree_size(stage["count"])
+		unit = stage.get("unit","files")
+		if unit == "lines":
+			files = line_count(stage["count"])
+		best[unit] = files
+		best["bytes"] = size
+		best[unit+"_per_s"] = files/best["wall"] if best["wall"] else 0
+		best["bytes_per_s"] = size/best["wall"] if best["wall"] else 0
+		results["stages"][name] = best
+		print("%-16s %8.3fs %8d %-5s %10.1f/s %8.1f MB/s %8d KB" %
+		      (name,best["wall"],files,unit,best[unit+"_per_s"],best["bytes_per_s"]/(1<<20),best["peak_rss_kb"]),
+		      file=sys.stderr)
+
+	if result_path:
+		fp = open(result_path,"w")
+		json.dump(results,fp,indent=1,sort_keys=True)
+		fp.write("\n")
+		fp.close()
+	else:
+		print(json.dumps(results,indent=1,sort_keys=True))
+	if baseline != None:
+		compare(results,baseline)
+	return 0 if all(x["status"] == 0 for x in results["stages"].values()) else 1
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv))
@@ -0,0 +1,209 @@
+## Copyright (c) 2022 Daniel Tabor
+##
+## Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions
+## are met:
+## 1. Redistributions of source code must retain the above copyright
+##    notice, this list of conditions and the following disclaimer.
+## 2. Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##
+## THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS "AS IS" AND
+## ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+## IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+## ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+## FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+## DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+## OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+## HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+## LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+## OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+## SUCH DAMAGE.
+##
+import concurrent.futures
+import threading
+import shutil
+import errno
+import fcntl
+import time
+import stat
+import os
+import instrument
+import progress
+
+#ioctl to share the extents of one file with another (btrfs, xfs, ...)
+FICLONE = getattr(fcntl,"FICLONE",0x40049409)
+
+#Errors meaning a copy method is not available for a pair of files
+UNSUPPORTED = [errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+               errno.ENOTTY]
+
+#(method, src device, dst device) pairs known not to work
+unsupported = {}
+
+CHUNK_SIZE = 1<<30
+
+def try_method(method, src_st, dst_st, func):
+	key = (method,src_st.st_dev,dst_st.st_dev)
+	if key in unsupported:
+		return False
+	try:
+		func()
+	except OSError as e:
+		if e.errno not in UNSUPPORTED:
+			raise
+		unsupported[key] = None
+		return False
+	return True
+
+def rewind(src_fd, dst_fd):
+	#Start over after a copy method gave up part way through
+	os.lseek(src_fd,0,os.SEEK_SET)
+	os.lseek(dst_fd,0,os.SEEK_SET)
+	os.ftruncate(dst_fd,0)
+
+def copy_file(src, dst):
+	#Copy the contents and mode of src to the file dst, letting the kernel
+	#do the work where possible: reflink, then copy_file_range, then
+	#sendfile, and finally a plain read/write loop.
+	#Returns the number of bytes copied.
+	fsrc = open(src,"rb")
+	try:
+		src_st = os.fstat(fsrc.fileno())
+		#Never write through an existing file, it may be hardlinked to
+		#a store or be a running executable
+		if os.path.lexists(dst):
+			os.unlink(dst)
+		fdst = open(dst,"wb")
+		try:
+			dst_st = os.fstat(fdst.fileno())
+			src_fd = fsrc.fileno()
+			dst_fd = fdst.fileno()
+			size = src_st.st_size
+
+			def reflink():
+				fcntl.ioctl(dst_fd,FICLONE,src_fd)
+
+			def copy_range():
+				rewind(src_fd,dst_fd)
+				while os.copy_file_range(src_fd,dst_fd,CHUNK_SIZE):
+					pass
+
+			def send():
+				rewind(src_fd,dst_fd)
+				offset = 0
+				while True:
+					sent = os.sendfile(dst_fd,src_fd,offset,CHUNK_SIZE)
+					if not sent:
+						break
+					offset += sent
+
+			if size == 0:
+				#Possibly a special file that does not report its size
+				shutil.copyfileobj(fsrc,fdst)
+			elif try_method("reflink",src_st,dst_st,reflink):
+				pass
+			elif hasattr(os,"copy_file_range") and \
+				try_method("copy_file_range",src_st,dst_st,copy_range):
+				pass
+			elif try_method("sendfile",src_st,dst_st,send):
+				pass
+			else:
+				rewind(src_fd,dst_fd)
+				shutil.copyfileobj(fsrc,fdst)
+			fdst.flush()
+			size = os.fstat(dst_fd).st_size
+		finally:
+			fdst.close()
+	finally:
+		fsrc.close()
+	os.chmod(dst,stat.S_IMODE(src_st.st_mode))
+	return size
+
+class CopyEngine:
+	#Copies files on a bounded pool of threads.  A destination is only
+	#ever copied once, no matter how many times it is requested.
+	def __init__(self, workers=None):
+		if workers == None:
+			workers = min(32,(os.cpu_count() or 1)+4)
+		self.pool = concurrent.futures.ThreadPoolExecutor(workers)
+		self.pending = 0
+		self.idle = threading.Condition()
+		#Bound the number of queued copies, so huge trees do not
+		#accumulate millions of pending futures
+		self.slots = threading.BoundedSemaphore(workers*4)
+		self.lock = threading.Lock()
+		self.scheduled = {}
+		self.errors = []
+		self.files = 0
+		self.bytes = 0
+		self.start = time.time()
+
+	def copy(self, src, dst, store=None):
+		#Schedule a copy of src, like shutil.copy: if dst is a directory
+		#the file is copied into it.  If a lib_store.LibStore is given,
+		#dst is linked to the stored copy of src instead.
+		if os.path.isdir(dst):
+			dst = os.path.join(dst,os.path.basename(src))
+		with self.lock:
+			if dst in self.scheduled:
+				return
+			self.scheduled[dst] = None
+		progress.expect("copy")
+		self.slots.acquire()
+		with self.idle:
+			self.pending += 1
+		self.pool.submit(self.run,src,dst,store)
+
+	def run(self, src, dst, store):
+		progress.working("copy %s" % os.path.basename(dst))
+		size = 0
+		try:
+			with instrument.stage("copy"):
+				if store:
+					size = store.link(src,dst)
+				else:
+					size = copy_file(src,dst)
+		except (IOError, OSError) as e:
+			instrument.count("copy.errors")
+			with self.lock:
+				self.errors.append([src,dst,e])
+		else:
+			instrument.count("copy.files")
+			instrument.count("copy.bytes",size)
+			with self.lock:
+				self.files += 1
+				self.bytes += size
+		finally:
+			progress.advance("copy",nbytes=size)
+			progress.working(None)
+			self.slots.release()
+			with self.idle:
+				self.pending -= 1
+				if self.pending == 0:
+					self.idle.notify_all()
+
+	def wait(self):
+		#Wait for every scheduled copy, returns [src, dst, error] for
+		#each copy that failed
+		with self.idle:
+			while self.pending:
+				self.idle.wait()
+		with self.lock:
+			errors = self.errors
+			self.errors = []
+		return errors
+
+	def rate(self):
+		elapsed = time.time()-self.start
+		if elapsed <= 0:
+			return 0.0
+		return self.bytes/elapsed
+
+	def shutdown(self):
+		self.pool.shutdown(wait=True)
+
+	def report(self):
+		return "Copied %d files, %.1f MB (%.1f MB/s)" % \
+			(self.files,self.bytes/1e6,self.rate()/1e6)
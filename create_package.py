@@ -23,21 +23,38 @@
 ## SUCH DAMAGE.
 ##
 import subprocess
-import shutil
 import sys
 import os
+import threading
+import archive
+import pack_image
+import lib_usage
+import elf_resolver
+import elf_reader
+import dep_cache
+import copy_engine
+import lib_store
+import instrument
+import progress
+import launcher
+import elf_patch
 
 def usage(cmd):
 	print("Usage:")
 	print("%s [-h] [-v level] [-a] [-d dist_dir | " % cmd)
 	print("     -gd root_dir dist_dir] [-qt qt_plugin_dir]")
 	print("     [-xl x_locale_dir] [-cl c_locale_dir] [-tar output_tarball]")
+	print("     [-z gzip|xz|zstd] [-r] [-pack output_image] [-ldd]")
+	print("     [-cache cache_file] [-store store_dir] [-trace trace_file]")
+	print("     [-unused report|drop] [-profile profile_file]")
+	print("     [-events events_file] [-launcher bash|sh|stub] [-patch]")
 	print("     executable")
 	print("")
 	print("  -v  : verbose level")
 	print("          level 0 = completely quiet")
-	print("          level 1 = libraries only")
-	print("          level 2 = print everything")
+	print("          level 1 = progress and summaries (default)")
+	print("          level 2 = libraries")
+	print("          level 3 = print everything")
 	print("  -a  : use the dist_dir for multiple packages; implied when")
 	print("        -gd is specified")
 	print("  -d  : Create a self contained package in the specified directory.")
@@ -45,20 +62,529 @@ def usage(cmd):
 	print("        Shell scripts will be created relative to this root to ")
 	print("        represent executables, and binary dependecies will be placed")
 	print("        in the dist_dir, which must be inside the root base tree.")
+	print("  -ldd: Use /usr/bin/ldd to find libraries instead of reading the")
+	print("        ELF dynamic sections directly.")
+	print("  -cache : Keep resolved libraries and ELF headers in cache_file, so")
+	print("        that later runs only examine files that have changed.")
+	print("  -store : Keep a single copy of each packaged file in store_dir")
+	print("        and hardlink (or symlink) the package contents to it.")
+	print("  -z  : Compression of the tarball (default gzip).  It is compressed")
+	print("        in blocks on every core.")
+	print("  -r  : Make the tarball reproducible (normalized timestamps, owners")
+	print("        and permissions).")
+	print("  -trace : Only package the plugin/locale files listed in trace_file")
+	print("        (files_used.py output), with the libraries they need.")
+	print("  -unused : Report the packaged libraries that no packaged file")
+	print("        imports a symbol from, or drop them (and their DT_NEEDED")
+	print("        entries from the packaged files that list them).")
+	print("  -profile : Write stage timings and counters to profile_file (a")
+	print("        Chrome trace)")
+	print("  -events : Write the progress as JSON lines to events_file.")
+	print("  -launcher : How executables are started (default bash).  sh is a")
+	print("        POSIX sh script that execs the loader, stub a static C")
+	print("        program (built with cc) that starts no shell at all.")
+	print("  -patch : Set DT_RUNPATH (and with -gd PT_INTERP) of the packaged")
+	print("        files, so that launchers do not set LD_LIBRARY_PATH.")
+	print("  -pack : Also write a pack image: a shell script that runs the")
+	print("        package, extracting only what each program needs (once).")
 	print("  Common paths:")
 	print("    qt - /usr/lib/x86_64-linux-gnu/qt5/plugins")
 	print("    xl - /usr/share/X11/locale")
 	print("    cl - /usr/share/locale")
 	exit(0)
 
-def isELF(path):
-	f = open(path,"rb")
-	hdr = f.read(4)
-	f.close()
-	if hdr == b'\x7fELF':
-		return True
-	else:
-		return False
+def ldd_subprocess(path):
+	deps = []
+	instrument.count("ldd.forks")
+	proc = subprocess.Popen(["/usr/bin/ldd",path],stdout=subprocess.PIPE)
+	proc.wait()
+	while True:
+		line = proc.stdout.readline().decode()
+		if not len(line):
+			break
+		line = line.strip()
+		items = line.split(" ")
+		if len(items) > 2 and items[1] == "=>" and len(items[2]):
+			if " ".join(items[2:]).lower() == "not found":
+				deps.append([items[0],None])
+			else:
+				deps.append([items[0],items[2]])
+	return deps
+
+def read_trace(path):
+	#The files a recorded run opened (one per line, as written by
+	#files_used.py), by their real path
+	paths = set()
+	fp = open(path,"r")
+	for line in fp:
+		line = line.strip()
+		if not len(line) or line[0] == "#" or line[0] != "/":
+			continue
+		paths.add(os.path.realpath(line))
+	fp.close()
+	return paths
+
+class Packager:
+	#Packages any number of executables into one distribution directory.
+	#Flags are parsed once, and the files that have been examined, the
+	#directories that have been created and the plugin/locale trees are
+	#shared by every executable that is added.
+	def __init__(self, dist_dir=".", root_dir=None, append_mode=False,
+	             verbose_level=1, src_qt_plugin=None, src_xlocaledir=None,
+	             src_clocaledir=None, use_ldd=False, cache=None, copier=None,
+	             store=None, trace_paths=None, launcher="bash", patch=False):
+		if root_dir != None:
+			#Global mode
+			self.global_mode = True
+			self.append_mode = True
+			self.root_dir = os.path.abspath(root_dir)
+			self.dist_dir = os.path.abspath(dist_dir)
+			if self.dist_dir[:len(self.root_dir)] != self.root_dir:
+				raise ValueError("%s is not inside %s" % (dist_dir,root_dir))
+			self.dst_dist_dir = self.dist_dir[len(self.root_dir):]
+		else:
+			self.global_mode = False
+			self.append_mode = append_mode
+			self.root_dir = None
+			self.dist_dir = dist_dir
+			self.dst_dist_dir = None
+		self.verbose_level = verbose_level
+		self.src_qt_plugin = src_qt_plugin
+		self.src_xlocaledir = src_xlocaledir
+		self.src_clocaledir = src_clocaledir
+		self.use_ldd = use_ldd
+		self.cache = cache
+		if copier == None:
+			copier = copy_engine.CopyEngine()
+		self.copier = copier
+		#Optional lib_store.LibStore shared by every package
+		self.store = store
+		#Optional set of files a recorded run opened (see read_trace).
+		#Only those files of the plugin/locale trees are packaged.
+		self.trace_paths = trace_paths
+		#Kind of launcher written for each executable (see launcher.py)
+		self.launcher = launcher
+		#Patch DT_RUNPATH (and PT_INTERP) of the packaged files rather
+		#than set LD_LIBRARY_PATH (see patch_elfs)
+		self.patch = patch
+
+		#Keep track of files that have already been examined/copied
+		self.old_files = {}
+		self.copied_files = {}
+		self.lock = threading.Lock()
+		#Directories known to exist
+		self.made_dirs = {}
+		#Libraries required by each examined file
+		self.deps = {}
+		#Loader for each (machine, program interpreter)
+		self.loaders = {}
+		#Files of the plugin/locale trees: [src, subdir, relative dir]
+		self.tree_files = None
+		#Loader installed in each package directory (bin, lib, ...)
+		self.package_dirs = {}
+		#Launcher path -> [subdist_name, loader_file, exec_name]
+		self.launchers = {}
+		#Optional is_current(dstfile, src) used to decide whether a file
+		#already in the package is up to date (by default any existing
+		#file is)
+		self.is_current = None
+
+	def makedirs(self, path):
+		if path in self.made_dirs:
+			return
+		instrument.count("makedirs.calls")
+		os.makedirs(path,exist_ok=True)
+		with self.lock:
+			self.made_dirs[path] = None
+
+	def subdist_name(self, exec_name):
+		if self.global_mode:
+			return ""
+		elif self.append_mode:
+			return "dist"
+		else:
+			return "%s_dist"%exec_name
+
+	def find_loader(self, src_exec):
+		#The loader is the program interpreter named by PT_INTERP
+		result = elf_reader.classify(src_exec)
+		if result == None or result["machine"] == None or result["interp"] == None:
+			return None
+		key = (result["machine"],result["interp"])
+		if key not in self.loaders:
+			loader_path = result["interp"]
+			#It must be there, and be able to run this machine's code
+			loader = elf_reader.classify(loader_path)
+			if loader == None or loader["machine"] != result["machine"]:
+				loader_path = None
+			self.loaders[key] = loader_path
+		return self.loaders[key]
+
+	def find_deps(self, target):
+		if target in self.deps:
+			return self.deps[target]
+		deps = None
+		resolver = "ldd" if self.use_ldd else "elf_resolver"
+		if self.cache:
+			deps = self.cache.get_deps(target,resolver)
+			if deps != None:
+				instrument.count("deps.cache_hits")
+		if deps == None:
+			with instrument.stage("ldd"):
+				if self.use_ldd:
+					deps = ldd_subprocess(target)
+				else:
+					deps = elf_resolver.ldd(target)
+			if self.cache:
+				self.cache.put_deps(target,deps,resolver)
+		self.deps[target] = deps
+		return deps
+
+	def find_tree_files(self):
+		#Find all qt plugins, xlocale and clocale files (just to be safe),
+		#or only those that were used if there is a trace.  The trees are
+		#only walked once, no matter how many executables are packaged.
+		if self.tree_files != None:
+			return self.tree_files
+		self.tree_files = []
+		skipped = 0
+		for src_tree, subdir in [[self.src_qt_plugin,"plugins"],
+		                         [self.src_xlocaledir,"xlocale"],
+		                         [self.src_clocaledir,"clocale"]]:
+			if not src_tree:
+				continue
+			for root,dirs,files in os.walk(src_tree):
+				rel_dir = os.path.relpath(root,src_tree)
+				for f in files:
+					src = os.path.join(root,f)
+					if self.trace_paths != None and os.path.realpath(src) not in self.trace_paths:
+						skipped += 1
+						continue
+					self.tree_files.append([src,subdir,rel_dir])
+		if self.trace_paths != None and self.verbose_level >= 1:
+			progress.message("Trace: using %d plugin/locale files, skipping %d" % (len(self.tree_files),skipped))
+		return self.tree_files
+
+	def tree_closure(self, exec_name=""):
+		#Every [src, dstfile] pair needed for the plugin/locale trees
+		dst_subdist_dir = os.path.join(self.dist_dir,self.subdist_name(exec_name))
+		dst_lib_dir = os.path.join(dst_subdist_dir,"lib")
+		closure = []
+		for src, subdir, rel_dir in self.find_tree_files():
+			dst_dir = os.path.normpath(os.path.join(dst_subdist_dir,subdir,rel_dir))
+			closure.append([src,os.path.join(dst_dir,os.path.basename(src))])
+			if elf_reader.is_elf(src):
+				for lib_name, lib_path in self.find_deps(src):
+					if lib_path != None:
+						closure.append([lib_path,os.path.join(dst_lib_dir,os.path.basename(lib_path))])
+		return closure
+
+	def plan_executable(self, src_exec):
+		#Determine every file needed to package src_exec without
+		#touching the distribution directory, so that planning can be
+		#done by several processes at once.  Returns None if src_exec
+		#can not be packaged.
+
+		#Determine Paths
+		exec_name = os.path.basename(src_exec)
+		subdist_name = self.subdist_name(exec_name)
+		if self.global_mode:
+			dst_script_path = os.path.join(self.root_dir,os.path.abspath(src_exec)[1:])
+		else:
+			dst_script_path = os.path.join(self.dist_dir,exec_name)
+		dst_subdist_dir = os.path.join(self.dist_dir,subdist_name)
+		dst_bin_dir = os.path.join(dst_subdist_dir,"bin")
+		dst_lib_dir = os.path.join(dst_subdist_dir,"lib")
+
+		#Determine the loader
+		loader_path = self.find_loader(src_exec)
+		if loader_path == None:
+			progress.message("Unable to determine loader")
+			return None
+		loader_file = os.path.basename(loader_path)
+
+		#Prep the plugin and locale directories
+		new_files = []
+		for src, subdir, rel_dir in self.find_tree_files():
+			dst_dir = os.path.normpath(os.path.join(dst_subdist_dir,subdir,rel_dir))
+			new_files.append([3,src,dst_dir])
+
+		#Copy executable and loader (set executable to be examined)
+		new_files.append([2,src_exec,dst_bin_dir])
+		new_files.append([2,loader_path,dst_lib_dir])
+
+		#Process all of the new files:
+		#  1) Schedule them to be copied into place
+		#  2) Check is see if they require libraries
+		#  3) Add required libraries to the new files list
+		files = []
+		while len(new_files):
+			verbose,target,dstdir = new_files.pop(0)
+			if (target,dstdir) in self.old_files:
+				continue
+
+			if verbose <= self.verbose_level:
+				progress.message("File: %s" % target)
+			files.append([verbose,target,dstdir])
+			progress.advance("examined")
+
+			if elf_reader.is_elf(target):
+				for lib_name, new_target in self.find_deps(target):
+					if new_target == None:
+						progress.message("Unidentified library: %s" % lib_name)
+					else:
+						if self.verbose_level >= 3:
+							progress.message("  -> %s" % new_target)
+						new_files.append([2,new_target,dst_lib_dir])
+			self.old_files[(target,dstdir)] = None
+
+		if self.cache:
+			self.cache.commit()
+
+		#Every file the executable needs, even those already planned
+		#for other executables
+		closure = [[src_exec,os.path.join(dst_bin_dir,exec_name)],
+		           [loader_path,os.path.join(dst_lib_dir,loader_file)]]
+		for lib_name, lib_path in self.find_deps(src_exec):
+			if lib_path != None:
+				closure.append([lib_path,os.path.join(dst_lib_dir,os.path.basename(lib_path))])
+
+		return {
+			"exec":    src_exec,
+			"files":   files,
+			"closure": closure,
+			"dirs":    [dst_bin_dir,dst_lib_dir],
+			"script":  [dst_script_path,subdist_name,loader_file,exec_name],
+		}
+
+	def claim(self, dstfile):
+		#Make sure only one thread copies each file into the package
+		with self.lock:
+			if dstfile in self.copied_files:
+				return False
+			self.copied_files[dstfile] = None
+			return True
+
+	def install(self, plan):
+		#Copy the files of a plan into place and create the launcher.
+		#May be called from several threads at once.
+		for d in plan["dirs"]:
+			self.makedirs(d)
+		for verbose,target,dstdir in plan["files"]:
+			self.makedirs(dstdir)
+			dstfile = os.path.join(dstdir,os.path.basename(target))
+			if not self.claim(dstfile):
+				continue
+			if os.path.exists(dstfile) and \
+				(self.is_current == None or self.is_current(dstfile,target)):
+				if not self.append_mode and verbose <= self.verbose_level:
+					progress.message("  (already present in package: %s)" % dstfile)
+			else:
+				self.copier.copy(target,dstfile,self.store)
+
+		dst_script_path, subdist_name, loader_file, exec_name = plan["script"]
+		self.add_launcher(dst_script_path,subdist_name,loader_file,exec_name)
+		self.makedirs(os.path.dirname(os.path.abspath(dst_script_path)))
+		self.write_launcher(dst_script_path,subdist_name,loader_file,exec_name)
+
+	def add_launcher(self, dst_script_path, subdist_name, loader_file, exec_name):
+		#Record a launcher and its package, which is done by install, or
+		#directly for an executable already packaged by an earlier run
+		dst_lib_dir = os.path.join(self.dist_dir,subdist_name,"lib")
+		with self.lock:
+			self.package_dirs[os.path.dirname(dst_lib_dir)] = os.path.join(dst_lib_dir,loader_file)
+			self.launchers[dst_script_path] = [subdist_name,loader_file,exec_name]
+
+	def add_executable(self, src_exec):
+		progress.working("plan %s" % os.path.basename(src_exec))
+		with instrument.stage("plan",exec=src_exec):
+			plan = self.plan_executable(src_exec)
+		progress.working(None)
+		if plan == None:
+			return 1
+		with instrument.stage("install",exec=src_exec):
+			self.install(plan)
+		return 0
+
+	def wait(self):
+		#Wait for all of the files to be copied into place.  Returns the
+		#list of [src, dst, error] for each file that could not be copied.
+		errors = self.copier.wait()
+		for src, dst, e in errors:
+			progress.message("Unable to copy %s: %s" % (src,e))
+		if self.verbose_level >= 1:
+			progress.message(self.copier.report())
+		return errors
+
+	def package_elfs(self, package_dir):
+		#The ELF files in a package directory
+		paths = []
+		for root, dirs, files in os.walk(package_dir):
+			if self.store:
+				#The store only holds copies of packaged files
+				dirs[:] = [d for d in dirs if os.path.join(root,d) != self.store.store_dir]
+			for f in files:
+				path = os.path.join(root,f)
+				if os.path.isfile(path) and elf_reader.is_elf(path):
+					paths.append(path)
+		return paths
+
+	def minimize_libs(self, drop=False, dropped=()):
+		#Find the libraries in the package that nothing in it imports a
+		#symbol from, and optionally remove them along with the DT_NEEDED
+		#entries that name them.  Libraries in dropped (removed by an
+		#earlier run) that were copied back, but that no file lists in
+		#DT_NEEDED any longer, are unused as well.  Returns the unused
+		#library paths.
+		self.copier.wait()
+		unused = {}
+		needed = set()
+		for package_dir, loader in sorted(self.package_dirs.items()):
+			paths = self.package_elfs(package_dir)
+			unused.update(lib_usage.find_unused(paths,keep=[loader]))
+			for path in paths:
+				info = elf_reader.read_elf(path)
+				if info != None:
+					needed.update(info["needed"])
+		for lib_path in dropped:
+			if lib_path in unused or not os.path.isfile(lib_path):
+				continue
+			info = elf_reader.read_elf(lib_path)
+			if os.path.basename(lib_path) not in needed and \
+			   (info == None or info["soname"] not in needed):
+				unused[lib_path] = []
+		for lib_path in sorted(unused):
+			if self.verbose_level >= 1:
+				progress.message("Unused library: %s" % lib_path)
+			if self.verbose_level >= 2:
+				for user in sorted(unused[lib_path]):
+					progress.message("  <- %s" % user)
+		if drop:
+			for lib_path in sorted(unused):
+				names = [os.path.basename(lib_path)]
+				info = elf_reader.read_elf(lib_path)
+				if info != None and info["soname"]:
+					names.append(info["soname"])
+				for user in unused[lib_path]:
+					if user not in unused:
+						if lib_usage.remove_needed(user,names) and self.store:
+							self.store.relink(user)
+			for lib_path in unused:
+				os.unlink(lib_path)
+		return unused
+
+	def patch_elfs(self):
+		#Set DT_RUNPATH of every ELF file of each package to the lib
+		#directory of the package (relative to $ORIGIN, or in global mode
+		#absolute, along with PT_INTERP set to its loader), then rewrite
+		#the launchers without LD_LIBRARY_PATH.  A launcher whose
+		#executable can not be patched, or whose package has another file
+		#that can not be, keeps setting it.  Returns the [path, error] of
+		#each file that was not patched.
+		self.copier.wait()
+		failed = []
+		unpatched = {}
+		for package_dir, loader in sorted(self.package_dirs.items()):
+			lib_dir = os.path.dirname(loader)
+			interp = None
+			if self.global_mode:
+				#The paths in the target root, as the launchers use.  $ORIGIN
+				#is not used as it needs /proc for executables started
+				#without the loader.
+				interp = os.path.join(self.dst_dist_dir,os.path.relpath(loader,self.dist_dir))
+				runpath = os.path.dirname(interp)
+			for path in self.package_elfs(package_dir):
+				if path == loader:
+					continue
+				if not self.global_mode:
+					rel_dir = os.path.relpath(lib_dir,os.path.dirname(path))
+					runpath = "$ORIGIN" if rel_dir == "." else "$ORIGIN/"+rel_dir
+				try:
+					if elf_patch.patch(path,runpath,interp):
+						if self.store:
+							self.store.relink(path)
+						if self.verbose_level >= 3:
+							progress.message("Patched: %s" % path)
+				except (ValueError, IOError, OSError) as e:
+					progress.message("Unable to patch %s: %s" % (path,e))
+					failed.append([path,e])
+					unpatched[path] = package_dir
+		#Any other file not patched leaves its libraries to LD_LIBRARY_PATH
+		execs = {}
+		for dst_script_path, [subdist_name, loader_file, exec_name] in self.launchers.items():
+			execs[os.path.join(self.dist_dir,subdist_name,"bin",exec_name)] = None
+		fallback = {}
+		for path, package_dir in unpatched.items():
+			if path not in execs and package_dir not in fallback:
+				progress.message("Using LD_LIBRARY_PATH for %s" % package_dir)
+				fallback[package_dir] = None
+		for dst_script_path, [subdist_name, loader_file, exec_name] in sorted(self.launchers.items()):
+			package_dir = os.path.dirname(os.path.join(self.dist_dir,subdist_name,"lib"))
+			patched = package_dir not in fallback and \
+			          os.path.join(package_dir,"bin",exec_name) not in unpatched
+			self.write_launcher(dst_script_path,subdist_name,loader_file,exec_name,patched=patched)
+		return failed
+
+	def write_launcher(self, dst_script_path, subdist_name, loader_file, exec_name, patched=False):
+		#Create the launcher (see launcher.py).  Once the package is
+		#patched (see patch_elfs) LD_LIBRARY_PATH is not needed, and in
+		#global mode the executables run their packaged loader themselves.
+		if self.global_mode:
+			dist = self.dst_dist_dir
+			append = True
+		else:
+			dist = subdist_name
+			append = False
+		env = []
+		if not patched:
+			env.append(["LD_LIBRARY_PATH","%s/lib" % dist,append])
+		if self.src_qt_plugin:
+			env.append(["QT_PLUGIN_PATH","%s/plugins" % dist,False])
+		if self.src_xlocaledir:
+			env.append(["XLOCALEDIR","%s/xlocale" % dist,False])
+		if self.src_clocaledir:
+			env.append(["LOCPATH","%s/clocale" % dist,False])
+		args = ["%s/bin/%s" % (dist,exec_name)]
+		if not patched or not self.global_mode:
+			args.insert(0,"%s/lib/%s" % (dist,loader_file))
+		elif not len(env):
+			#Nothing to set up, so the launcher is a link to the executable
+			exec_path = os.path.join(self.dist_dir,subdist_name,"bin",exec_name)
+			if os.path.lexists(dst_script_path):
+				os.unlink(dst_script_path)
+			os.symlink(os.path.relpath(exec_path,os.path.dirname(os.path.abspath(dst_script_path))),dst_script_path)
+			return
+		spec = {
+			"env":      env,
+			"args":     args,
+			"relative": not self.global_mode,
+		}
+		launcher.write_launcher(dst_script_path,self.launcher,spec)
+
+	def create_tarball(self, dst_tgz_path, method="gzip", deterministic=False):
+		self.copier.wait()
+		if self.verbose_level >= 1:
+			progress.message("Creating tarball: %s" % dst_tgz_path)
+		if self.global_mode:
+			src_dir = self.root_dir
+		else:
+			src_dir = self.dist_dir
+		if not archive.write_archive(dst_tgz_path,src_dir,method=method,
+		                             verbose=self.verbose_level >= 3,
+		                             deterministic=deterministic):
+			if self.verbose_level >= 1:
+				progress.message("Unchanged: %s" % dst_tgz_path)
+
+	def create_pack(self, dst_pack_path, method="gzip"):
+		self.copier.wait()
+		if self.verbose_level >= 1:
+			progress.message("Creating pack image: %s" % dst_pack_path)
+		if self.global_mode:
+			src_dir = self.root_dir
+		else:
+			src_dir = self.dist_dir
+		pack_image.write_pack(dst_pack_path,src_dir,method=method,
+		                      verbose=self.verbose_level >= 3)
 
 def main(argv):
 	if "-h" in argv:
@@ -70,7 +596,7 @@ def main(argv):
 	try:
 		idx = argv.index("-v")
 	except:
-		verbose_level = 2
+		verbose_level = 1
 	else:
 		if len(argv) < idx+2:
 			usage(argv[0])
@@ -89,22 +615,28 @@ def main(argv):
 		append_mode = True
 		del argv[idx]
 
+	try:
+		idx = argv.index("-ldd")
+	except:
+		use_ldd = False
+	else:
+		use_ldd = True
+		del argv[idx]
+
 	if "-gd" in argv:
-		global_mode = True
 		append_mode = True
 		idx = argv.index("-gd")
 		if len(argv) < idx+3:
 			usage(argv[0])
 		root_dir = os.path.abspath(argv[idx+1])
 		dist_dir = os.path.abspath(argv[idx+2])
-		dst_dist_dir = dist_dir[len(root_dir):]
 		if dist_dir[:len(root_dir)] != root_dir:
 			usage(argv[0])
 		del argv[idx]
 		del argv[idx]
 		del argv[idx]
 	else:
-		global_mode = False
+		root_dir = None
 		try:
 			idx = argv.index("-d")
 		except:
@@ -152,6 +684,80 @@ def main(argv):
 			del argv[idx]
 			del argv[idx]
 
+	try:
+		idx = argv.index("-cache")
+	except:
+		cache = None
+	else:
+		if len(argv) < idx+2:
+			usage(argv[0])
+		else:
+			cache = dep_cache.open_cache(argv[idx+1])
+			elf_reader.persistent_cache = cache
+			del argv[idx]
+			del argv[idx]
+
+	try:
+		idx = argv.index("-store")
+	except:
+		store = None
+	else:
+		if len(argv) < idx+2:
+			usage(argv[0])
+		else:
+			store = lib_store.LibStore(argv[idx+1],cache)
+			del argv[idx]
+			del argv[idx]
+
+	try:
+		idx = argv.index("-trace")
+	except:
+		trace_paths = None
+	else:
+		if len(argv) < idx+2:
+			usage(argv[0])
+		else:
+			trace_paths = read_trace(argv[idx+1])
+			del argv[idx]
+			del argv[idx]
+
+	try:
+		idx = argv.index("-events")
+	except:
+		events_path = None
+	else:
+		if len(argv) < idx+2:
+			usage(argv[0])
+		else:
+			events_path = argv[idx+1]
+			del argv[idx]
+			del argv[idx]
+
+	try:
+		idx = argv.index("-profile")
+	except:
+		profile_path = None
+	else:
+		if len(argv) < idx+2:
+			usage(argv[0])
+		else:
+			profile_path = argv[idx+1]
+			instrument.enable()
+			del argv[idx]
+			del argv[idx]
+
+	try:
+		idx = argv.index("-unused")
+	except:
+		unused_mode = None
+	else:
+		if len(argv) < idx+2 or argv[idx+1] not in ("report","drop"):
+			usage(argv[0])
+		else:
+			unused_mode = argv[idx+1]
+			del argv[idx]
+			del argv[idx]
+
 	try:
 		idx = argv.index("-tar")
 	except:
@@ -163,190 +769,98 @@ def main(argv):
 			dst_tgz_path = os.path.abspath(argv[idx+1])
 			del argv[idx]
 			del argv[idx]
-			
-	if len(argv) < 2:
-		usage(argv[0])
 
-	#Determine Paths
-	src_exec = argv[1]
-	exec_name = os.path.basename(src_exec)
-	if global_mode:
-		subdist_name = ""
-		dst_script_path = os.path.join(root_dir,os.path.abspath(src_exec)[1:])
+	try:
+		idx = argv.index("-patch")
+	except:
+		patch = False
+	else:
+		patch = True
+		del argv[idx]
+
+	try:
+		idx = argv.index("-launcher")
+	except:
+		launcher_kind = "bash"
 	else:
-		if append_mode:
-			subdist_name = "dist"
+		if len(argv) < idx+2 or argv[idx+1] not in launcher.LAUNCHERS:
+			usage(argv[0])
 		else:
-			subdist_name = "%s_dist"%exec_name
-		dst_script_path = os.path.join(dist_dir,exec_name)
-	dst_bin_dir = os.path.join(dist_dir,subdist_name,"bin")
-	dst_lib_dir = os.path.join(dist_dir,subdist_name,"lib")
-	dst_qt_dir = os.path.join(dist_dir,subdist_name,"plugins")+"/"
-	dst_xl_dir = os.path.join(dist_dir,subdist_name,"xlocale")+"/"
-	dst_cl_dir = os.path.join(dist_dir,subdist_name,"clocale")+"/"
-	
-	#Keep track of files that have already been examined/copied
-	old_files = {}
-	new_files = []
-
-	#Make directories
-	if not os.path.exists(dst_bin_dir):
-		os.makedirs(dst_bin_dir)
-	if not os.path.exists(dst_lib_dir):
-		os.makedirs(dst_lib_dir)
-	if src_qt_plugin and not os.path.exists(dst_qt_dir):
-		os.makedirs(dst_qt_dir)
-	if src_xlocaledir and not os.path.exists(dst_xl_dir):
-		os.makedirs(dst_xl_dir)
-	if src_clocaledir and not os.path.exists(dst_cl_dir):
-		os.makedirs(dst_cl_dir)
-	
-	#Determine the loader
-	loader_path = None
-	loader_file = None
-	proc = subprocess.Popen(["/usr/bin/strings",src_exec],stdout=subprocess.PIPE)
-	while True:
-		line = proc.stdout.readline().decode()
-		if not len(line):
-			break 
-		line = line.strip()
-		idx1 = line.find("/ld")
-		idx2 = line.find(".so")
-		if idx1 != -1 and idx2 != -1:
-			loader_path = line
-			loader_file = os.path.basename(loader_path)
-			if not os.path.exists(loader_path):
-				loader_path = None
-				loader_file = None
-			break
-	if loader_path == None:
-		print("Unable to determine loader")
-		return 1
+			launcher_kind = argv[idx+1]
+			del argv[idx]
+			del argv[idx]
 
-	#Find all qt plugins (just to be safe) and prep directories
-	if src_qt_plugin:
-		for root,dirs,files in os.walk(src_qt_plugin):
-			for f in files:
-				dst_dir = root.replace(src_qt_plugin,dst_qt_dir)
-				if not os.path.exists(dst_dir):
-					os.makedirs(dst_dir)
-				src = os.path.join(root,f)
-				new_files.append([2,src,dst_dir])
-
-	#Find all xlocale files (just to be safe) and prep directories
-	if src_xlocaledir:
-		for root,dirs,files in os.walk(src_xlocaledir):
-			for f in files:
-				dst_dir = root.replace(src_xlocaledir,dst_xl_dir)
-				dst_path = os.path.join(dst_dir,f)
-				if not os.path.exists(dst_dir):
-					os.makedirs(dst_dir)
-				src = os.path.join(root,f)
-				new_files.append([2,src,dst_dir])
-
-	#Find all clocale files (just to be safe) and prep directories
-	if src_clocaledir:
-		for root,dirs,files in os.walk(src_clocaledir):
-			for f in files:
-				dst_dir = root.replace(src_clocaledir,dst_cl_dir)
-				if not os.path.exists(dst_dir):
-					os.makedirs(dst_dir)
-				src = os.path.join(root,f)
-				new_files.append([2,src,dst_dir])
-
-
-	#Copy executable and loader (set executable to be examined)
-	new_files.append([1,src_exec,dst_bin_dir])
-	new_files.append([1,loader_path,dst_lib_dir])
-
-	#Process all of the new files:
-	#  1) Copy them into place
-	#  2) Check is see if they require libraries
-	#  3) Add required libraries to the new files list
-	#Process all required libraries and get everything copied to lib
-	while len(new_files):
-		verbose,target,dstdir = new_files[0]
-		if target in old_files:
-			del new_files[0]
-			continue
+	try:
+		idx = argv.index("-pack")
+	except:
+		dst_pack_path = None
+	else:
+		if len(argv) < idx+2:
+			usage(argv[0])
+		else:
+			dst_pack_path = os.path.abspath(argv[idx+1])
+			del argv[idx]
+			del argv[idx]
 
-		if verbose <= verbose_level:
-			print("File: %s" % target)
+	try:
+		idx = argv.index("-r")
+	except:
+		deterministic = False
+	else:
+		deterministic = True
+		del argv[idx]
 
-		dstfile = os.path.join(dstdir,os.path.basename(target))
-		if os.path.exists(dstfile):
-			if not append_mode and verbose <= verbose_level:
-				print("  (already present in package)")
-		else:
-			shutil.copy(target,dstdir)
-
-		if isELF(target):
-			proc = subprocess.Popen(["/usr/bin/ldd",target],stdout=subprocess.PIPE)
-			proc.wait()
-			while True:
-				line = proc.stdout.readline().decode()
-				if not len(line):
-					break
-				line = line.strip()
-				items = line.split(" ")
-				if items[1] == "=>" and len(items[2]):
-					if " ".join(items[2:]).lower() == "not found":
-						print("Unidentified library: %s" % items[0])
-					else:
-						new_target = items[2]
-						if verbose <= verbose_level:
-							print("  -> %s" % new_target)
-						new_files.append([1,new_target,dst_lib_dir])
-		del new_files[0]
-		old_files[target] = None
-
-	#Create the launcher script
-	f = open(dst_script_path,"w")
-	f.write("#!/bin/bash\n")
-	if global_mode:
-		f.write("export LD_LIBRARY_PATH=%s/lib:$LD_LIBRARY_PATH\n"%dst_dist_dir)
-		if src_qt_plugin:
-			f.write("export QT_PLUGIN_PATH=%s/plugins\n"%dst_dist_dir)
-		if src_xlocaledir:
-			f.write("export XLOCALEDIR=%s/xlocale\n"%dst_dist_dir)
-		if src_clocaledir:
-			f.write("export LOCPATH=%s/clocale\n"%dst_dist_dir)
-		f.write("%s/lib/%s %s/bin/%s $@\n" % (dst_dist_dir,loader_file,dst_dist_dir,exec_name))
-		f.close()
+	try:
+		idx = argv.index("-z")
+	except:
+		method = "gzip"
 	else:
-		f.write("DIR=$(dirname $0)\n")
-		f.write("export LD_LIBRARY_PATH=$DIR/%s/lib\n"%subdist_name)
-		if src_qt_plugin:
-			f.write("export QT_PLUGIN_PATH=$DIR/%s/plugins\n"%subdist_name)
-		if src_xlocaledir:
-			f.write("export XLOCALEDIR=$DIR/%s/xlocale\n"%subdist_name)
-		if src_clocaledir:
-			f.write("export LOCPATH=$DIR/%s/clocale\n"%subdist_name)
-		f.write("$DIR/%s/lib/%s $DIR/%s/bin/%s $@\n" % (subdist_name,loader_file,subdist_name,exec_name))
-	f.close()
-
-	subprocess.call(["chmod","777",dst_script_path])
-		
-	#Create tarball
-	if dst_tgz_path:
-		if verbose_level == 0:
-			args = "-czf"
-		if verbose_level >= 1:
-			print("Creating tarball: %s" % dst_tgz_path)
-		if verbose_level >= 2:
-			args = "-czvf"
-			
-		wd = os.getcwd()
-		if global_mode:
-			os.chdir(root_dir)
+		if len(argv) < idx+2 or argv[idx+1] not in archive.COMPRESSORS:
+			usage(argv[0])
 		else:
-			os.chdir(dist_dir)
-		files = [x for x in os.listdir(".") if x not in [".",".."]]
-		subprocess.call(["tar",args,dst_tgz_path]+files)
-		os.chdir(wd)
-	
-	return 0
+			method = argv[idx+1]
+			del argv[idx]
+			del argv[idx]
+			
+	if len(argv) < 2:
+		usage(argv[0])
+
+	packager = Packager(dist_dir,root_dir,append_mode,verbose_level,
+	                    src_qt_plugin,src_xlocaledir,src_clocaledir,
+	                    use_ldd,cache,store=store,trace_paths=trace_paths,
+	                    launcher=launcher_kind,patch=patch)
+	progress.start("create_package",console=verbose_level >= 1,events_path=events_path)
+	status = packager.add_executable(argv[1])
+	if status == 0:
+		with instrument.stage("copy_wait"):
+			if len(packager.wait()):
+				status = 1
+
+	if status == 0:
+		#Find (and drop) unused libraries
+		if unused_mode:
+			with instrument.stage("unused_libs"):
+				packager.minimize_libs(unused_mode == "drop")
+
+		#Point the packaged files at their libraries
+		if patch:
+			with instrument.stage("patch"):
+				packager.patch_elfs()
+
+		#Create tarball
+		if dst_tgz_path:
+			with instrument.stage("tarball"):
+				packager.create_tarball(dst_tgz_path,method,deterministic)
+
+		#Create pack image
+		if dst_pack_path:
+			with instrument.stage("pack"):
+				packager.create_pack(dst_pack_path,method)
+	progress.finish()
+
+	if profile_path:
+		instrument.write_profile(profile_path,"create_package")
+	return status
 
 if __name__ == "__main__":
 	sys.exit(main(sys.argv))
-
@@ -0,0 +1,234 @@
+## Copyright (c) 2022 Daniel Tabor
+##
+## Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions
+## are met:
+## 1. Redistributions of source code must retain the above copyright
+##    notice, this list of conditions and the following disclaimer.
+## 2. Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##
+## THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS "AS IS" AND
+## ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+## IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+## ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+## FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+## DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+## OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+## HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+## LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+## OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+## SUCH DAMAGE.
+##
+import concurrent.futures
+import hashlib
+import struct
+import json
+import os
+import archive
+
+#A delta archive holds the added and changed entries of a root at their
+#usual place, and the directory DELTA_DIR with:
+#  apply.py   : harvest_apply.py, which applies the delta to a root
+#  delta.json : the entries to delete and the patches to apply
+#  patches/N  : block patches of changed large files
+DELTA_DIR = ".harvest_delta"
+DELTA_VERSION = 1
+MANIFEST_VERSION = 1
+
+#Large files are described by the digests of their blocks, so that a
+#changed file can be sent as the blocks the old one lacks
+DIFF_BLOCK = 4096
+DIFF_MIN = 1<<20
+
+#A patch is only used if it is smaller than this part of the file
+PATCH_MAX_RATIO = 0.5
+
+#Patch operations
+OP_COPY = 0
+OP_DATA = 1
+PATCH_MAGIC = b"HDP1"
+
+READ_SIZE = 1<<20
+
+def block_digest(data):
+	return hashlib.blake2b(data,digest_size=8).hexdigest()
+
+def file_digests(path, size):
+	#Returns the sha256 of a file, and the digests of its blocks if it
+	#is large enough to be patched
+	sha = hashlib.sha256()
+	blocks = None
+	if size >= DIFF_MIN:
+		blocks = []
+	f = open(path,"rb")
+	while True:
+		data = f.read(READ_SIZE)
+		if not len(data):
+			break
+		sha.update(data)
+		if blocks != None:
+			for i in range(0,len(data),DIFF_BLOCK):
+				blocks.append(block_digest(data[i:i+DIFF_BLOCK]))
+	f.close()
+	return sha.hexdigest(), blocks
+
+def scan_root(root_dir, workers=None):
+	#Describe every entry of root_dir, keyed by its path within it
+	files = {}
+	hashes = []
+	pool = concurrent.futures.ThreadPoolExecutor(workers)
+	for path, arcname in archive.walk_sorted(root_dir,os.listdir(root_dir)):
+		st = os.lstat(path)
+		if os.path.islink(path):
+			files[arcname] = {"type":"link", "target":os.readlink(path)}
+		elif os.path.isdir(path):
+			files[arcname] = {"type":"dir"}
+		elif os.path.isfile(path):
+			entry = {"type":"file", "size":st.st_size}
+			if st.st_mode & 0o111:
+				entry["mode"] = 0o755
+			else:
+				entry["mode"] = 0o644
+			files[arcname] = entry
+			hashes.append([entry,pool.submit(file_digests,path,st.st_size)])
+	for entry, future in hashes:
+		entry["sha256"], blocks = future.result()
+		if blocks != None:
+			entry["blocks"] = blocks
+	pool.shutdown()
+	return {"version":MANIFEST_VERSION, "block_size":DIFF_BLOCK, "files":files}
+
+def read_manifest(path):
+	#A manifest written by write_manifest, or a root directory to scan
+	if os.path.isdir(path):
+		return scan_root(path)
+	fp = open(path,"r")
+	manifest = json.load(fp)
+	fp.close()
+	if manifest.get("version") != MANIFEST_VERSION:
+		raise ValueError("%s is not a version %d manifest" % (path,MANIFEST_VERSION))
+	return manifest
+
+def write_manifest(path, manifest):
+	tmp_path = path+".tmp"
+	fp = open(tmp_path,"w")
+	json.dump(manifest,fp,sort_keys=True)
+	fp.close()
+	os.replace(tmp_path,path)
+
+def make_patch(old_blocks, path):
+	#Encode the file at path as the blocks of the old file it shares
+	#(by digest) and the data of all others.  Returns None when that
+	#would not save enough.
+	index = {}
+	for i in range(len(old_blocks)-1,-1,-1):
+		index[old_blocks[i]] = i
+	ops = []
+	data_len = 0
+	size = 0
+	f = open(path,"rb")
+	while True:
+		block = f.read(DIFF_BLOCK)
+		if not len(block):
+			break
+		size += len(block)
+		i = index.get(block_digest(block))
+		if i != None:
+			offset = i*DIFF_BLOCK
+			if len(ops) and ops[-1][0] == OP_COPY and ops[-1][1]+ops[-1][2] == offset:
+				ops[-1][2] += len(block)
+			else:
+				ops.append([OP_COPY,offset,len(block)])
+		else:
+			data_len += len(block)
+			if len(ops) and ops[-1][0] == OP_DATA:
+				ops[-1][1].append(block)
+			else:
+				ops.append([OP_DATA,[block]])
+	f.close()
+	if data_len > size*PATCH_MAX_RATIO:
+		return None
+	out = [PATCH_MAGIC]
+	for op in ops:
+		if op[0] == OP_COPY:
+			out.append(struct.pack("<BQQ",OP_COPY,op[1],op[2]))
+		else:
+			data = b"".join(op[1])
+			out.append(struct.pack("<BQ",OP_DATA,len(data)))
+			out.append(data)
+	return b"".join(out)
+
+def apply_script():
+	#The apply tool shipped in every delta
+	path = os.path.join(os.path.dirname(os.path.abspath(__file__)),"harvest_apply.py")
+	fp = open(path,"rb")
+	data = fp.read()
+	fp.close()
+	return data
+
+def write_delta(dst_path, root_dir, old_manifest, new_manifest, method="gzip", workers=None, verbose=False, deterministic=False):
+	#Write a delta archive that turns a root described by old_manifest
+	#into root_dir (described by new_manifest).  Returns a dict of counts.
+	old_files = old_manifest["files"]
+	new_files = new_manifest["files"]
+	same_blocks = old_manifest.get("block_size") == DIFF_BLOCK
+
+	delete = []
+	added = []
+	patches = []
+	stats = {"deleted":0, "added":0, "changed":0, "patched":0, "unchanged":0}
+	for arcname in sorted(old_files):
+		if arcname not in new_files or new_files[arcname]["type"] != old_files[arcname]["type"]:
+			delete.append(arcname)
+	stats["deleted"] = len(delete)
+	for arcname in sorted(new_files):
+		new = new_files[arcname]
+		old = old_files.get(arcname)
+		if old == None or old["type"] != new["type"]:
+			added.append(arcname)
+			stats["added"] += 1
+		elif new["type"] == "dir" or new == old:
+			stats["unchanged"] += 1
+		elif new["type"] == "file" and old.get("sha256") == new["sha256"] and old.get("mode") != new["mode"]:
+			#Only the mode changed, which a patch without data does
+			patches.append([arcname,PATCH_MAGIC+struct.pack("<BQQ",OP_COPY,0,new["size"]),old,new])
+		else:
+			patch = None
+			if new["type"] == "file" and same_blocks and old.get("blocks") and new["size"] >= DIFF_MIN:
+				patch = make_patch(old["blocks"],os.path.join(root_dir,arcname))
+			if patch == None:
+				added.append(arcname)
+				stats["changed"] += 1
+			else:
+				patches.append([arcname,patch,old,new])
+	stats["patched"] = len(patches)
+
+	#What harvest_apply.py needs to know, besides the added entries
+	info = {"version":DELTA_VERSION, "delete":delete, "patch":[]}
+	for i in range(len(patches)):
+		arcname, patch, old, new = patches[i]
+		info["patch"].append({
+			"path":        arcname,
+			"data":        "%s/patches/%d" % (DELTA_DIR,i),
+			"base_sha256": old["sha256"],
+			"sha256":      new["sha256"],
+			"size":        new["size"],
+			"mode":        new["mode"],
+		})
+
+	writer = archive.ArchiveWriter(dst_path,method,None,workers,verbose,deterministic)
+	try:
+		writer.add_dir(DELTA_DIR)
+		writer.add_bytes(DELTA_DIR+"/apply.py",apply_script(),0o755)
+		writer.add_bytes(DELTA_DIR+"/delta.json",json.dumps(info,sort_keys=True,indent=1).encode())
+		for i in range(len(patches)):
+			writer.add_bytes(info["patch"][i]["data"],patches[i][1])
+		for arcname in added:
+			writer.add(os.path.join(root_dir,arcname),arcname)
+	except:
+		writer.abort()
+		raise
+	writer.close()
+	return stats
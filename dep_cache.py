@@ -0,0 +1,194 @@
+## Copyright (c) 2022 Daniel Tabor
+##
+## Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions
+## are met:
+## 1. Redistributions of source code must retain the above copyright
+##    notice, this list of conditions and the following disclaimer.
+## 2. Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##
+## THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS "AS IS" AND
+## ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+## IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+## ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+## FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+## DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+## OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+## HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+## LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+## OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+## SUCH DAMAGE.
+##
+import threading
+import sqlite3
+import json
+import os
+
+SCHEMA_VERSION = 4
+
+#Writes are committed in batches to keep the per-file cost low
+COMMIT_INTERVAL = 500
+
+class DepCache:
+	#Persistent cache of ELF parse results, file classifications,
+	#resolved library closures and content hashes.  Every entry is keyed
+	#by the identity of the file it describes (path, inode, mtime, size)
+	#and is ignored once the file changes.
+	def __init__(self, path):
+		self.path = path
+		#The cache may be used by the copy threads as well
+		self.lock = threading.RLock()
+		self.db = sqlite3.connect(path,timeout=60,check_same_thread=False)
+		self.db.execute("PRAGMA journal_mode=WAL")
+		self.db.execute("PRAGMA synchronous=NORMAL")
+		self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+		row = self.db.execute("SELECT value FROM meta WHERE key='version'").fetchone()
+		if row == None or int(row[0]) != SCHEMA_VERSION:
+			#(loaders only exists in version 3 and older caches)
+			for table in ["files","kinds","deps","loaders","hashes"]:
+				self.db.execute("DROP TABLE IF EXISTS %s" % table)
+			self.db.execute("INSERT OR REPLACE INTO meta VALUES ('version',?)",(str(SCHEMA_VERSION),))
+		for table, columns in [["files","info TEXT"],
+		                       ["kinds","kind TEXT"],
+		                       ["deps","env TEXT, deps TEXT"],
+		                       ["hashes","digest TEXT"]]:
+			self.db.execute("CREATE TABLE IF NOT EXISTS %s (path TEXT PRIMARY KEY, ino INTEGER, mtime INTEGER, size INTEGER, %s)" % (table,columns))
+		self.db.commit()
+		#Writes not yet in the database, keyed by (table, path).  Several
+		#processes may share the cache, so the write lock is only taken
+		#while these are written out, never between writes.
+		self.pending = {}
+		#Files are assumed not to change while a build is running
+		self.stat_memo = {}
+		self.env = self.environment()
+
+	def identity(self, path):
+		if path in self.stat_memo:
+			return self.stat_memo[path]
+		try:
+			st = os.stat(path)
+		except OSError:
+			ident = None
+		else:
+			ident = (st.st_ino,st.st_mtime_ns,st.st_size)
+		self.stat_memo[path] = ident
+		return ident
+
+	def forget(self, path):
+		#path was rewritten during the run
+		self.stat_memo.pop(path,None)
+
+	def environment(self):
+		#Library resolution also depends on the loader configuration
+		env = [os.getenv("LD_LIBRARY_PATH","")]
+		try:
+			st = os.stat("/etc/ld.so.cache")
+			env += [st.st_ino,st.st_mtime_ns,st.st_size]
+		except OSError:
+			pass
+		return json.dumps(env)
+
+	def lookup(self, table, columns, path):
+		ident = self.identity(path)
+		if ident == None:
+			return None
+		with self.lock:
+			row = self.pending.get((table,path))
+			if row == None:
+				row = self.db.execute("SELECT ino, mtime, size, %s FROM %s WHERE path=?" % (columns,table),(path,)).fetchone()
+		if row == None or tuple(row[:3]) != ident:
+			return None
+		return row[3:]
+
+	def store(self, table, path, values):
+		ident = self.identity(path)
+		if ident == None:
+			return
+		with self.lock:
+			self.pending[(table,path)] = ident+tuple(values)
+			if len(self.pending) >= COMMIT_INTERVAL:
+				self.commit()
+
+	def get_info(self, path):
+		#Returns [info] on a hit, where info is None for non-ELF files
+		row = self.lookup("files","info",path)
+		if row == None:
+			return None
+		return [json.loads(row[0])]
+
+	def put_info(self, path, info):
+		self.store("files",path,[json.dumps(info)])
+
+	def get_kind(self, path):
+		row = self.lookup("kinds","kind",path)
+		if row == None:
+			return None
+		return json.loads(row[0])
+
+	def put_kind(self, path, kind):
+		self.store("kinds",path,[json.dumps(kind)])
+
+	def deps_env(self, resolver):
+		#Closures found by different resolvers (ldd or elf_resolver) may
+		#name the same libraries by different paths
+		return json.dumps([resolver,json.loads(self.env)])
+
+	def get_deps(self, path, resolver):
+		row = self.lookup("deps","env, deps",path)
+		if row == None or row[0] != self.deps_env(resolver):
+			return None
+		deps = []
+		for name, lib_path, lib_ident in json.loads(row[1]):
+			#Any change to a library in the closure invalidates the entry
+			if self.identity(lib_path) != tuple(lib_ident):
+				return None
+			deps.append([name,lib_path])
+		return deps
+
+	def put_deps(self, path, deps, resolver):
+		entries = []
+		for name, lib_path in deps:
+			if lib_path == None:
+				#Do not remember failures, the library may show up later
+				return
+			ident = self.identity(lib_path)
+			if ident == None:
+				return
+			entries.append([name,lib_path,ident])
+		self.store("deps",path,[self.deps_env(resolver),json.dumps(entries)])
+
+	def get_hash(self, path):
+		row = self.lookup("hashes","digest",path)
+		if row == None:
+			return None
+		return row[0]
+
+	def put_hash(self, path, digest):
+		self.store("hashes",path,[digest])
+
+	def commit(self):
+		with self.lock:
+			if not len(self.pending):
+				return
+			for (table,path), row in self.pending.items():
+				marks = ",".join(["?"]*(1+len(row)))
+				self.db.execute("INSERT OR REPLACE INTO %s VALUES (%s)" % (table,marks),(path,)+row)
+			self.db.commit()
+			self.pending = {}
+
+	def close(self):
+		self.commit()
+		self.db.close()
+		if open_caches.get(os.path.abspath(self.path)) == self:
+			del open_caches[os.path.abspath(self.path)]
+
+#Caches opened by path, so tools calling each other share a connection
+open_caches = {}
+
+def open_cache(path):
+	path = os.path.abspath(path)
+	if path not in open_caches:
+		open_caches[path] = DepCache(path)
+	return open_caches[path]
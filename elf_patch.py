@@ -0,0 +1,216 @@
+## Copyright (c) 2022 Daniel Tabor
+##
+## Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions
+## are met:
+## 1. Redistributions of source code must retain the above copyright
+##    notice, this list of conditions and the following disclaimer.
+## 2. Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##
+## THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS "AS IS" AND
+## ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+## IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+## ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+## FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+## DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+## OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+## HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+## LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+## OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+## SUCH DAMAGE.
+##
+import struct
+import shutil
+import os
+import elf_reader
+import lib_usage
+
+#Sets DT_RUNPATH and PT_INTERP of ELF files without patchelf.  Neither
+#fits in place, so a new string table (the old one with the new
+#DT_RUNPATH string at its end), a new dynamic section and the new
+#interpreter path are appended to the file.  They are mapped by a new
+#PT_LOAD segment, which takes the program header of a PT_NOTE segment
+#(only read by debuggers and core dumps), so the program header table
+#keeps its size and place.
+
+PT_NOTE = 4
+
+PF_W = 2
+PF_R = 4
+
+SHT_DYNAMIC = 6
+
+#Smallest alignment of the new segment
+PAGE_SIZE = 0x1000
+
+def align_up(value, align):
+	return (value+align-1)//align*align
+
+def unpack_phdr(layout, data, offset):
+	fields = struct.unpack_from(layout["phdr"],data,offset)
+	if layout["class"] == elf_reader.ELFCLASS64:
+		p_type, p_flags, p_offset, p_vaddr, p_paddr, p_filesz, p_memsz, p_align = fields
+	else:
+		p_type, p_offset, p_vaddr, p_paddr, p_filesz, p_memsz, p_flags, p_align = fields
+	return [p_type,p_flags,p_offset,p_vaddr,p_paddr,p_filesz,p_memsz,p_align]
+
+def pack_phdr(layout, phdr):
+	p_type, p_flags, p_offset, p_vaddr, p_paddr, p_filesz, p_memsz, p_align = phdr
+	if layout["class"] == elf_reader.ELFCLASS64:
+		return struct.pack(layout["phdr"],p_type,p_flags,p_offset,p_vaddr,p_paddr,p_filesz,p_memsz,p_align)
+	return struct.pack(layout["phdr"],p_type,p_offset,p_vaddr,p_paddr,p_filesz,p_memsz,p_flags,p_align)
+
+def patch(path, runpath=None, interp=None):
+	#Set DT_RUNPATH (replacing any DT_RPATH) of the ELF file at path to
+	#runpath if it needs libraries, and its PT_INTERP to interp if it has
+	#one.  The file is rewritten as a new copy, so that anything hardlinked
+	#to it (such as a lib_store entry) is left alone.  Returns False if
+	#the file already was that way.  Raises ValueError if it can not be
+	#patched.
+	f = open(path,"rb")
+	try:
+		layout = lib_usage.read_layout(f)
+		if layout == None:
+			raise ValueError("not an ELF file")
+		f.seek(16)
+		hdr = struct.unpack(layout["hdr"],f.read(struct.calcsize(layout["hdr"])))
+		e_phoff, e_shoff = hdr[4], hdr[5]
+		e_phentsize, e_phnum, e_shentsize, e_shnum = hdr[8], hdr[9], hdr[10], hdr[11]
+		f.seek(e_phoff)
+		data = f.read(e_phentsize*e_phnum)
+		phdrs = [unpack_phdr(layout,data,i*e_phentsize) for i in range(e_phnum)]
+
+		#What the file has now
+		old_interp = None
+		for phdr in phdrs:
+			if phdr[0] == elf_reader.PT_INTERP:
+				f.seek(phdr[2])
+				old_interp = elf_reader.read_cstr(f.read(phdr[5]),0)
+		entries = []
+		strtab = None
+		if layout["dynamic"] != None:
+			entries = [x for x in layout["dynamic"][2] if x[0] != elf_reader.DT_NULL]
+			tags = dict(entries)
+			if elf_reader.DT_STRTAB in tags and elf_reader.DT_STRSZ in tags:
+				str_offset = elf_reader.vaddr_to_offset(layout["phdrs"],tags[elf_reader.DT_STRTAB])
+				if str_offset != None:
+					f.seek(str_offset)
+					strtab = f.read(tags[elf_reader.DT_STRSZ])
+	finally:
+		f.close()
+
+	#What has to change
+	if not any(d_tag == elf_reader.DT_NEEDED for d_tag, d_val in entries):
+		runpath = None
+	if runpath != None:
+		if strtab == None:
+			raise ValueError("no dynamic string table")
+		paths = [[d_tag,elf_reader.read_cstr(strtab,d_val)] for d_tag, d_val in entries
+		         if d_tag in (elf_reader.DT_RPATH,elf_reader.DT_RUNPATH)]
+		if paths == [[elf_reader.DT_RUNPATH,runpath]]:
+			runpath = None
+	if old_interp == None or old_interp == interp:
+		interp = None
+	if runpath == None and interp == None:
+		return False
+
+	#The segment that maps what is appended: the first PT_NOTE, moved
+	#after the last PT_LOAD, as the loaders expect the PT_LOAD program
+	#headers in order of address
+	notes = [i for i, phdr in enumerate(phdrs) if phdr[0] == PT_NOTE]
+	loads = [i for i, phdr in enumerate(phdrs) if phdr[0] == elf_reader.PT_LOAD]
+	if not len(notes):
+		raise ValueError("no PT_NOTE segment to map the new dynamic section with")
+	if not len(loads):
+		raise ValueError("no PT_LOAD segment")
+	note = notes[0]
+	if note < loads[-1]:
+		phdrs.insert(loads[-1],phdrs.pop(note))
+		note = loads[-1]
+	align = max([PAGE_SIZE]+[phdr[7] for phdr in phdrs if phdr[0] == elf_reader.PT_LOAD])
+	end = max(phdr[3]+phdr[6] for phdr in phdrs if phdr[0] == elf_reader.PT_LOAD)
+	word = 8 if layout["class"] == elf_reader.ELFCLASS64 else 4
+	region_offset = align_up(os.path.getsize(path),word)
+	region_vaddr = align_up(end,align)+region_offset%align
+
+	#Lay out what is appended
+	region = b""
+	changes = {}
+	if runpath != None:
+		dyn_size = struct.calcsize(layout["dyn"])
+		new_strtab = strtab+runpath.encode(errors="surrogateescape")+b"\0"
+		strtab_vaddr = region_vaddr+dyn_size*(len(entries)+2)
+		dynamic = b""
+		for d_tag, d_val in entries:
+			if d_tag in (elf_reader.DT_RPATH,elf_reader.DT_RUNPATH):
+				continue
+			if d_tag == elf_reader.DT_STRTAB:
+				d_val = strtab_vaddr
+			elif d_tag == elf_reader.DT_STRSZ:
+				d_val = len(new_strtab)
+			dynamic += struct.pack(layout["dyn"],d_tag,d_val)
+		dynamic += struct.pack(layout["dyn"],elf_reader.DT_RUNPATH,len(strtab))
+		#Keep the string table at the same place whatever was dropped
+		dynamic = dynamic.ljust(dyn_size*(len(entries)+2),b"\0")
+		changes["dynamic"] = [0,len(dynamic)]
+		changes["strtab"] = [len(dynamic),len(new_strtab)]
+		region = dynamic+new_strtab
+	if interp != None:
+		data = interp.encode(errors="surrogateescape")+b"\0"
+		changes["interp"] = [len(region),len(data)]
+		region += data
+
+	#Point the program headers at it
+	old = {}
+	phdrs[note] = [elf_reader.PT_LOAD,PF_R|PF_W,region_offset,region_vaddr,region_vaddr,
+	               len(region),len(region),align]
+	for phdr in phdrs:
+		if phdr[0] == elf_reader.PT_DYNAMIC and "dynamic" in changes:
+			old["dynamic"] = [phdr[2],phdr[3]]
+			start, size = changes["dynamic"]
+		elif phdr[0] == elf_reader.PT_INTERP and "interp" in changes:
+			old["interp"] = [phdr[2],phdr[3]]
+			start, size = changes["interp"]
+		else:
+			continue
+		phdr[2:7] = [region_offset+start,region_vaddr+start,region_vaddr+start,size,size]
+	if "strtab" in changes:
+		old["strtab"] = [str_offset,tags[elf_reader.DT_STRTAB]]
+
+	tmp_path = path+".harvest_tmp"
+	shutil.copyfile(path,tmp_path)
+	shutil.copymode(path,tmp_path)
+	try:
+		f = open(tmp_path,"r+b")
+		for i, phdr in enumerate(phdrs):
+			f.seek(e_phoff+i*e_phentsize)
+			f.write(pack_phdr(layout,phdr))
+		#Keep the section headers of what moved in step, for the tools
+		#that read those
+		if e_shoff and e_shnum and e_shentsize >= struct.calcsize(layout["shdr"]):
+			f.seek(e_shoff)
+			data = f.read(e_shentsize*e_shnum)
+			for i in range(len(data)//e_shentsize):
+				shdr = list(struct.unpack_from(layout["shdr"],data,i*e_shentsize))
+				for name, [old_offset, old_vaddr] in old.items():
+					if shdr[4] == old_offset and shdr[3] == old_vaddr and \
+					   (name != "dynamic" or shdr[1] == SHT_DYNAMIC):
+						start, size = changes[name]
+						shdr[3:6] = [region_vaddr+start,region_offset+start,size]
+						f.seek(e_shoff+i*e_shentsize)
+						f.write(struct.pack(layout["shdr"],*shdr))
+						break
+		f.seek(0,os.SEEK_END)
+		f.write(b"\0"*(region_offset-f.tell()))
+		f.write(region)
+		f.close()
+		os.replace(tmp_path,path)
+	finally:
+		if os.path.exists(tmp_path):
+			os.unlink(tmp_path)
+	#The cached information is no longer that of the file
+	elf_reader.forget(path)
+	lib_usage.symbol_cache.pop(path,None)
+	return True
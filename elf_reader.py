@@ -0,0 +1,308 @@
+## Copyright (c) 2022 Daniel Tabor
+##
+## Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions
+## are met:
+## 1. Redistributions of source code must retain the above copyright
+##    notice, this list of conditions and the following disclaimer.
+## 2. Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##
+## THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS "AS IS" AND
+## ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+## IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+## ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+## FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+## DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+## OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+## HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+## LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+## OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+## SUCH DAMAGE.
+##
+import struct
+import instrument
+
+ELF_MAGIC = b'\x7fELF'
+
+ELFCLASS32 = 1
+ELFCLASS64 = 2
+ELFDATA2LSB = 1
+ELFDATA2MSB = 2
+
+ET_EXEC = 2
+ET_DYN  = 3
+
+PT_LOAD    = 1
+PT_DYNAMIC = 2
+PT_INTERP  = 3
+
+DT_NULL    = 0
+DT_NEEDED  = 1
+DT_STRTAB  = 5
+DT_STRSZ   = 10
+DT_SONAME  = 14
+DT_RPATH   = 15
+DT_RUNPATH = 29
+DT_FLAGS_1 = 0x6ffffffb
+
+DF_1_NODEFLIB = 0x800
+DF_1_PIE      = 0x08000000
+
+#Longest "#!" line the kernel looks at
+SHEBANG_MAX = 256
+
+#Cache of parsed files, keyed by path
+elf_cache = {}
+
+#Cache of file classifications, keyed by path
+kind_cache = {}
+
+#Optional dep_cache.DepCache shared across runs
+persistent_cache = None
+
+def vaddr_to_offset(phdrs, vaddr):
+	for p_type, p_flags, p_offset, p_vaddr, p_filesz, p_memsz in phdrs:
+		if p_type != PT_LOAD:
+			continue
+		if vaddr >= p_vaddr and vaddr < p_vaddr+p_filesz:
+			return vaddr - p_vaddr + p_offset
+	return None
+
+def forget(path):
+	#Drop what is cached about the file at path, which has been rewritten
+	elf_cache.pop(path,None)
+	kind_cache.pop(path,None)
+	if persistent_cache:
+		persistent_cache.forget(path)
+
+def read_cstr(strtab, offset):
+	end = strtab.find(b'\x00',offset)
+	if end < 0:
+		end = len(strtab)
+	return strtab[offset:end].decode(errors="surrogateescape")
+
+def parse_elf(f):
+	#Parse the identification and header of an open ELF file.
+	#Returns None if the file is not a recognizable ELF file.
+	ident = f.read(16)
+	if len(ident) < 16 or ident[:4] != ELF_MAGIC:
+		return None
+	elf_class = ident[4]
+	elf_data = ident[5]
+	if elf_data == ELFDATA2LSB:
+		endian = "<"
+	elif elf_data == ELFDATA2MSB:
+		endian = ">"
+	else:
+		return None
+	if elf_class == ELFCLASS64:
+		hdr_fmt = endian+"HHIQQQIHHHHHH"
+		phdr_fmt = endian+"IIQQQQQQ"
+		dyn_fmt = endian+"qQ"
+	elif elf_class == ELFCLASS32:
+		hdr_fmt = endian+"HHIIIIIHHHHHH"
+		phdr_fmt = endian+"IIIIIIII"
+		dyn_fmt = endian+"iI"
+	else:
+		return None
+	data = f.read(struct.calcsize(hdr_fmt))
+	if len(data) < struct.calcsize(hdr_fmt):
+		return None
+	e_type, e_machine, e_version, e_entry, e_phoff, e_shoff, e_flags, \
+		e_ehsize, e_phentsize, e_phnum, e_shentsize, e_shnum, e_shstrndx = \
+		struct.unpack(hdr_fmt,data)
+
+	#Read the program headers
+	phdrs = []
+	if e_phoff and e_phnum and e_phentsize >= struct.calcsize(phdr_fmt):
+		f.seek(e_phoff)
+		data = f.read(e_phentsize*e_phnum)
+		for i in range(len(data)//e_phentsize):
+			fields = struct.unpack_from(phdr_fmt,data,i*e_phentsize)
+			if elf_class == ELFCLASS64:
+				p_type, p_flags, p_offset, p_vaddr, p_paddr, \
+					p_filesz, p_memsz, p_align = fields
+			else:
+				p_type, p_offset, p_vaddr, p_paddr, \
+					p_filesz, p_memsz, p_flags, p_align = fields
+			phdrs.append((p_type,p_flags,p_offset,p_vaddr,p_filesz,p_memsz))
+
+	info = {
+		"class":   elf_class,
+		"data":    elf_data,
+		"machine": e_machine,
+		"type":    e_type,
+		"needed":  [],
+		"soname":  None,
+		"rpath":   None,
+		"runpath": None,
+		"flags_1": 0,
+		"interp":  None,
+	}
+
+	#Read the program interpreter
+	for p_type, p_flags, p_offset, p_vaddr, p_filesz, p_memsz in phdrs:
+		if p_type == PT_INTERP:
+			f.seek(p_offset)
+			info["interp"] = read_cstr(f.read(p_filesz),0)
+			break
+
+	#Read the dynamic section
+	dynamic = []
+	for p_type, p_flags, p_offset, p_vaddr, p_filesz, p_memsz in phdrs:
+		if p_type == PT_DYNAMIC:
+			f.seek(p_offset)
+			data = f.read(p_filesz)
+			dyn_size = struct.calcsize(dyn_fmt)
+			for i in range(len(data)//dyn_size):
+				d_tag, d_val = struct.unpack_from(dyn_fmt,data,i*dyn_size)
+				if d_tag == DT_NULL:
+					break
+				dynamic.append((d_tag,d_val))
+			break
+	if not len(dynamic):
+		return info
+
+	#Locate the dynamic string table
+	strtab_addr = None
+	strtab_size = None
+	for d_tag, d_val in dynamic:
+		if d_tag == DT_STRTAB:
+			strtab_addr = d_val
+		elif d_tag == DT_STRSZ:
+			strtab_size = d_val
+	if strtab_addr == None or strtab_size == None:
+		return info
+	strtab_offset = vaddr_to_offset(phdrs,strtab_addr)
+	if strtab_offset == None:
+		return info
+	f.seek(strtab_offset)
+	strtab = f.read(strtab_size)
+
+	for d_tag, d_val in dynamic:
+		if d_tag == DT_NEEDED:
+			info["needed"].append(read_cstr(strtab,d_val))
+		elif d_tag == DT_SONAME:
+			info["soname"] = read_cstr(strtab,d_val)
+		elif d_tag == DT_RPATH:
+			info["rpath"] = read_cstr(strtab,d_val)
+		elif d_tag == DT_RUNPATH:
+			info["runpath"] = read_cstr(strtab,d_val)
+		elif d_tag == DT_FLAGS_1:
+			info["flags_1"] = d_val
+	return info
+
+def read_elf(path):
+	#Parse (and cache) the dynamic linking information of an ELF file.
+	#Returns None if path is not an ELF file.
+	if path in elf_cache:
+		return elf_cache[path]
+	if persistent_cache:
+		hit = persistent_cache.get_info(path)
+		if hit != None:
+			instrument.count("elf.persistent_hits")
+			elf_cache[path] = hit[0]
+			return hit[0]
+	try:
+		f = open(path,"rb")
+	except IOError:
+		return None
+	instrument.count("elf.parses")
+	try:
+		info = parse_elf(f)
+	except (struct.error, ValueError, OSError):
+		info = None
+	f.close()
+	elf_cache[path] = info
+	if persistent_cache:
+		persistent_cache.put_info(path,info)
+	return info
+
+def elf_kind(info):
+	if info["type"] == ET_EXEC:
+		if info["interp"]:
+			return "exec"
+		return "static"
+	if info["type"] == ET_DYN:
+		#Some libraries (libc) can also be run, but are still libraries
+		if info["interp"] and (info["flags_1"] & DF_1_PIE or not info["soname"]):
+			return "pie"
+		if info["flags_1"] & DF_1_PIE:
+			return "static"
+		return "shared"
+	return "object"
+
+def parse_shebang(line):
+	#Split a "#!" line into the interpreter and its optional argument,
+	#the way the kernel does
+	line = line[2:].split(b"\n")[0].strip().decode(errors="surrogateescape")
+	parts = line.split(None,1)
+	if not len(parts):
+		return None, None
+	if len(parts) == 1:
+		return parts[0], None
+	return parts[0], parts[1].strip()
+
+def classify(path):
+	#Classify a file from a single read of its headers.  Returns a dict
+	#with "kind" being one of:
+	#  exec   : ET_EXEC run by a program interpreter
+	#  pie    : ET_DYN run by a program interpreter
+	#  static : executable without a program interpreter, or static PIE
+	#  shared : shared library
+	#  object : any other ELF file
+	#  script : "#!" script
+	#  data   : anything else
+	#"machine" is the ELF machine, or None if the file is not ELF.
+	#"interp" is the program interpreter of ELF files, and the
+	#interpreter of scripts, with its argument in "interp_arg".
+	#Returns None if path can not be read.
+	if path in kind_cache:
+		return kind_cache[path]
+	if persistent_cache:
+		hit = persistent_cache.get_kind(path)
+		if hit != None:
+			instrument.count("classify.persistent_hits")
+			kind_cache[path] = hit
+			return hit
+	try:
+		f = open(path,"rb")
+	except IOError:
+		return None
+	instrument.count("classify.reads")
+	result = {"kind":"data", "machine":None, "interp":None, "interp_arg":None}
+	try:
+		magic = f.read(4)
+		if magic == ELF_MAGIC:
+			f.seek(0)
+			if path in elf_cache:
+				info = elf_cache[path]
+			else:
+				try:
+					info = parse_elf(f)
+				except (struct.error, ValueError):
+					info = None
+				elf_cache[path] = info
+				if persistent_cache:
+					persistent_cache.put_info(path,info)
+			if info != None:
+				result["kind"] = elf_kind(info)
+				result["machine"] = info["machine"]
+				result["interp"] = info["interp"]
+		elif magic[:2] == b"#!":
+			result["kind"] = "script"
+			result["interp"], result["interp_arg"] = parse_shebang(magic+f.read(SHEBANG_MAX-4))
+	except OSError:
+		f.close()
+		return None
+	f.close()
+	kind_cache[path] = result
+	if persistent_cache:
+		persistent_cache.put_kind(path,result)
+	return result
+
+def is_elf(path):
+	result = classify(path)
+	return result != None and result["machine"] != None
@@ -0,0 +1,204 @@
+## Copyright (c) 2022 Daniel Tabor
+##
+## Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions
+## are met:
+## 1. Redistributions of source code must retain the above copyright
+##    notice, this list of conditions and the following disclaimer.
+## 2. Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##
+## THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS "AS IS" AND
+## ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+## IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+## ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+## FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+## DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+## OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+## HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+## LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+## OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+## SUCH DAMAGE.
+##
+import struct
+import os
+import elf_reader
+import instrument
+
+LD_CACHE_PATH = "/etc/ld.so.cache"
+LD_CACHE_MAGIC = b'glibc-ld.so.cache1.1'
+
+#Multiarch library directories used by Debian based distributions
+MULTIARCH = {
+	3:   "i386-linux-gnu",
+	40:  "arm-linux-gnueabihf",
+	62:  "x86_64-linux-gnu",
+	183: "aarch64-linux-gnu",
+}
+
+#soname -> [paths] read from ld.so.cache (None until first use)
+ld_cache = None
+
+#(name, search dirs, class, data, machine) -> resolved path
+lookup_cache = {}
+
+def read_ld_cache(path=LD_CACHE_PATH):
+	entries = {}
+	try:
+		f = open(path,"rb")
+		data = f.read()
+		f.close()
+	except IOError:
+		return entries
+	#The new format may be preceded by an old format header
+	base = data.find(LD_CACHE_MAGIC)
+	if base < 0:
+		return entries
+	try:
+		nlibs, len_strings = struct.unpack_from("<II",data,base+20)
+		if nlibs > len(data):
+			#Big endian cache
+			nlibs, len_strings = struct.unpack_from(">II",data,base+20)
+			entry_fmt = ">iIIIQ"
+		else:
+			entry_fmt = "<iIIIQ"
+		entry_size = struct.calcsize(entry_fmt)
+		for i in range(nlibs):
+			flags, key, value, osversion, hwcap = \
+				struct.unpack_from(entry_fmt,data,base+48+i*entry_size)
+			key = elf_reader.read_cstr(data,base+key)
+			value = elf_reader.read_cstr(data,base+value)
+			if key not in entries:
+				entries[key] = []
+			entries[key].append(value)
+	except struct.error:
+		pass
+	return entries
+
+def default_dirs(info):
+	dirs = []
+	triplet = MULTIARCH.get(info["machine"])
+	if triplet:
+		dirs += ["/lib/%s" % triplet, "/usr/lib/%s" % triplet]
+	if info["class"] == elf_reader.ELFCLASS64:
+		dirs += ["/lib64", "/usr/lib64"]
+	dirs += ["/lib", "/usr/lib"]
+	return dirs
+
+def expand_path_list(path_list, origin, info):
+	#Split an RPATH/RUNPATH/LD_LIBRARY_PATH string and expand the
+	#dynamic string tokens understood by ld.so
+	if info["class"] == elf_reader.ELFCLASS64:
+		lib = "lib64"
+	else:
+		lib = "lib"
+	dirs = []
+	for d in path_list.split(":"):
+		if not len(d):
+			continue
+		for token, value in [["ORIGIN",origin],
+		                     ["LIB",lib],
+		                     ["PLATFORM",os.uname().machine]]:
+			d = d.replace("${%s}"%token,value).replace("$%s"%token,value)
+		dirs.append(d)
+	return dirs
+
+def compatible(path, info):
+	#ld.so skips libraries built for a different class or machine
+	if not os.path.isfile(path):
+		return False
+	cand = elf_reader.read_elf(path)
+	if cand == None:
+		return False
+	return cand["class"] == info["class"] and \
+		cand["data"] == info["data"] and \
+		cand["machine"] == info["machine"]
+
+def search_dirs(name, dirs, info):
+	key = (name,tuple(dirs),info["class"],info["data"],info["machine"])
+	if key in lookup_cache:
+		return lookup_cache[key]
+	found = None
+	for d in dirs:
+		path = os.path.normpath(os.path.join(d,name))
+		if compatible(path,info):
+			found = path
+			break
+	lookup_cache[key] = found
+	return found
+
+def search_ld_cache(name, info):
+	global ld_cache
+	if ld_cache == None:
+		ld_cache = read_ld_cache()
+	for path in ld_cache.get(name,[]):
+		if compatible(path,info):
+			return path
+	return None
+
+def find_library(name, obj_info, origin, inherited_rpaths):
+	#Resolve a DT_NEEDED entry of an object, following the ld.so search
+	#order: DT_RPATH (own and loaders', unless DT_RUNPATH is present),
+	#LD_LIBRARY_PATH, DT_RUNPATH, ld.so.cache, default directories
+	if "/" in name:
+		if compatible(name,obj_info):
+			return os.path.normpath(os.path.abspath(name))
+		return None
+	if obj_info["runpath"] == None:
+		dirs = []
+		if obj_info["rpath"] != None:
+			dirs += expand_path_list(obj_info["rpath"],origin,obj_info)
+		for rpath_dirs in inherited_rpaths:
+			dirs += rpath_dirs
+		path = search_dirs(name,dirs,obj_info)
+		if path:
+			return path
+	env_path = os.getenv("LD_LIBRARY_PATH")
+	if env_path:
+		path = search_dirs(name,expand_path_list(env_path,origin,obj_info),obj_info)
+		if path:
+			return path
+	if obj_info["runpath"] != None:
+		path = search_dirs(name,expand_path_list(obj_info["runpath"],origin,obj_info),obj_info)
+		if path:
+			return path
+	if obj_info["flags_1"] & elf_reader.DF_1_NODEFLIB:
+		return None
+	path = search_ld_cache(name,obj_info)
+	if path:
+		return path
+	return search_dirs(name,default_dirs(obj_info),obj_info)
+
+def ldd(path):
+	#Determine every library needed to load path, in the order ld.so
+	#would load them.  Returns a list of [name, resolved_path], where
+	#resolved_path is None for libraries that could not be found.
+	root_info = elf_reader.read_elf(path)
+	if root_info == None:
+		return []
+	instrument.count("ldd.resolves")
+	root_path = os.path.realpath(path)
+	loaded = {}
+	deps = []
+	queue = [[root_path,root_info,[]]]
+	while len(queue):
+		obj_path, obj_info, inherited_rpaths = queue.pop(0)
+		origin = os.path.dirname(obj_path)
+		#RPATHs are inherited by the objects loaded on our behalf
+		child_rpaths = inherited_rpaths
+		if obj_info["runpath"] == None and obj_info["rpath"] != None:
+			child_rpaths = [expand_path_list(obj_info["rpath"],origin,obj_info)] + inherited_rpaths
+		for name in obj_info["needed"]:
+			if name in loaded:
+				continue
+			lib_path = find_library(name,obj_info,origin,inherited_rpaths)
+			loaded[name] = lib_path
+			deps.append([name,lib_path])
+			if lib_path == None:
+				continue
+			lib_info = elf_reader.read_elf(lib_path)
+			if lib_info["soname"] and lib_info["soname"] not in loaded:
+				loaded[lib_info["soname"]] = lib_path
+			queue.append([lib_path,lib_info,child_rpaths])
+	return deps
@@ -24,18 +24,31 @@
 ##
 import sys
 import os
-import subprocess
-import select
+import tracers
 
 def usage():
 	print("Usage:")
-	print("%s [-h] [-s strace_path] [-o log_output] exe_path" % sys.argv[0])
+	print("%s [-h] [-t tracer] [-s strace_path] [-o log_output] exe_path" % sys.argv[0])
+	print("")
+	print("  -t : How to trace the program, strace (default) or audit")
 	sys.exit(1)
 
 def main():
 	if "-h" in sys.argv:
 		usage()
 
+	try:
+		idx = sys.argv.index("-t")
+	except:
+		tracer_name = "strace"
+	else:
+		if len(sys.argv) < idx+2 or sys.argv[idx+1] not in tracers.TRACERS:
+			usage()
+		else:
+			tracer_name = sys.argv[idx+1]
+			del sys.argv[idx]
+			del sys.argv[idx]
+
 	try:
 		idx = sys.argv.index("-s")
 	except:
@@ -56,7 +69,8 @@ def main():
 		if len(sys.argv) < idx+2:
 			usage()
 		else:
-			output_fp = file(sys.argv[idx+1],"wb")
+			output_fp = open(sys.argv[idx+1],"w")
+			del sys.argv[idx]
 			del sys.argv[idx]
 
 
@@ -66,7 +80,7 @@ def main():
 	exe_path = sys.argv[1]
 
 	#Determine strace_path
-	if strace_path == None:
+	if tracer_name == "strace" and strace_path == None:
 		path_dirs = os.getenv("PATH","/bin:/usr/bin:/usr/local/bin").split(":")
 		for d in path_dirs:
 			if "strace" in os.listdir(d):
@@ -78,37 +92,17 @@ def main():
 			usage()
 
 
-	#Run the program and parse STDERR
+	#Run the program and parse the trace
 	file_paths = {}
-	proc = subprocess.Popen([strace_path,exe_path],stderr=subprocess.PIPE)
-	while True:
-		rl, wl, xl = select.select([proc.stderr],[],[],0)
-		if len(rl):
-			line = proc.stderr.readline().decode()
-			if not len(line):
-				#Reached EOF on stderr, process is done
-				break
-			if "open(" != line[:5] and "openat(" != line[:7]:
-				continue
-			c, r = [x.strip() for x in line.strip().split("=")]
-			try:
-				r = int(r)
-			except ValueError:
-				continue
-			if r > 0:
-				s_idx = c.index("(")
-				e_idx = c.index(")")
-				if s_idx >= 0 and e_idx >= 0:
-					params = [x.strip() for x in c[s_idx+1:e_idx].split(",")]
-					if len(params) == 3:
-						path = params[1]
-					else:
-						path = params[0]
-					if path[0] != "\"" or path[-1] != "\"":
-						continue
-					path = path[1:-1]
-					if path not in file_paths:
-						file_paths[path] = None
+	if tracer_name == "strace":
+		tracer = tracers.StraceTracer(strace_path,follow=False)
+	else:
+		tracer = tracers.AuditTracer(follow=False)
+	for pid, kind, path, ok in tracer.records([exe_path]):
+		if kind not in ("open","load") or not ok:
+			continue
+		if path not in file_paths:
+			file_paths[path] = None
 	
 	#Write the output
 	output_fp.write("#######################################\n")
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+## Copyright (c) 2022 Daniel Tabor
+##
+## Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions
+## are met:
+## 1. Redistributions of source code must retain the above copyright
+##    notice, this list of conditions and the following disclaimer.
+## 2. Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##
+## THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS "AS IS" AND
+## ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+## IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+## ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+## FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+## DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+## OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+## HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+## LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+## OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+## SUCH DAMAGE.
+##
+##
+## This tool is shipped inside every delta archive (as .harvest_delta/apply.py)
+## so it must not depend on anything else in this package.
+##
+import subprocess
+import tempfile
+import hashlib
+import tarfile
+import struct
+import shutil
+import json
+import sys
+import os
+
+DELTA_DIR = ".harvest_delta"
+DELTA_VERSION = 1
+PATCH_MAGIC = b"HDP1"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+OP_COPY = 0
+OP_DATA = 1
+READ_SIZE = 1<<20
+
+def usage(cmd):
+	print("Usage:")
+	print("%s [-h] [-v] delta_archive root_dir" % cmd)
+	print("")
+	print("  Applies a delta made by harvester_package.py -delta to root_dir.")
+	sys.exit(1)
+
+def sha256_file(path):
+	sha = hashlib.sha256()
+	f = open(path,"rb")
+	while True:
+		data = f.read(READ_SIZE)
+		if not len(data):
+			break
+		sha.update(data)
+	f.close()
+	return sha.hexdigest()
+
+def remove(path):
+	if os.path.islink(path) or os.path.isfile(path):
+		os.unlink(path)
+	elif os.path.isdir(path):
+		shutil.rmtree(path)
+
+def open_delta(path):
+	#tarfile only reads zstd from Python 3.14 on, so before that a zstd
+	#delta is decompressed to a temporary file first, with the zstandard
+	#module or the zstd program
+	f = open(path,"rb")
+	magic = f.read(len(ZSTD_MAGIC))
+	if magic != ZSTD_MAGIC or hasattr(tarfile.TarFile,"zstopen"):
+		f.close()
+		return tarfile.open(path,"r:*")
+	tmp = tempfile.TemporaryFile()
+	try:
+		import zstandard
+	except ImportError:
+		f.close()
+		subprocess.check_call(["zstd","-dcq",path],stdout=tmp)
+	else:
+		f.seek(0)
+		reader = zstandard.ZstdDecompressor().stream_reader(f,read_across_frames=True)
+		shutil.copyfileobj(reader,tmp)
+		f.close()
+	tmp.seek(0)
+	return tarfile.open(fileobj=tmp,mode="r:")
+
+def apply_patch(patch, base_path, dst_path):
+	#Rebuild a file from the blocks of its old version and new data
+	if patch[:len(PATCH_MAGIC)] != PATCH_MAGIC:
+		raise ValueError("bad patch for %s" % dst_path)
+	base = open(base_path,"rb")
+	out = open(dst_path,"wb")
+	pos = len(PATCH_MAGIC)
+	while pos < len(patch):
+		op = patch[pos]
+		if op == OP_COPY:
+			op, offset, length = struct.unpack_from("<BQQ",patch,pos)
+			pos += struct.calcsize("<BQQ")
+			base.seek(offset)
+			while length:
+				data = base.read(min(length,READ_SIZE))
+				if not len(data):
+					raise ValueError("patch for %s reads past the old file" % dst_path)
+				out.write(data)
+				length -= len(data)
+		elif op == OP_DATA:
+			op, length = struct.unpack_from("<BQ",patch,pos)
+			pos += struct.calcsize("<BQ")
+			out.write(patch[pos:pos+length])
+			pos += length
+		else:
+			raise ValueError("bad patch for %s" % dst_path)
+	out.close()
+	base.close()
+
+def main(argv):
+	if "-h" in argv:
+		usage(argv[0])
+
+	try:
+		idx = argv.index("-v")
+	except:
+		verbose = False
+	else:
+		verbose = True
+		del argv[idx]
+
+	if len(argv) < 3:
+		usage(argv[0])
+
+	delta_path = argv[1]
+	root_dir = os.path.abspath(argv[2])
+
+	try:
+		tar = open_delta(delta_path)
+	except (OSError, subprocess.CalledProcessError, tarfile.TarError) as e:
+		print("ERROR: Unable to read %s: %s" % (delta_path,e))
+		return 1
+	try:
+		fp = tar.extractfile(DELTA_DIR+"/delta.json")
+		info = json.loads(fp.read().decode())
+		fp.close()
+	except (KeyError, ValueError, EOFError, tarfile.TarError):
+		print("ERROR: %s is not a harvest delta" % delta_path)
+		return 1
+	if info.get("version") != DELTA_VERSION:
+		print("ERROR: %s is not a version %d delta" % (delta_path,DELTA_VERSION))
+		return 1
+
+	#Make sure the delta was made against what is in root_dir before
+	#touching anything
+	for patch in info["patch"]:
+		path = os.path.join(root_dir,patch["path"])
+		if not os.path.isfile(path) or sha256_file(path) != patch["base_sha256"]:
+			print("ERROR: %s is not the version this delta was made for" % path)
+			return 1
+
+	#Rebuild the patched files next to the old ones, and check them,
+	#before anything in root_dir is changed
+	patched = []
+	done = False
+	try:
+		for patch in info["patch"]:
+			path = os.path.join(root_dir,patch["path"])
+			tmp_path = path+".harvest_tmp"
+			if verbose:
+				print("Patch: %s" % patch["path"])
+			patched.append(tmp_path)
+			fp = tar.extractfile(patch["data"])
+			apply_patch(fp.read(),path,tmp_path)
+			fp.close()
+			if sha256_file(tmp_path) != patch["sha256"]:
+				print("ERROR: patching %s did not give the expected file" % path)
+				return 1
+			os.chmod(tmp_path,patch["mode"])
+		done = True
+	except (OSError, ValueError, struct.error, tarfile.TarError) as e:
+		print("ERROR: Unable to patch: %s" % e)
+		return 1
+	finally:
+		if not done:
+			for tmp_path in patched:
+				if os.path.exists(tmp_path):
+					os.unlink(tmp_path)
+
+	#Remove what is gone (or changed type), deepest first
+	for arcname in sorted(info["delete"],reverse=True):
+		if verbose:
+			print("Delete: %s" % arcname)
+		remove(os.path.join(root_dir,arcname))
+
+	#Put the added and changed entries in place.  Existing files are
+	#replaced rather than written into, as they may be hardlinked.
+	extracted = 0
+	for member in tar:
+		if member.name == DELTA_DIR or member.name.startswith(DELTA_DIR+"/"):
+			continue
+		path = os.path.join(root_dir,member.name)
+		if verbose:
+			print("Extract: %s" % member.name)
+		if not member.isdir() and os.path.lexists(path):
+			remove(path)
+		if hasattr(tarfile,"tar_filter"):
+			tar.extract(member,root_dir,filter="tar")
+		else:
+			tar.extract(member,root_dir)
+		extracted += 1
+
+	for patch, tmp_path in zip(info["patch"],patched):
+		os.replace(tmp_path,os.path.join(root_dir,patch["path"]))
+	tar.close()
+
+	print("Applied %s: %d deleted, %d extracted, %d patched" %
+		(delta_path,len(info["delete"]),extracted,len(info["patch"])))
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv))
@@ -24,19 +24,68 @@
 ##
 import sys
 import os
-import shutil
+import json
+import concurrent.futures
 import create_package
+import copy_engine
+import lib_store
+import elf_reader
+import dep_cache
+import instrument
+import progress
+import launcher
+import path_trie
 
-exec_paths   = {}
-data_paths   = {}
-ignore_paths = {}
+exec_paths   = path_trie.PathTrie()
+data_paths   = path_trie.PathTrie()
+ignore_paths = path_trie.PathTrie()
+
+#Packager used by each planning process in parallel mode
+worker_packager = None
+
+#Kinds of executables (see elf_reader.classify) that get packaged with
+#their libraries, and those that are copied as they are
+PACKAGED_KINDS = {"exec","pie"}
+COPIED_KINDS = {
+	"static" : "Static Binary",
+	"script" : "Script",
+}
+
+#Manifests of the previous and the current build (incremental mode only)
+MANIFEST_VERSION = 1
+old_manifest = None
+new_manifest = None
+identities = {}
 
 def usage(cmd):
 	print("Usage:")
 	print("%s [-h] [-c config_dir] [-qt qt_plugin_dir]" % cmd)
-	print("     [-xl x_locale_dir] [-cl c_locale_dir]")
+	print("     [-xl x_locale_dir] [-cl c_locale_dir] [-cache cache_file]")
+	print("     [-j jobs] [-store store_dir] [-m manifest_file] [-trace trace_file]")
+	print("     [-unused report|drop] [-profile profile_file] [-v]")
+	print("     [-events events_file] [-launcher bash|sh|stub] [-patch]")
 	print("     root_dir dist_dir")
 	print("")
+	print("  -j : Package up to jobs executables at once.")
+	print("  -store : Keep a single copy of each packaged file in store_dir")
+	print("        and hardlink (or symlink) the package contents to it.")
+	print("  -m : Incremental mode.  Record what was built in manifest_file,")
+	print("       and on later builds only copy files and package executables")
+	print("       whose sources have changed, and remove files that are no")
+	print("       longer part of the build.")
+	print("  -trace : Only package the plugin/locale files listed in trace_file")
+	print("        (files_used.py output), with the libraries they need.")
+	print("  -unused : Report the packaged libraries that no packaged file")
+	print("        imports a symbol from, or drop them.")
+	print("  -profile : Write stage timings and counters to profile_file (a")
+	print("        Chrome trace)")
+	print("  -v : Print every file harvested, not just the progress.")
+	print("  -events : Write the progress as JSON lines to events_file.")
+	print("  -launcher : How executables are started (default bash), see")
+	print("        create_package.py.")
+	print("  -patch : Set DT_RUNPATH and PT_INTERP of the packaged files, so")
+	print("        that launchers do not set LD_LIBRARY_PATH.")
+	print("")
 	print("This program utilizes create_package called with the -gd argument.")
 	print("")
 	sys.exit(1)
@@ -60,22 +109,152 @@ def read_config(config_dir):
 			line = line.strip()
 			if not len(line) or line[0] == "#":
 				continue
-			config_dict[line] = None
+			config_dict.add(line)
 		fp.close()
 
-def isELF(path):
-	f = open(path,"rb")
-	hdr = f.read(4).decode()
-	f.close()
-	if hdr == "\x7fELF":
-		return True
+def identity(path):
+	if path in identities:
+		return identities[path]
+	try:
+		st = os.stat(path)
+	except OSError:
+		ident = None
 	else:
+		ident = [st.st_ino,st.st_mtime_ns,st.st_size]
+	identities[path] = ident
+	return ident
+
+def read_manifest(path):
+	manifest = None
+	if path != None and os.path.exists(path):
+		fp = open(path,"r")
+		try:
+			manifest = json.load(fp)
+		except ValueError:
+			manifest = None
+		fp.close()
+	if manifest == None or manifest.get("version") != MANIFEST_VERSION:
+		manifest = {"version":MANIFEST_VERSION,"env":None,"files":{},"exec":{}}
+	return manifest
+
+def write_manifest(path, manifest):
+	fp = open(path+".tmp","w")
+	json.dump(manifest,fp,sort_keys=True)
+	fp.close()
+	os.replace(path+".tmp",path)
+
+def is_current(dst, src):
+	#Decide whether dst, which may already exist in the distribution, is
+	#an up to date copy of src.  Without a manifest any existing file is.
+	if not os.path.lexists(dst):
+		return False
+	if old_manifest == None:
+		return True
+	return old_manifest["files"].get(dst) == [src,identity(src)]
+
+def record(dst, src, ident):
+	if new_manifest != None:
+		new_manifest["files"][dst] = [src,ident]
+
+def harvest_copy(copier, src, dst, store=None):
+	record(dst,src,identity(src))
+	if not is_current(dst,src):
+		copier.copy(src,dst,store)
+
+def harvest_symlink(linkto, dst):
+	record(dst,linkto,None)
+	if os.path.islink(dst) and os.readlink(dst) == linkto:
+		return
+	if os.path.lexists(dst):
+		if old_manifest == None:
+			return
+		os.unlink(dst)
+	os.symlink(linkto,dst)
+
+def exec_current(exec_file):
+	#An executable is up to date when nothing in its dependency closure
+	#has changed since the last build
+	if old_manifest == None or old_manifest["env"] != new_manifest["env"]:
+		return False
+	rec = old_manifest["exec"].get(exec_file)
+	if rec == None or not os.path.exists(rec["script"]):
 		return False
+	for src, dst, ident in rec["closure"]:
+		if identity(src) != ident or not os.path.exists(dst):
+			return False
+	return True
+
+def record_exec(exec_file, rec):
+	if new_manifest == None:
+		return
+	new_manifest["exec"][exec_file] = rec
+	for src, dst, ident in rec["closure"]:
+		record(dst,src,ident)
+	record(rec["script"],exec_file,None)
+
+def record_plan(plan):
+	closure = [[src,dst,identity(src)] for src, dst in plan["closure"]]
+	record_exec(plan["exec"],{"closure":closure,"script":plan["script"][0],"launcher":plan["script"]})
+
+def forget_dropped(dropped, unused):
+	#Dropped libraries are no longer part of the build, so that the
+	#executables needing them still are up to date.  They are remembered
+	#(as long as they are not back in use), since a later build may copy
+	#them back for files that no longer list them.
+	for lib_path in unused:
+		new_manifest["files"].pop(lib_path,None)
+	for rec in new_manifest["exec"].values():
+		rec["closure"] = [x for x in rec["closure"] if x[1] not in unused]
+	new_manifest["dropped"] = sorted(set(x for x in dropped if not os.path.lexists(x)) | set(unused))
+
+def remove_orphans(root_dir):
+	#Remove everything the previous build created that is no longer part
+	#of the build, along with any directories left empty
+	for dst in sorted(old_manifest["files"].keys()):
+		if dst in new_manifest["files"]:
+			continue
+		if os.path.lexists(dst) and not os.path.isdir(dst):
+			progress.debug("Removing: %s" % dst)
+			os.unlink(dst)
+		d = os.path.dirname(dst)
+		while d[:len(root_dir)+1] == root_dir+"/":
+			try:
+				os.rmdir(d)
+			except OSError:
+				break
+			d = os.path.dirname(d)
+
+def init_worker(packager_args, cache_path, profile):
+	global worker_packager
+	if profile:
+		#Drop what a forked worker inherited from the tool
+		instrument.take()
+		instrument.enable()
+	cache = None
+	if cache_path != None:
+		#Never share the parent's database connection across a fork
+		cache = dep_cache.DepCache(cache_path)
+	elf_reader.persistent_cache = cache
+	worker_packager = create_package.Packager(cache=cache,**packager_args)
+
+def plan_worker(exec_file):
+	#What the worker recorded goes back with the plan (see instrument.take)
+	with instrument.stage("plan",exec=exec_file):
+		plan = worker_packager.plan_executable(exec_file)
+	return [plan,instrument.take()]
+
+def install_worker(packager, plan):
+	progress.working("install %s" % os.path.basename(plan["exec"]))
+	with instrument.stage("install",exec=plan["exec"]):
+		packager.install(plan)
+	progress.working(None)
 
 def main(argv):
 	global exec_paths
 	global data_paths
 	global ignore_paths
+	global old_manifest
+	global new_manifest
 	
 	if "-h" in argv:
 		usage(argv[0])
@@ -130,101 +309,375 @@ def main(argv):
 			del argv[idx]
 			del argv[idx]
 
+	try:
+		idx = argv.index("-cache")
+	except:
+		cache_path = None
+	else:
+		if len(argv) < idx+2:
+			usage(argv[0])
+		else:
+			cache_path = argv[idx+1]
+			del argv[idx]
+			del argv[idx]
+
+	try:
+		idx = argv.index("-j")
+	except:
+		jobs = 1
+	else:
+		if len(argv) < idx+2:
+			usage(argv[0])
+		try:
+			jobs = int(argv[idx+1])
+		except ValueError:
+			usage(argv[0])
+		if jobs < 1:
+			usage(argv[0])
+		del argv[idx]
+		del argv[idx]
+
+	try:
+		idx = argv.index("-store")
+	except:
+		store_dir = None
+	else:
+		if len(argv) < idx+2:
+			usage(argv[0])
+		else:
+			store_dir = argv[idx+1]
+			del argv[idx]
+			del argv[idx]
+
+	try:
+		idx = argv.index("-m")
+	except:
+		manifest_path = None
+	else:
+		if len(argv) < idx+2:
+			usage(argv[0])
+		else:
+			manifest_path = argv[idx+1]
+			del argv[idx]
+			del argv[idx]
+
+	try:
+		idx = argv.index("-trace")
+	except:
+		trace_paths = None
+	else:
+		if len(argv) < idx+2:
+			usage(argv[0])
+		else:
+			trace_paths = create_package.read_trace(argv[idx+1])
+			del argv[idx]
+			del argv[idx]
+
+	try:
+		idx = argv.index("-v")
+	except:
+		verbose = False
+	else:
+		verbose = True
+		del argv[idx]
+
+	try:
+		idx = argv.index("-events")
+	except:
+		events_path = None
+	else:
+		if len(argv) < idx+2:
+			usage(argv[0])
+		else:
+			events_path = argv[idx+1]
+			del argv[idx]
+			del argv[idx]
+
+	try:
+		idx = argv.index("-profile")
+	except:
+		profile_path = None
+	else:
+		if len(argv) < idx+2:
+			usage(argv[0])
+		else:
+			profile_path = argv[idx+1]
+			instrument.enable()
+			del argv[idx]
+			del argv[idx]
+
+	try:
+		idx = argv.index("-launcher")
+	except:
+		launcher_kind = "bash"
+	else:
+		if len(argv) < idx+2 or argv[idx+1] not in launcher.LAUNCHERS:
+			usage(argv[0])
+		else:
+			launcher_kind = argv[idx+1]
+			del argv[idx]
+			del argv[idx]
+
+	try:
+		idx = argv.index("-patch")
+	except:
+		patch = False
+	else:
+		patch = True
+		del argv[idx]
+
+	try:
+		idx = argv.index("-unused")
+	except:
+		unused_mode = None
+	else:
+		if len(argv) < idx+2 or argv[idx+1] not in ("report","drop"):
+			usage(argv[0])
+		else:
+			unused_mode = argv[idx+1]
+			del argv[idx]
+			del argv[idx]
+
 	if len(argv) < 3:
 		usage(argv[0])
 
-	root_dir = argv[1]
-	dist_dir = argv[2]
+	root_dir = os.path.abspath(argv[1])
+	dist_dir = os.path.abspath(argv[2])
 
-	cp_args = ["create_package","-v","0","-gd",root_dir,dist_dir]
-	if src_qt_plugin != None:
-		cp_args.append("-qt")
-		cp_args.append(src_qt_plugin)
-	if src_xlocaledir != None:
-		cp_args.append("-xl")
-		cp_args.append(src_xlocaledir)
-	if src_clocaledir != None:
-		cp_args.append("-cl")
-		cp_args.append(src_clocaledir)
+	if cache_path != None:
+		cache = dep_cache.open_cache(cache_path)
+		elf_reader.persistent_cache = cache
+	else:
+		cache = None
+	packager_args = {
+		"dist_dir":       dist_dir,
+		"root_dir":       root_dir,
+		"verbose_level":  0,
+		"src_qt_plugin":  src_qt_plugin,
+		"src_xlocaledir": src_xlocaledir,
+		"src_clocaledir": src_clocaledir,
+		"trace_paths":    trace_paths,
+		"launcher":       launcher_kind,
+		"patch":          patch,
+	}
+	copier = copy_engine.CopyEngine()
+	if store_dir != None:
+		store = lib_store.LibStore(store_dir,cache)
+	else:
+		store = None
+	try:
+		packager = create_package.Packager(cache=cache,copier=copier,store=store,
+		                                   **packager_args)
+	except ValueError as e:
+		print("ERROR: %s" % e)
+		usage(argv[0])
+
+	progress.start("harvester_build",events_path=events_path,debug=verbose)
 
 	#Read in the existing configuration
-	read_config(config_dir)
+	with instrument.stage("read_config"):
+		read_config(config_dir)
+
+	if manifest_path != None:
+		old_manifest = read_manifest(manifest_path)
+		new_manifest = read_manifest(None)
+		new_manifest["env"] = {
+			"ld_so_cache":     identity("/etc/ld.so.cache"),
+			"ld_library_path": os.getenv("LD_LIBRARY_PATH",""),
+			"options":         [dist_dir,src_qt_plugin,src_xlocaledir,src_clocaledir,
+			                    sorted(trace_paths) if trace_paths != None else None,
+			                    unused_mode,launcher_kind,patch],
+		}
+		packager.is_current = is_current
 
 	error_files = []
 
 	#Copy over all of the configured data paths
-	data_files = [x for x in data_paths.keys()]
-	data_files.sort()
-	for data_file in data_files:
-		if data_file[0] != "/":
-			error_files.append(data_file)
-			print("ERROR: Data file path: %s is not absolute" % data_file)
-			continue
-		print("Harvesting Data Path: %s" % data_file)
-		if os.path.islink(data_file):
-			#Create a symlink
-			linkto = os.readlink(data_file)
-			dst_dir = os.path.join(root_dir,os.path.dirname(data_file)[1:])
-			dst = os.path.join(dst_dir,os.path.basename(data_file))
-			if not os.path.exists(dst):
-				os.symlink(linkto,dst)
-		elif not os.path.isdir(data_file):
-			#Just copy over a single file
-			if not os.path.exists(data_file):
+	with instrument.stage("data"):
+		data_files = [x for x in data_paths]
+		data_files.sort()
+		progress.expect("data",len(data_files))
+		for data_file in data_files:
+			progress.advance("data")
+			if data_file[0] != "/":
 				error_files.append(data_file)
-				print("ERROR: %s does not exists" % data_file)
+				progress.message("ERROR: Data file path: %s is not absolute" % data_file)
 				continue
-			dst_dir = os.path.join(root_dir,os.path.dirname(data_file)[1:])
-			dst = os.path.join(dst_dir,os.path.basename(data_file))
-			if not os.path.exists(dst_dir):
-				os.makedirs(dst_dir)
-			if not os.path.exists(dst):
-				shutil.copy(data_file,dst)
-		else:
-			#Copy over an entire subtree
-			for root,dirs,files in os.walk(data_file):
-				for d in dirs:
-					dst_dir = os.path.join(root_dir,root[1:],d)
-					if not os.path.exists(dst_dir):
-						os.makedirs(dst_dir)
-				for f in files:
-					src = os.path.join(root,f)
-					dst_dir = os.path.join(root_dir,root[1:])
-					dst = os.path.join(dst_dir,f)
-					if not os.path.exists(dst_dir):
-						os.makedirs(dst_dir)
-					if not os.path.exists(dst):
-						shutil.copy(src,dst)
+			if ignore_paths.covers(data_file) != None:
+				continue
+			progress.debug("Harvesting Data Path: %s" % data_file)
+			progress.working("data %s" % data_file)
+			if os.path.islink(data_file):
+				#Create a symlink
+				linkto = os.readlink(data_file)
+				dst_dir = os.path.join(root_dir,os.path.dirname(data_file)[1:])
+				dst = os.path.join(dst_dir,os.path.basename(data_file))
+				if not os.path.exists(dst_dir):
+					os.makedirs(dst_dir)
+				harvest_symlink(linkto,dst)
+			elif not os.path.isdir(data_file):
+				#Just copy over a single file
+				if not os.path.exists(data_file):
+					error_files.append(data_file)
+					progress.message("ERROR: %s does not exists" % data_file)
+					continue
+				dst_dir = os.path.join(root_dir,os.path.dirname(data_file)[1:])
+				dst = os.path.join(dst_dir,os.path.basename(data_file))
+				if not os.path.exists(dst_dir):
+					os.makedirs(dst_dir)
+				harvest_copy(copier,data_file,dst)
+			else:
+				#Copy over an entire subtree
+				for root,dirs,files in os.walk(data_file):
+					#Skip any ignored trees within it
+					dirs[:] = [d for d in dirs if os.path.join(root,d) not in ignore_paths]
+					for d in dirs:
+						dst_dir = os.path.join(root_dir,root[1:],d)
+						if not os.path.exists(dst_dir):
+							os.makedirs(dst_dir)
+					for f in files:
+						src = os.path.join(root,f)
+						if src in ignore_paths:
+							continue
+						dst_dir = os.path.join(root_dir,root[1:])
+						dst = os.path.join(dst_dir,f)
+						if not os.path.exists(dst_dir):
+							os.makedirs(dst_dir)
+						harvest_copy(copier,src,dst)
+		progress.working(None)
 
 	#Create portable packages for each executable
-	exec_files = [x for x in exec_paths.keys()]
+	exec_files = [x for x in exec_paths]
 	exec_files.sort()
+	elf_files = []
+	progress.expect("exec",len(exec_files))
 	for i in range(len(exec_files)):
 		exec_file = exec_files[i]
+		progress.advance("exec")
 		if exec_file[0] != "/":
-			error_files.append(data_file)
-			print("ERROR: Exec file path: %s is not absolute" % exec_file)
+			error_files.append(exec_file)
+			progress.message("ERROR: Exec file path: %s is not absolute" % exec_file)
+			continue
+		if ignore_paths.covers(exec_file) != None:
 			continue
 		if not os.path.exists(exec_file):
-			error_files.append(data_file)
-			print("ERROR: Exec file path: %s does not exist" % exec_file)
+			error_files.append(exec_file)
+			progress.message("ERROR: Exec file path: %s does not exist" % exec_file)
 			continue
 		dst_dir = os.path.join(root_dir,os.path.dirname(exec_file)[1:])
 		if not os.path.exists(dst_dir):
 			os.makedirs(dst_dir)
-		if isELF(exec_file):
-			print("Harvesting Binary: %s" % exec_file)
-			if create_package.main(cp_args+[exec_file]):
+		result = elf_reader.classify(exec_file)
+		if result == None:
+			error_files.append(exec_file)
+			progress.message("ERROR: Exec file path: %s can not be read" % exec_file)
+			continue
+		if result["kind"] in PACKAGED_KINDS:
+			if exec_current(exec_file):
+				progress.debug("Up to date Binary: %s" % exec_file)
+				rec = old_manifest["exec"][exec_file]
+				#Its package is still patched along with the rest
+				packager.add_launcher(*rec["launcher"])
+				record_exec(exec_file,rec)
+				continue
+			progress.debug("Harvesting Binary: %s" % exec_file)
+			if jobs > 1:
+				elf_files.append(exec_file)
+				continue
+			progress.working("plan %s" % os.path.basename(exec_file))
+			with instrument.stage("plan",exec=exec_file):
+				plan = packager.plan_executable(exec_file)
+			progress.working(None)
+			if plan == None:
 				error_files.append(exec_file)
+				continue
+			install_worker(packager,plan)
+			record_plan(plan)
 		else:
-			print("Harvesting Script: %s" % exec_file)
-			shutil.copy(exec_file,dst_dir)
+			#Static binaries and scripts run as they are
+			progress.debug("Harvesting %s: %s" % (COPIED_KINDS.get(result["kind"],"File"),exec_file))
+			harvest_copy(copier,exec_file,os.path.join(dst_dir,os.path.basename(exec_file)))
+
+	#The plugin and locale trees may change without any executable
+	#changing, so check them on their own.  They are copied as install
+	#would, as the copier only copies each file once.
+	if new_manifest != None:
+		for src, dst in packager.tree_closure():
+			packager.makedirs(os.path.dirname(dst))
+			harvest_copy(copier,src,dst,packager.store)
+
+	if len(elf_files):
+		#Libraries are resolved by a pool of processes, while the results
+		#are copied into place by a pool of threads.  The packager makes
+		#sure every file is only copied once.
+		planners = concurrent.futures.ProcessPoolExecutor(jobs,
+			initializer=init_worker,initargs=(packager_args,cache_path,instrument.enabled))
+		installers = concurrent.futures.ThreadPoolExecutor(jobs)
+		installs = []
+		progress.expect("plan",len(elf_files))
+		for exec_file, [plan, profile] in zip(elf_files,planners.map(plan_worker,elf_files)):
+			progress.advance("plan")
+			instrument.merge(profile)
+			if plan == None:
+				error_files.append(exec_file)
+				continue
+			installs.append([exec_file,installers.submit(install_worker,packager,plan)])
+			record_plan(plan)
+		planners.shutdown()
+		for exec_file, future in installs:
+			try:
+				future.result()
+			except (IOError, OSError) as e:
+				progress.message("ERROR: %s: %s" % (exec_file,e))
+				error_files.append(exec_file)
+		installers.shutdown()
+
+	#Wait for all of the files to be copied into place
+	with instrument.stage("copy_wait"):
+		failed = copier.wait()
+	for src, dst, e in failed:
+		progress.message("ERROR: Unable to copy %s: %s" % (src,e))
+		error_files.append(src)
+		if new_manifest != None and dst in new_manifest["files"]:
+			del new_manifest["files"][dst]
+	copier.shutdown()
+	progress.message(copier.report())
+
+	#Find (and drop) libraries nothing imports a symbol from
+	if unused_mode:
+		dropped = []
+		if unused_mode == "drop" and old_manifest != None:
+			dropped = old_manifest.get("dropped",[])
+		with instrument.stage("unused_libs"):
+			unused = packager.minimize_libs(unused_mode == "drop",dropped)
+		for lib_path in sorted(unused):
+			progress.message("Unused Library: %s" % lib_path)
+		if unused_mode == "drop" and new_manifest != None:
+			forget_dropped(dropped,unused)
+
+	#Point the packaged files at their libraries
+	if patch:
+		with instrument.stage("patch"):
+			packager.patch_elfs()
+
+	if new_manifest != None:
+		with instrument.stage("manifest"):
+			remove_orphans(root_dir)
+			write_manifest(manifest_path,new_manifest)
+
+	if cache:
+		cache.close()
+
+	progress.finish()
+
+	if profile_path:
+		instrument.write_profile(profile_path,"harvester_build")
 
 	if len(error_files):
 		print("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
 		print("!!")
 		print("!! Build failed for the following files:")
-		for f in error_files:
+		for f in sorted(error_files):
 			print("!! %s" % f)
 		print("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
 
@@ -24,16 +24,27 @@
 ##
 import sys
 import os
-import subprocess
-import select
+import tracers
+import path_trie
+import instrument
 
-exec_paths   = {}
-data_paths   = {}
-ignore_paths = {}
+exec_paths   = path_trie.PathTrie()
+data_paths   = path_trie.PathTrie()
+ignore_paths = path_trie.PathTrie()
 
 def usage(cmd):
 	print("Usage:")
-	print("%s [-h] [-s strace_path] [-c config_dir] exe_path [args...]" % cmd)
+	print("%s [-h] [-t tracer] [-s strace_path] [-c config_dir] [-l trace_log]" % cmd)
+	print("     [-profile profile_file]")
+	print("     exe_path [args...]")
+	print("")
+	print("  -t : How to trace the program (default strace):")
+	print("       strace : run it under strace")
+	print("       audit  : load a LD_AUDIT/LD_PRELOAD shim into it, built with cc.")
+	print("                Much faster, but statically linked programs are not seen")
+	print("  -l : Also save the raw trace output to trace_log")
+	print("  -profile : Write stage timings and counters to profile_file (a")
+	print("       Chrome trace)")
 	sys.exit(1)
 
 def read_config(config_dir):
@@ -55,7 +66,7 @@ def read_config(config_dir):
 			line = line.strip()
 			if not len(line) or line[0] == "#":
 				continue
-			config_dict[line] = None
+			config_dict.add(line)
 		fp.close()
 		
 
@@ -65,46 +76,28 @@ def write_config(config_dir):
 	for path, config_dict in [["HARVEST_EXEC",exec_paths],
 														["HARVEST_DATA",data_paths]]:
 		print("  %s: %d total files" % (path,len(config_dict)))
-		files = [x for x in config_dict.keys()]
+		files = [x for x in config_dict]
 		files.sort()
 		fp = open(os.path.join(config_dir,path),"w")
 		for f in files:
 			fp.write("%s\n" % f)
 		fp.close()
 
-def dequote(s):
-	if s[0] == "\"":
-		if s[-1] != "\"":
-			raise ValueError("Not quoted %s" % s)
-		return s[1:-1]
-	elif s[0] == "'":
-		if s[-1] != "'":
-			raise ValueError("Not quoted %s" % s)
-		return s[1:-1]
-	else:
-		raise ValueError("Not quoted %s" % s)
-
 def config_add(config_dict, path):
 	global ignore_paths
 	apath = os.path.abspath(path)
-	if apath in config_dict:
-		#Specific path is already configured
+	if config_dict.covers(apath) != None:
+		#Already configured, by itself or its entire directory tree
 		return
 	if not os.path.exists(apath):
 		#Specific path does not exist
 		return
-	parts = apath.split("/")
-	for i in range(len(parts)):
-		test_path = "/".join(parts[:i+1])
-		if test_path in ignore_paths:
-			#Configured to ignore this entire directory tree
-			return
-		elif test_path in config_dict:
-			#Already configured to include this entire directory tree 
-			return
+	if ignore_paths.covers(apath) != None:
+		#Configured to ignore this entire directory tree
+		return
 	
 	#No reason found to not include this file
-	config_dict[apath] = None
+	config_dict.add(apath)
 
 def main(argv):
 	global exec_paths
@@ -113,6 +106,18 @@ def main(argv):
 	if "-h" in argv:
 		usage(argv[0])
 
+	try:
+		idx = argv.index("-t")
+	except:
+		tracer_name = "strace"
+	else:
+		if len(argv) < idx+2 or argv[idx+1] not in tracers.TRACERS:
+			usage(argv[0])
+		else:
+			tracer_name = argv[idx+1]
+			del argv[idx]
+			del argv[idx]
+
 	try:
 		idx = argv.index("-s")
 	except:
@@ -139,6 +144,31 @@ def main(argv):
 			del argv[idx]
 			del argv[idx]
 
+	try:
+		idx = argv.index("-l")
+	except:
+		log_path = None
+	else:
+		if len(argv) < idx+2:
+			usage(argv[0])
+		else:
+			log_path = argv[idx+1]
+			del argv[idx]
+			del argv[idx]
+
+	try:
+		idx = argv.index("-profile")
+	except:
+		profile_path = None
+	else:
+		if len(argv) < idx+2:
+			usage(argv[0])
+		else:
+			profile_path = argv[idx+1]
+			instrument.enable()
+			del argv[idx]
+			del argv[idx]
+
 	if len(argv) < 2:
 		usage(argv[0])
 
@@ -146,7 +176,7 @@ def main(argv):
 	exe_args = argv[2:]
 	
 	#Determine strace_path
-	if strace_path == None:
+	if tracer_name == "strace" and strace_path == None:
 		path_dirs = os.getenv("PATH","/bin:/usr/bin:/usr/local/bin").split(":")
 		script_path = os.path.dirname(argv[0])
 		#Give preference to the statically linked executable included
@@ -162,122 +192,27 @@ def main(argv):
 			usage(argv[0])
 
 	#Read in the existing configuration
-	read_config(config_dir)
+	with instrument.stage("read_config"):
+		read_config(config_dir)
 
-	#Run the program and parse STDERR
-	file_paths = {}
-	proc = subprocess.Popen([strace_path,"-f",exe_path]+exe_args,stderr=subprocess.PIPE)
-	output = {}
-	output[proc.pid] = ""
-	while True:
-		rl, wl, xl = select.select([proc.stderr],[],[],0)
-		if len(rl):
-			line = proc.stderr.readline().decode()
-			
-			if not len(line):
-				#Reached EOF on stderr, process is done
-				break
-			
-			#Ignore any PID declarations at the beginning of the line
-			if "[pid" == line[:4]:
-				e_idx = line.find("]")
-				if e_idx < 0:
-					continue
-				line = line[e_idx+1:].strip()
-			
-			#Attempt to identify a syscall and result
-			try:
-				call, result = [x.strip() for x in line.strip().split("=")]
-			except ValueError:
-				#No identifyable call and result
-				#continue
-				#This is a HACK to get around unfinished syscalls without
-				#having to track output from different processess and threads
-				call = line
-				result = None
+	#Run the program and record the files it uses
+	if tracer_name == "strace":
+		tracer = tracers.StraceTracer(strace_path,log_path=log_path)
+	else:
+		tracer = tracers.AuditTracer(log_path=log_path)
+	with instrument.stage("trace"):
+		for pid, kind, path, ok in tracer.records([exe_path]+exe_args):
+			instrument.count("trace.%s" % kind)
+			if kind == "exec":
+				config_add(exec_paths,path)
 			else:
-				#Treat result at an integer
-				try:
-					if "0x" == result[:2]:
-						result = int(result.split(" ")[0],16)
-					else:
-						result = int(result.split(" ")[0])
-				except ValueError:
-					#Can not determine result
-					continue
-			
-			#Identify the syscall and arguments
-			call = call.strip()
-			s_idx = call.find("(")
-			if s_idx < 0:
-				#No syscall on line
-				continue
-			sysfunc = call[:s_idx]
-			sysargs = []
-			esc = []
-			arg = []
-			for i in range(s_idx+1,len(call)):
-				if not len(esc):
-					if "<unfinished" == call[i:i+11]:
-						#This is a HACK to get around unfinished syscalls 
-						#for which we really don't care about the result
-						if len(arg):
-							sysargs.append("".join(arg))
-							arg = []
-						break
-					elif call[i] == ")":
-						#End of syscall
-						if len(arg):
-							sysargs.append("".join(arg))
-							arg = []
-						break
-					elif call[i] == ",":
-						#End of argument
-						sysargs.append("".join(arg))
-						arg = []
-						continue
-				
-				#Handled layers of escaped arguments
-				if len(esc) and call[i] == esc[-1]:
-					esc = esc[:-1]
-				elif call[i] == "[":
-					esc.append("]")
-				elif call[i] == "(":
-					esc.append(")")
-				elif call[i] == "\"":
-					esc.append("\"")
-				elif call[i] == "\'":
-					esc.append("\'")
-					
-				arg.append(call[i])
-			
-			if sysfunc == "access":
-				try:
-					data_path = dequote(sysargs[0])
-				except ValueError:
-					continue
-				config_add(data_paths,data_path)
-			
-			if sysfunc == "open" or sysfunc == "openat":
-				if len(sysargs) == 3:
-					data_path = sysargs[1]
-				else:
-					data_path = sysargs[0]
-				try:
-					data_path = dequote(data_path)
-				except ValueError:
-					continue
-				config_add(data_paths,data_path)
+				config_add(data_paths,path)
 
-			if sysfunc == "execve":
-				try:
-					exec_path = dequote(sysargs[0])
-				except ValueError:
-					continue
-				config_add(exec_paths,exec_path)
-				
 	print("Harvester writing configuration files...")
-	write_config(config_dir)
+	with instrument.stage("write_config"):
+		write_config(config_dir)
+	if profile_path:
+		instrument.write_profile(profile_path,"harvester_config")
 	
 	print("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
 	print("!!                                   !!")
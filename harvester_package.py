@@ -24,12 +24,31 @@
 ##
 import sys
 import os
-import subprocess
+import archive
+import delta
+import pack_image
+import instrument
 
 def usage(cmd):
 	print("Usage:")
-	print("%s [-h] [-v] root_dir output_tarball" % cmd)
+	print("%s [-h] [-v] [-r] [-z gzip|xz|zstd] [-j jobs] [-delta old] [-M manifest] [-pack]" % cmd)
+	print("     [-profile profile_file] root_dir output_tarball")
 	print("")
+	print("  -z : Compression of the tarball (default gzip).  zstd falls back")
+	print("       to gzip if this Python can not write it.")
+	print("  -j : Compress on up to jobs cores (default all of them)")
+	print("  -r : Reproducible tarball.  Timestamps (SOURCE_DATE_EPOCH or 0),")
+	print("       owners and permissions are normalized, and an existing")
+	print("       output_tarball with the same contents is left untouched.")
+	print("  -delta : Only pack what changed since old, a previous root_dir or")
+	print("           a manifest written by -M.  The tarball is applied with")
+	print("           the .harvest_delta/apply.py it contains.")
+	print("  -M : Write the manifest of root_dir to manifest, for a later -delta")
+	print("  -pack : Write a pack image instead of a tarball.  It is a shell")
+	print("          script that runs a program of the package, extracting")
+	print("          only the files that program needs (once) into a cache.")
+	print("  -profile : Write stage timings and counters to profile_file (a")
+	print("        Chrome trace)")
 	sys.exit(1)
 
 def main(argv):
@@ -44,23 +63,121 @@ def main(argv):
 		verbose = True
 		del argv[idx]
 
-	if len(argv) < 2:
+	try:
+		idx = argv.index("-r")
+	except:
+		deterministic = False
+	else:
+		deterministic = True
+		del argv[idx]
+
+	try:
+		idx = argv.index("-z")
+	except:
+		method = "gzip"
+	else:
+		if len(argv) < idx+2 or argv[idx+1] not in archive.COMPRESSORS:
+			usage(argv[0])
+		else:
+			method = argv[idx+1]
+			del argv[idx]
+			del argv[idx]
+
+	try:
+		idx = argv.index("-j")
+	except:
+		jobs = None
+	else:
+		if len(argv) < idx+2 or not argv[idx+1].isdigit() or int(argv[idx+1]) < 1:
+			usage(argv[0])
+		else:
+			jobs = int(argv[idx+1])
+			del argv[idx]
+			del argv[idx]
+
+	try:
+		idx = argv.index("-pack")
+	except:
+		pack = False
+	else:
+		pack = True
+		del argv[idx]
+
+	try:
+		idx = argv.index("-delta")
+	except:
+		old_path = None
+	else:
+		if len(argv) < idx+2:
+			usage(argv[0])
+		else:
+			old_path = os.path.abspath(argv[idx+1])
+			del argv[idx]
+			del argv[idx]
+
+	try:
+		idx = argv.index("-M")
+	except:
+		manifest_path = None
+	else:
+		if len(argv) < idx+2:
+			usage(argv[0])
+		else:
+			manifest_path = os.path.abspath(argv[idx+1])
+			del argv[idx]
+			del argv[idx]
+
+	try:
+		idx = argv.index("-profile")
+	except:
+		profile_path = None
+	else:
+		if len(argv) < idx+2:
+			usage(argv[0])
+		else:
+			profile_path = argv[idx+1]
+			instrument.enable()
+			del argv[idx]
+			del argv[idx]
+
+	if len(argv) < 3 or (pack and old_path):
 		usage(argv[0])
 	
 	root_dir = os.path.abspath(argv[1])
 	dst_tgz_path = os.path.abspath(argv[2])
-	
-	if verbose:
-		args = "-czvf"
+
+	manifest = None
+	if old_path or manifest_path:
+		with instrument.stage("scan",root=root_dir):
+			manifest = delta.scan_root(root_dir,jobs)
+	if manifest_path:
+		delta.write_manifest(manifest_path,manifest)
+
+	if old_path:
+		#Create delta tarball
+		if not os.path.exists(old_path):
+			print("ERROR: %s does not exist" % old_path)
+			sys.exit(1)
+		with instrument.stage("delta"):
+			stats = delta.write_delta(dst_tgz_path,root_dir,delta.read_manifest(old_path),manifest,
+			                          method=method,workers=jobs,verbose=verbose,deterministic=deterministic)
+		print("Delta: %d added, %d changed, %d patched, %d deleted, %d unchanged" %
+			(stats["added"],stats["changed"],stats["patched"],stats["deleted"],stats["unchanged"]))
+	elif pack:
+		#Create pack image
+		with instrument.stage("pack"):
+			count = pack_image.write_pack(dst_tgz_path,root_dir,method=method,workers=jobs,verbose=verbose)
+		print("Packed %d files: %s" % (count,dst_tgz_path))
 	else:
-		args = "-czf"
-	
-	#Create tarball
-	wd = os.getcwd()
-	os.chdir(root_dir)
-	files = [x for x in os.listdir(".") if x not in [".",".."]]
-	subprocess.call(["tar",args,dst_tgz_path]+files)
-	os.chdir(wd)
+		#Create tarball
+		with instrument.stage("archive"):
+			written = archive.write_archive(dst_tgz_path,root_dir,method=method,workers=jobs,
+			                                verbose=verbose,deterministic=deterministic)
+		if not written:
+			print("Unchanged: %s" % dst_tgz_path)
+
+	if profile_path:
+		instrument.write_profile(profile_path,"harvester_package")
 
 if __name__ == "__main__":
 	main(sys.argv)
@@ -25,15 +25,24 @@
 import sys
 import os
 import shutil
-import create_package
+import elf_reader
+import dep_cache
+import path_trie
+import tree_walk
+import instrument
 
-exec_paths   = {}
-data_paths   = {}
-ignore_paths = {}
+exec_paths   = path_trie.PathTrie()
+data_paths   = path_trie.PathTrie()
+ignore_paths = path_trie.PathTrie()
 
 def usage(cmd):
 	print("Usage:")
-	print("%s [-h] [-c config_dir] src_dir [src_dir ...]" % cmd)
+	print("%s [-h] [-c config_dir] [-cache cache_file] [-j jobs]" % cmd)
+	print("     [-profile profile_file] src_dir [src_dir ...]")
+	print("")
+	print("  -j : Scan up to jobs directories at once")
+	print("  -profile : Write stage timings and counters to profile_file (a")
+	print("       Chrome trace)")
 	sys.exit(1)
 
 def read_config(config_dir):
@@ -55,7 +64,7 @@ def read_config(config_dir):
 			line = line.strip()
 			if not len(line) or line[0] == "#":
 				continue
-			config_dict[line] = None
+			config_dict.add(line)
 		fp.close()
 
 def write_config(config_dir):
@@ -64,7 +73,7 @@ def write_config(config_dir):
 	for path, config_dict in [["HARVEST_EXEC",exec_paths],
 														["HARVEST_DATA",data_paths]]:
 		print("  %s: %d total files" % (path,len(config_dict)))
-		files = [x for x in config_dict.keys()]
+		files = [x for x in config_dict]
 		files.sort()
 		fp = open(os.path.join(config_dir,path),"w")
 		for f in files:
@@ -74,31 +83,41 @@ def write_config(config_dir):
 def config_add(config_dict, path):
 	global ignore_paths
 	apath = os.path.abspath(path)
-	if apath in config_dict:
-		#Specific path is already configured
+	if config_dict.covers(apath) != None:
+		#Already configured, by itself or its entire directory tree
+		return
+	if ignore_paths.covers(apath) != None:
+		#Configured to ignore this entire directory tree
 		return
-	
-	parts = apath.split("/")[1:]
-	for i in range(len(parts)):
-		test_path = "/".join(parts)
-		if test_path in ignore_paths:
-			#Configured to ignore this entire directory tree
-			return
-		elif test_path in config_dict:
-			#Already configured to include this entire directory tree 
-			return
 	
 	#No reason found to not include this file
-	config_dict[apath] = None
-
-def isELF(path):
-	f = open(path,"rb")
-	hdr = f.read(4).encode()
-	f.close()
-	if hdr == "\x7fELF":
-		return True
-	else:
-		return False
+	config_dict.add(apath)
+
+#Kinds of files that are packaged as executables
+EXEC_KINDS = {"exec","pie","static"}
+
+def classify(path):
+	#Called by the tree walker for every regular file
+	result = elf_reader.classify(path)
+	if result == None:
+		return None
+	return result["kind"]
+
+def script_interpreter(path):
+	#The program that runs a script, looking through "/usr/bin/env prog"
+	result = elf_reader.classify(path)
+	interp = result["interp"]
+	if interp and os.path.basename(interp) == "env" and result["interp_arg"]:
+		for arg in result["interp_arg"].split():
+			if arg[0] != "-" and "=" not in arg:
+				return shutil.which(arg)
+		return None
+	return interp
+
+def prune(path):
+	#Ignored trees are not walked at all
+	global ignore_paths
+	return path in ignore_paths
 
 def main(argv):
 	global exec_paths
@@ -108,18 +127,18 @@ def main(argv):
 		usage(argv[0])
 
 	try:
-		idx = sys.argv.index("-c")
+		idx = argv.index("-c")
 	except:
 		config_dir = "."
 	else:
-		if len(sys.argv) < idx+2:
-			usage()
+		if len(argv) < idx+2:
+			usage(argv[0])
 		else:
-			config_dir = sys.argv[idx+1]
+			config_dir = argv[idx+1]
 			if not os.path.isdir(config_dir):
-				usage()
-			del sys.argv[idx]
-			del sys.argv[idx]
+				usage(argv[0])
+			del argv[idx]
+			del argv[idx]
 
 	try:
 		idx = argv.index("-qt")
@@ -133,32 +152,73 @@ def main(argv):
 			del argv[idx]
 			del argv[idx]
 
+	try:
+		idx = argv.index("-cache")
+	except:
+		pass
+	else:
+		if len(argv) < idx+2:
+			usage(argv[0])
+		else:
+			elf_reader.persistent_cache = dep_cache.open_cache(argv[idx+1])
+			del argv[idx]
+			del argv[idx]
+
+	try:
+		idx = argv.index("-j")
+	except:
+		jobs = None
+	else:
+		if len(argv) < idx+2 or not argv[idx+1].isdigit() or int(argv[idx+1]) < 1:
+			usage(argv[0])
+		else:
+			jobs = int(argv[idx+1])
+			del argv[idx]
+			del argv[idx]
+
+	try:
+		idx = argv.index("-profile")
+	except:
+		profile_path = None
+	else:
+		if len(argv) < idx+2:
+			usage(argv[0])
+		else:
+			profile_path = argv[idx+1]
+			instrument.enable()
+			del argv[idx]
+			del argv[idx]
+
 	if len(argv) < 2:
 		usage(argv[0])
 
-	src_dirs = sys.argv[1:]
+	src_dirs = argv[1:]
 
 	#Read in the existing configuration
-	read_config(config_dir)
+	with instrument.stage("read_config"):
+		read_config(config_dir)
 
 	for src_dir in src_dirs:
-		for root,dirs,files in os.walk(src_dir):
-			for d in dirs:
-				absfile = os.path.abspath(os.path.join(root,d))
+		if ignore_paths.covers(os.path.abspath(src_dir)) != None:
+			continue
+		with instrument.stage("walk",src_dir=src_dir):
+			for absfile, kind in tree_walk.walk(src_dir,classify,prune,jobs):
+				if kind in EXEC_KINDS:
+					config_add(exec_paths,absfile)
+					continue
 				config_add(data_paths,absfile)
-			for f in files:
-				absfile = os.path.abspath(os.path.join(root,f))
-				if os.path.islink(abspath):
-					config_add(data_paths,absfile)
-				else:
-					try:
-						if isELF(absfile):
-							config_add(exec_paths,absfile)
-						else:
-							config_add(data_paths,absfile)
-					except IOError:
-						continue
-	write_config(config_dir)
+				if kind == "script" and os.access(absfile,os.X_OK):
+					#Scripts are data, but whatever runs them is needed too
+					interp = script_interpreter(absfile)
+					if interp and os.path.isfile(interp):
+						config_add(exec_paths,interp)
+	with instrument.stage("write_config"):
+		write_config(config_dir)
+
+	if elf_reader.persistent_cache:
+		elf_reader.persistent_cache.close()
+	if profile_path:
+		instrument.write_profile(profile_path,"harvester_stripmine")
 
 if __name__ == "__main__":
 	main(sys.argv)
@@ -0,0 +1,155 @@
+## Copyright (c) 2022 Daniel Tabor
+##
+## Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions
+## are met:
+## 1. Redistributions of source code must retain the above copyright
+##    notice, this list of conditions and the following disclaimer.
+## 2. Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##
+## THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS "AS IS" AND
+## ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+## IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+## ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+## FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+## DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+## OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+## HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+## LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+## OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+## SUCH DAMAGE.
+##
+import contextlib
+import threading
+import json
+import time
+import os
+
+#Timings of stages and counts of what was done, written as a Chrome trace
+#(chrome://tracing, Perfetto) by the -profile option of the tools.  Until
+#enable() is called, stage() and count() do nothing.
+enabled = False
+
+#Complete ("X") trace events of the stages that have finished
+events = []
+
+#Counter name -> total
+counters = {}
+
+lock = threading.Lock()
+
+#Shared by the stages that are not timed
+NULL_STAGE = contextlib.nullcontext()
+
+def enable():
+	global enabled
+	enabled = True
+
+def now_us():
+	#The monotonic clock is the same for every process, so the events
+	#of worker processes line up with those of the tool
+	return time.monotonic_ns()//1000
+
+class Stage:
+	def __init__(self, name, args):
+		self.name = name
+		self.args = args
+
+	def __enter__(self):
+		self.start = now_us()
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		event = {
+			"name": self.name,
+			"cat":  "stage",
+			"ph":   "X",
+			"ts":   self.start,
+			"dur":  now_us()-self.start,
+			"pid":  os.getpid(),
+			"tid":  threading.get_native_id(),
+		}
+		if self.args:
+			event["args"] = self.args
+		with lock:
+			events.append(event)
+		return False
+
+def stage(name, **args):
+	#Time a stage: "with instrument.stage(name):"
+	if not enabled:
+		return NULL_STAGE
+	return Stage(name,args)
+
+def count(name, n=1):
+	if not enabled:
+		return
+	with lock:
+		counters[name] = counters.get(name,0)+n
+
+def take():
+	#Remove and return what has been recorded, so that a worker process
+	#can hand it to the tool with its results
+	global events
+	global counters
+	with lock:
+		profile = {"events":events, "counters":counters}
+		events = []
+		counters = {}
+	return profile
+
+def merge(profile):
+	#Add what a worker process recorded (see take)
+	if profile == None:
+		return
+	with lock:
+		events.extend(profile["events"])
+		for name, n in profile["counters"].items():
+			counters[name] = counters.get(name,0)+n
+
+def forked():
+	#The lock may have been held by another thread at the fork
+	global lock
+	lock = threading.Lock()
+
+os.register_at_fork(after_in_child=forked)
+
+def summary():
+	#Number of times each stage ran and its total time in ms
+	stages = {}
+	with lock:
+		for event in events:
+			total = stages.setdefault(event["name"],{"count":0,"total_ms":0.0})
+			total["count"] += 1
+			total["total_ms"] += event["dur"]/1000.0
+	return stages
+
+def write_profile(path, tool):
+	#Write everything recorded as a Chrome trace.  The counters are also
+	#a single counter ("C") event at the end, and with the per-stage
+	#totals under "otherData" for scripts.
+	end = now_us()
+	with lock:
+		trace = sorted(events,key=lambda x: x["ts"])
+		totals = dict(counters)
+	pids = sorted(set(x["pid"] for x in trace) | {os.getpid()})
+	meta = []
+	for pid in pids:
+		name = tool if pid == os.getpid() else "%s worker" % tool
+		meta.append({"name":"process_name", "ph":"M", "pid":pid, "tid":0, "args":{"name":name}})
+	if len(totals):
+		trace.append({"name":"counters", "ph":"C", "ts":end, "pid":os.getpid(), "tid":0, "args":totals})
+	fp = open(path,"w")
+	json.dump({
+		"traceEvents":     meta+trace,
+		"displayTimeUnit": "ms",
+		"otherData": {
+			"tool":     tool,
+			"counters": totals,
+			"stages":   summary(),
+		},
+	},fp,indent=1,sort_keys=True)
+	fp.write("\n")
+	fp.close()
@@ -0,0 +1,447 @@
+## Copyright (c) 2022 Daniel Tabor
+##
+## Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions
+## are met:
+## 1. Redistributions of source code must retain the above copyright
+##    notice, this list of conditions and the following disclaimer.
+## 2. Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##
+## THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS "AS IS" AND
+## ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+## IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+## ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+## FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+## DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+## OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+## HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+## LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+## OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+## SUCH DAMAGE.
+##
+import subprocess
+import threading
+import tempfile
+import hashlib
+import os
+import tracers
+
+#Launchers start a packaged executable with the bundled loader:
+#  bash : a bash script (the original launcher)
+#  sh   : a POSIX sh script that finds its directory without running
+#         dirname and replaces itself with the loader
+#  stub : a small static C program (STUB_SOURCE) that finds its directory
+#         through /proc/self/exe, sets the variables and execs the loader,
+#         so no shell is started at all
+#
+#A launcher is described by a dict:
+#  env      : [name, path, append] for each variable to set.  With append
+#             the path is put in front of the current value.
+#  args     : the loader and the executable
+#  relative : paths are relative to the launcher's directory, rather
+#             than absolute
+LAUNCHERS = ["bash","sh","stub"]
+
+#The stub has CONFIG_SIZE bytes of configuration, which start as
+#TEMPLATE_MARK in the compiled stub and are replaced by CONFIG_HEADER and
+#the records of each launcher (see STUB_SOURCE)
+CONFIG_SIZE = 4096
+TEMPLATE_MARK = b"@HARVEST_LAUNCHER@"
+CONFIG_HEADER = b"HARVEST_LAUNCHER\0"
+
+#Largest file read_stub looks at: a stub linked statically with libc
+#(see STUB_FLAGS) is under this, other stubs are far smaller
+STUB_MAX = 1<<20
+
+STUB_SOURCE = r"""
+/* Built with HARVEST_NOLIBC where this architecture's system calls are
+ * known, so that the static stub is a few KB rather than a copy of libc
+ * per launcher.  Otherwise the same few calls come from libc. */
+#define CONFIG_SIZE 4096
+#define HEADER_SIZE 17
+#define MAX_ARGS    8
+#define PATH_SIZE   4096
+#define POOL_SIZE   (1 << 21)
+
+#ifdef HARVEST_NOLIBC
+
+#if defined(__x86_64__)
+#define SYS_write      1
+#define SYS_execve     59
+#define SYS_exit       60
+#define SYS_readlinkat 267
+static long syscall4(long n, long a, long b, long c, long d)
+{
+	long ret;
+	register long r10 __asm__("r10") = d;
+	__asm__ volatile ("syscall" : "=a"(ret) : "a"(n), "D"(a), "S"(b), "d"(c), "r"(r10)
+	                  : "rcx", "r11", "memory");
+	return ret;
+}
+__asm__(".text\n.global _start\n_start:\n"
+        "\txor %rbp, %rbp\n\tmov %rsp, %rdi\n\tand $-16, %rsp\n\tcall start\n\thlt\n");
+#elif defined(__aarch64__)
+#define SYS_write      64
+#define SYS_execve     221
+#define SYS_exit       93
+#define SYS_readlinkat 78
+static long syscall4(long n, long a, long b, long c, long d)
+{
+	register long x8 __asm__("x8") = n;
+	register long x0 __asm__("x0") = a;
+	register long x1 __asm__("x1") = b;
+	register long x2 __asm__("x2") = c;
+	register long x3 __asm__("x3") = d;
+	__asm__ volatile ("svc 0" : "+r"(x0) : "r"(x8), "r"(x1), "r"(x2), "r"(x3) : "memory");
+	return x0;
+}
+__asm__(".text\n.global _start\n_start:\n\tmov x0, sp\n\tbl start\n");
+#else
+#error "no system calls for this architecture"
+#endif
+
+#define AT_FDCWD -100
+
+static long sys_write(int fd, const char *s, unsigned long n)
+{
+	return syscall4(SYS_write, fd, (long)s, (long)n, 0);
+}
+
+static long sys_readlink(const char *path, char *buf, unsigned long n)
+{
+	return syscall4(SYS_readlinkat, AT_FDCWD, (long)path, (long)buf, (long)n);
+}
+
+static long sys_execve(const char *path, char **argv, char **envp)
+{
+	return syscall4(SYS_execve, (long)path, (long)argv, (long)envp, 0);
+}
+
+static void __attribute__((noreturn)) sys_exit(int code)
+{
+	for (;;)
+		syscall4(SYS_exit, code, 0, 0, 0);
+}
+
+/* The compiler may call these for loops that copy or clear memory */
+void *memcpy(void *dst, const void *src, unsigned long n)
+{
+	volatile char *d = dst;
+	const char *s = src;
+	while (n--)
+		*d++ = *s++;
+	return dst;
+}
+
+void *memset(void *dst, int c, unsigned long n)
+{
+	volatile char *d = dst;
+	while (n--)
+		*d++ = (char)c;
+	return dst;
+}
+
+static int launch(int argc, char **argv, char **envp);
+
+void __attribute__((noreturn)) start(long *sp)
+{
+	int argc = (int)sp[0];
+	char **argv = (char **)(sp + 1);
+	sys_exit(launch(argc, argv, argv + argc + 1));
+}
+
+#else
+
+#include <stdlib.h>
+#include <unistd.h>
+
+static long sys_write(int fd, const char *s, unsigned long n)
+{
+	return write(fd, s, n);
+}
+
+static long sys_readlink(const char *path, char *buf, unsigned long n)
+{
+	return readlink(path, buf, n);
+}
+
+static long sys_execve(const char *path, char **argv, char **envp)
+{
+	return execve(path, argv, envp);
+}
+
+static void sys_exit(int code)
+{
+	_exit(code);
+}
+
+static int launch(int argc, char **argv, char **envp);
+
+int main(int argc, char **argv, char **envp)
+{
+	return launch(argc, argv, envp);
+}
+
+#endif
+
+/* Filled in for each launcher: after the header, records ending with an
+ * empty one.
+ *   =NAME=path  set NAME to path
+ *   +NAME=path  put path in front of the current value of NAME
+ *   xpath       an argument (the loader, then the executable)
+ * Relative paths are relative to the directory of this program. */
+char harvest_config[CONFIG_SIZE] = "@HARVEST_LAUNCHER@";
+
+static char dir[PATH_SIZE];
+
+/* Everything built is taken from here, and never freed */
+static char pool[POOL_SIZE];
+static unsigned long used;
+
+static unsigned long slen(const char *s)
+{
+	unsigned long n = 0;
+	while (s[n])
+		n++;
+	return n;
+}
+
+static void fail(const char *a, const char *b)
+{
+	sys_write(2, a, slen(a));
+	sys_write(2, b, slen(b));
+	sys_write(2, "\n", 1);
+	sys_exit(127);
+}
+
+static void *alloc(unsigned long n)
+{
+	void *p;
+	n = (n + 7) & ~7UL;
+	if (n > POOL_SIZE - used)
+		fail("harvest launcher: ", "out of memory");
+	p = pool + used;
+	used += n;
+	return p;
+}
+
+static char *join(const char *a, const char *sep, const char *b)
+{
+	unsigned long la = slen(a), ls = slen(sep), lb = slen(b), i;
+	char *s = alloc(la + ls + lb + 1);
+	for (i = 0; i < la; i++)
+		s[i] = a[i];
+	for (i = 0; i < ls; i++)
+		s[la + i] = sep[i];
+	for (i = 0; i <= lb; i++)
+		s[la + ls + i] = b[i];
+	return s;
+}
+
+static char *resolve(char *path)
+{
+	return path[0] == '/' ? path : join(dir, "/", path);
+}
+
+static int launch(int argc, char **argv, char **envp)
+{
+	char **args, **env;
+	char *p, *next, *name, *value, *old;
+	unsigned long k;
+	int nargs = 0, nenv = 0, i;
+	long n;
+
+	n = sys_readlink("/proc/self/exe", dir, sizeof(dir) - 1);
+	if (n <= 0)
+		fail("/proc/self/exe", ": unable to read the link");
+	dir[n] = 0;
+	while (n > 0 && dir[n] != '/')
+		n--;
+	dir[n] = 0;
+
+	/* A copy of the environment, with room for every record */
+	while (envp[nenv])
+		nenv++;
+	env = alloc((nenv + CONFIG_SIZE / 2 + 1) * sizeof(char *));
+	for (i = 0; i <= nenv; i++)
+		env[i] = envp[i];
+	args = alloc((MAX_ARGS + argc + 1) * sizeof(char *));
+
+	for (p = harvest_config + HEADER_SIZE; *p; p = next) {
+		next = p + slen(p) + 1;
+		if (*p == 'x') {
+			if (nargs < MAX_ARGS)
+				args[nargs++] = resolve(p + 1);
+			continue;
+		}
+		name = p + 1;
+		for (k = 0; name[k] && name[k] != '='; k++)
+			;
+		if (!name[k])
+			continue;
+		value = resolve(name + k + 1);
+		for (i = 0; env[i]; i++) {
+			unsigned long j;
+			for (j = 0; j < k && env[i][j] == name[j]; j++)
+				;
+			if (j == k && env[i][k] == '=')
+				break;
+		}
+		old = env[i] ? env[i] + k + 1 : 0;
+		if (*p == '+' && old && *old)
+			value = join(value, ":", old);
+		name[k] = 0;
+		env[i] = join(name, "=", value);
+		name[k] = '=';
+		if (i == nenv)
+			env[++nenv] = 0;
+	}
+	if (nargs == 0)
+		fail(argv[0], ": not a configured launcher");
+	for (i = 1; i < argc; i++)
+		args[nargs++] = argv[i];
+	args[nargs] = 0;
+
+	sys_execve(args[0], args, env);
+	fail(args[0], ": unable to execute");
+	return 127;
+}
+"""
+
+#How the stub is compiled, in order of preference: without libc, then
+#statically linked with it
+STUB_FLAGS = [
+	["-Os","-static","-s","-nostdlib","-ffreestanding","-fno-stack-protector",
+	 "-fno-asynchronous-unwind-tables","-fno-pie","-no-pie","-DHARVEST_NOLIBC"],
+	["-Os","-static","-s"],
+]
+
+#Compiled stub path for each compiler
+stubs = {}
+stub_lock = threading.Lock()
+
+def script(kind, spec):
+	#The text of a bash or sh launcher
+	if kind == "bash":
+		prefix = "$DIR/" if spec["relative"] else ""
+		text = "#!/bin/bash\n"
+		if spec["relative"]:
+			text += "DIR=$(dirname $0)\n"
+		for name, path, append in spec["env"]:
+			text += "export %s=%s%s%s\n" % (name,prefix,path,":$%s" % name if append else "")
+		text += "%s $@\n" % " ".join(prefix+x for x in spec["args"])
+		return text
+	prefix = "$DIR/" if spec["relative"] else ""
+	text = "#!/bin/sh\n"
+	if spec["relative"]:
+		text += 'case "$0" in */*) DIR="${0%/*}";; *) DIR=.;; esac\n'
+	for name, path, append in spec["env"]:
+		if append:
+			text += 'export %s="%s%s${%s:+:$%s}"\n' % (name,prefix,path,name,name)
+		else:
+			text += 'export %s="%s%s"\n' % (name,prefix,path)
+	text += "exec %s \"$@\"\n" % " ".join('"%s%s"' % (prefix,x) for x in spec["args"])
+	return text
+
+def stub_config(spec):
+	config = CONFIG_HEADER
+	for name, path, append in spec["env"]:
+		config += ("%s%s=%s\0" % ("+" if append else "=",name,path)).encode()
+	for arg in spec["args"]:
+		config += ("x%s\0" % arg).encode()
+	config += b"\0"
+	if len(config) > CONFIG_SIZE:
+		raise ValueError("launcher configuration is over %d bytes" % CONFIG_SIZE)
+	return config.ljust(CONFIG_SIZE,b"\0")
+
+def build_stub(cc="cc", build_dir=None):
+	#Compile the stub, once per version of its source.  It is linked
+	#statically, without libc where the system calls of the architecture
+	#are known, so it runs whatever the libc of the target.
+	with stub_lock:
+		if cc in stubs:
+			return stubs[cc]
+		build_dir = tracers.private_dir(build_dir)
+		key = hashlib.sha1(STUB_SOURCE.encode()).hexdigest()[:16]
+		stub_path = os.path.join(build_dir,"harvest_launcher-%s" % key)
+		if not os.path.exists(stub_path):
+			fd, src_path = tempfile.mkstemp(suffix=".c",dir=build_dir)
+			tmp_path = src_path[:-2]
+			try:
+				os.write(fd,STUB_SOURCE.encode())
+				os.close(fd)
+				for flags in STUB_FLAGS:
+					try:
+						subprocess.check_call([cc]+flags+["-o",tmp_path,src_path],
+						                      stderr=subprocess.DEVNULL)
+					except subprocess.CalledProcessError:
+						continue
+					break
+				else:
+					print("WARNING: %s can not link statically, the launcher stub needs the libc of the target" % cc)
+					subprocess.check_call([cc,"-Os","-s","-o",tmp_path,src_path])
+				os.replace(tmp_path,stub_path)
+			finally:
+				os.unlink(src_path)
+				if os.path.exists(tmp_path):
+					os.unlink(tmp_path)
+		f = open(stub_path,"rb")
+		image = f.read()
+		f.close()
+		if image.count(TEMPLATE_MARK) != 1:
+			raise ValueError("%s has no launcher configuration" % stub_path)
+		stubs[cc] = image
+		return image
+
+def write_launcher(dst_path, kind, spec, cc="cc"):
+	if kind == "stub":
+		image = build_stub(cc)
+		offset = image.index(TEMPLATE_MARK)
+		data = image[:offset]+stub_config(spec)+image[offset+CONFIG_SIZE:]
+		#Replace rather than rewrite, the old launcher may be running
+		tmp_path = dst_path+".tmp"
+		f = open(tmp_path,"wb")
+		f.write(data)
+		f.close()
+		os.chmod(tmp_path,0o777)
+		os.replace(tmp_path,dst_path)
+		return
+	if os.path.islink(dst_path):
+		#Never write through a link to the executable (see
+		#create_package.Packager.write_launcher)
+		os.unlink(dst_path)
+	f = open(dst_path,"w")
+	f.write(script(kind,spec))
+	f.close()
+	os.chmod(dst_path,0o777)
+
+def read_stub(path):
+	#The description of the stub launcher at path, or None if it is not one
+	try:
+		f = open(path,"rb")
+	except IOError:
+		return None
+	data = f.read(STUB_MAX+1)
+	f.close()
+	if len(data) > STUB_MAX:
+		return None
+	offset = data.find(CONFIG_HEADER)
+	if offset < 0:
+		return None
+	spec = {"env":[], "args":[], "relative":True}
+	records = data[offset+len(CONFIG_HEADER):offset+CONFIG_SIZE].split(b"\0")
+	for record in records:
+		record = record.decode(errors="surrogateescape")
+		if not len(record):
+			break
+		if record[0] == "x":
+			spec["args"].append(record[1:])
+		else:
+			name, path = record[1:].split("=",1)
+			spec["env"].append([name,path,record[0] == "+"])
+	if not len(spec["args"]):
+		return None
+	spec["relative"] = spec["args"][0][:1] != "/"
+	return spec
@@ -0,0 +1,108 @@
+## Copyright (c) 2022 Daniel Tabor
+##
+## Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions
+## are met:
+## 1. Redistributions of source code must retain the above copyright
+##    notice, this list of conditions and the following disclaimer.
+## 2. Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##
+## THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS "AS IS" AND
+## ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+## IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+## ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+## FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+## DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+## OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+## HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+## LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+## OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+## SUCH DAMAGE.
+##
+import threading
+import hashlib
+import errno
+import os
+import copy_engine
+
+HASH_BLOCK = 1<<20
+
+class LibStore:
+	#Content addressed store of files.  Each distinct file is stored once
+	#as store_dir/xx/<sha256>, and packages hardlink to the stored copy
+	#(or symlink to it when a hardlink is not possible).
+	def __init__(self, store_dir, cache=None):
+		self.store_dir = os.path.abspath(store_dir)
+		self.cache = cache
+		self.lock = threading.Lock()
+		self.digests = {}
+		os.makedirs(self.store_dir,exist_ok=True)
+
+	def digest(self, path):
+		with self.lock:
+			if path in self.digests:
+				return self.digests[path]
+			if self.cache:
+				digest = self.cache.get_hash(path)
+				if digest != None:
+					self.digests[path] = digest
+					return digest
+		h = hashlib.sha256()
+		f = open(path,"rb")
+		while True:
+			data = f.read(HASH_BLOCK)
+			if not len(data):
+				break
+			h.update(data)
+		f.close()
+		digest = h.hexdigest()
+		with self.lock:
+			self.digests[path] = digest
+			if self.cache:
+				self.cache.put_hash(path,digest)
+		return digest
+
+	def add(self, src):
+		#Store src (if it is not already stored).  Returns the path of
+		#the stored file and the number of bytes copied into the store.
+		digest = self.digest(src)
+		store_path = os.path.join(self.store_dir,digest[:2],digest)
+		if os.path.exists(store_path):
+			return store_path, 0
+		os.makedirs(os.path.dirname(store_path),exist_ok=True)
+		tmp_path = "%s.%d.%d" % (store_path,os.getpid(),threading.get_ident())
+		size = copy_engine.copy_file(src,tmp_path)
+		try:
+			os.link(tmp_path,store_path)
+		except OSError as e:
+			#Another thread or process stored the same file first
+			if e.errno != errno.EEXIST:
+				os.unlink(tmp_path)
+				raise
+			size = 0
+		os.unlink(tmp_path)
+		return store_path, size
+
+	def relink(self, path):
+		#Store the new contents of path, a linked file that has been
+		#replaced by an edited copy, and link it to them.  The stored
+		#copy of its old contents is left alone.
+		with self.lock:
+			self.digests.pop(path,None)
+		return self.link(path,path)
+
+	def link(self, src, dst):
+		#Make dst refer to the stored copy of src.  Returns the number of
+		#bytes copied into the store.
+		store_path, size = self.add(src)
+		if os.path.lexists(dst):
+			os.unlink(dst)
+		try:
+			os.link(store_path,dst)
+		except OSError as e:
+			if e.errno not in [errno.EXDEV, errno.EPERM, errno.EMLINK]:
+				raise
+			os.symlink(os.path.relpath(store_path,os.path.dirname(os.path.abspath(dst))),dst)
+		return size
@@ -0,0 +1,352 @@
+## Copyright (c) 2022 Daniel Tabor
+##
+## Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions
+## are met:
+## 1. Redistributions of source code must retain the above copyright
+##    notice, this list of conditions and the following disclaimer.
+## 2. Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##
+## THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS "AS IS" AND
+## ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+## IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+## ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+## FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+## DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+## OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+## HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+## LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+## OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+## SUCH DAMAGE.
+##
+import struct
+import shutil
+import os
+import elf_reader
+
+SHT_DYNSYM = 11
+
+DT_HASH     = 4
+DT_SYMTAB   = 6
+DT_GNU_HASH = 0x6ffffef5
+
+SHN_UNDEF = 0
+
+STB_GLOBAL = 1
+STB_WEAK   = 2
+STB_GNU_UNIQUE = 10
+
+#Cache of (imports, exports) name lists, keyed by path
+symbol_cache = {}
+
+def read_layout(f):
+	#Read what is needed to find the dynamic section and symbols of an
+	#open ELF file.  Returns None if it is not a recognizable ELF file.
+	ident = f.read(16)
+	if len(ident) < 16 or ident[:4] != elf_reader.ELF_MAGIC:
+		return None
+	if ident[5] == elf_reader.ELFDATA2LSB:
+		endian = "<"
+	elif ident[5] == elf_reader.ELFDATA2MSB:
+		endian = ">"
+	else:
+		return None
+	if ident[4] == elf_reader.ELFCLASS64:
+		layout = {
+			"hdr":  endian+"HHIQQQIHHHHHH",
+			"phdr": endian+"IIQQQQQQ",
+			"shdr": endian+"IIQQQQIIQQ",
+			"dyn":  endian+"qQ",
+			"sym":  endian+"IBBHQQ",
+		}
+	elif ident[4] == elf_reader.ELFCLASS32:
+		layout = {
+			"hdr":  endian+"HHIIIIIHHHHHH",
+			"phdr": endian+"IIIIIIII",
+			"shdr": endian+"IIIIIIIIII",
+			"dyn":  endian+"iI",
+			"sym":  endian+"IIIBBH",
+		}
+	else:
+		return None
+	layout["class"] = ident[4]
+	layout["endian"] = endian
+	data = f.read(struct.calcsize(layout["hdr"]))
+	if len(data) < struct.calcsize(layout["hdr"]):
+		return None
+	e_type, e_machine, e_version, e_entry, e_phoff, e_shoff, e_flags, \
+		e_ehsize, e_phentsize, e_phnum, e_shentsize, e_shnum, e_shstrndx = \
+		struct.unpack(layout["hdr"],data)
+
+	phdrs = []
+	if e_phoff and e_phnum and e_phentsize >= struct.calcsize(layout["phdr"]):
+		f.seek(e_phoff)
+		data = f.read(e_phentsize*e_phnum)
+		for i in range(len(data)//e_phentsize):
+			fields = struct.unpack_from(layout["phdr"],data,i*e_phentsize)
+			if layout["class"] == elf_reader.ELFCLASS64:
+				p_type, p_flags, p_offset, p_vaddr, p_paddr, \
+					p_filesz, p_memsz, p_align = fields
+			else:
+				p_type, p_offset, p_vaddr, p_paddr, \
+					p_filesz, p_memsz, p_flags, p_align = fields
+			phdrs.append((p_type,p_flags,p_offset,p_vaddr,p_filesz,p_memsz))
+	layout["phdrs"] = phdrs
+
+	shdrs = []
+	if e_shoff and e_shnum and e_shentsize >= struct.calcsize(layout["shdr"]):
+		f.seek(e_shoff)
+		data = f.read(e_shentsize*e_shnum)
+		for i in range(len(data)//e_shentsize):
+			sh_name, sh_type, sh_flags, sh_addr, sh_offset, sh_size, \
+				sh_link, sh_info, sh_addralign, sh_entsize = \
+				struct.unpack_from(layout["shdr"],data,i*e_shentsize)
+			shdrs.append((sh_type,sh_offset,sh_size,sh_link,sh_entsize))
+	layout["shdrs"] = shdrs
+
+	#The dynamic section: its file offset, size and entries
+	layout["dynamic"] = None
+	for p_type, p_flags, p_offset, p_vaddr, p_filesz, p_memsz in phdrs:
+		if p_type == elf_reader.PT_DYNAMIC:
+			f.seek(p_offset)
+			data = f.read(p_filesz)
+			dyn_size = struct.calcsize(layout["dyn"])
+			entries = []
+			for i in range(len(data)//dyn_size):
+				d_tag, d_val = struct.unpack_from(layout["dyn"],data,i*dyn_size)
+				entries.append((d_tag,d_val))
+				if d_tag == elf_reader.DT_NULL:
+					break
+			layout["dynamic"] = (p_offset,len(data)//dyn_size,entries)
+			break
+	return layout
+
+def gnu_hash_count(f, layout, offset):
+	#The number of symbols covered by a DT_GNU_HASH table is one past the
+	#last symbol of its longest chain
+	e = layout["endian"]
+	f.seek(offset)
+	nbuckets, symoffset, bloom_size, bloom_shift = struct.unpack(e+"IIII",f.read(16))
+	if layout["class"] == elf_reader.ELFCLASS64:
+		f.seek(offset+16+8*bloom_size)
+	else:
+		f.seek(offset+16+4*bloom_size)
+	buckets = struct.unpack(e+"%dI" % nbuckets,f.read(4*nbuckets))
+	last = max(buckets) if nbuckets else 0
+	if last < symoffset:
+		return symoffset
+	chains = f.tell()
+	while True:
+		f.seek(chains+4*(last-symoffset))
+		data = f.read(4)
+		if len(data) < 4 or struct.unpack(e+"I",data)[0] & 1:
+			return last+1
+		last += 1
+
+def dynamic_symbols(f, layout):
+	#Returns (symtab offset, count, strtab bytes) of the dynamic symbol
+	#table, from the section headers if there are any, otherwise from
+	#the dynamic section and its hash table
+	shdrs = layout["shdrs"]
+	sym_size = struct.calcsize(layout["sym"])
+	for sh_type, sh_offset, sh_size, sh_link, sh_entsize in shdrs:
+		if sh_type == SHT_DYNSYM and sh_link < len(shdrs):
+			str_offset, str_size = shdrs[sh_link][1], shdrs[sh_link][2]
+			f.seek(str_offset)
+			return sh_offset, sh_size//sym_size, f.read(str_size)
+	if layout["dynamic"] == None:
+		return None
+	tags = dict(layout["dynamic"][2])
+	phdrs = layout["phdrs"]
+	if DT_SYMTAB not in tags or elf_reader.DT_STRTAB not in tags or elf_reader.DT_STRSZ not in tags:
+		return None
+	sym_offset = elf_reader.vaddr_to_offset(phdrs,tags[DT_SYMTAB])
+	str_offset = elf_reader.vaddr_to_offset(phdrs,tags[elf_reader.DT_STRTAB])
+	if sym_offset == None or str_offset == None:
+		return None
+	count = None
+	if DT_HASH in tags:
+		offset = elf_reader.vaddr_to_offset(phdrs,tags[DT_HASH])
+		if offset != None:
+			f.seek(offset)
+			count = struct.unpack(layout["endian"]+"II",f.read(8))[1]
+	elif DT_GNU_HASH in tags:
+		offset = elf_reader.vaddr_to_offset(phdrs,tags[DT_GNU_HASH])
+		if offset != None:
+			count = gnu_hash_count(f,layout,offset)
+	if count == None:
+		return None
+	f.seek(str_offset)
+	return sym_offset, count, f.read(tags[elf_reader.DT_STRSZ])
+
+def read_symbols(path):
+	#Returns the lists of symbol names an ELF file imports (undefined)
+	#and exports (defined, global or weak), or None if they can not be
+	#read
+	if path in symbol_cache:
+		return symbol_cache[path]
+	result = None
+	try:
+		f = open(path,"rb")
+	except IOError:
+		return None
+	try:
+		layout = read_layout(f)
+		table = None
+		if layout != None:
+			table = dynamic_symbols(f,layout)
+		if table != None:
+			sym_offset, count, strtab = table
+			sym_size = struct.calcsize(layout["sym"])
+			f.seek(sym_offset)
+			data = f.read(sym_size*count)
+			imports = []
+			exports = []
+			for i in range(1,len(data)//sym_size):
+				fields = struct.unpack_from(layout["sym"],data,i*sym_size)
+				if layout["class"] == elf_reader.ELFCLASS64:
+					st_name, st_info, st_other, st_shndx, st_value, st_size = fields
+				else:
+					st_name, st_value, st_size, st_info, st_other, st_shndx = fields
+				if st_info>>4 not in (STB_GLOBAL,STB_WEAK,STB_GNU_UNIQUE) or not st_name:
+					continue
+				name = elf_reader.read_cstr(strtab,st_name)
+				if st_shndx == SHN_UNDEF:
+					imports.append(name)
+				else:
+					exports.append(name)
+			result = (imports,exports)
+	except (struct.error, ValueError, OSError):
+		result = None
+	f.close()
+	symbol_cache[path] = result
+	return result
+
+class SymbolIndex:
+	#Symbol names are interned to small integers, so that every object's
+	#imports and exports are sets of integers that are cheap to store
+	#and intersect across thousands of libraries
+	def __init__(self):
+		self.ids = {}
+		self.objects = {}
+
+	def intern(self, names):
+		ids = self.ids
+		result = set()
+		for name in names:
+			i = ids.get(name)
+			if i == None:
+				i = ids[name] = len(ids)
+			result.add(i)
+		return result
+
+	def add(self, path):
+		#Returns False if the symbols of path could not be read
+		symbols = read_symbols(path)
+		if symbols == None:
+			return False
+		self.objects[path] = (self.intern(symbols[0]),self.intern(symbols[1]))
+		return True
+
+	def imports(self, path):
+		return self.objects[path][0]
+
+	def exports(self, path):
+		return self.objects[path][1]
+
+def find_unused(paths, keep=()):
+	#Find the libraries among paths that no other object in paths imports
+	#a symbol from, even though some object lists them in DT_NEEDED.
+	#Libraries only needed by unused ones are unused as well.  Libraries
+	#whose symbols can not be read, and those in keep, are always used.
+	#Returns a dict of unused library path -> paths of the objects that
+	#list it.
+	index = SymbolIndex()
+	by_name = {}
+	needed_by = {}
+	for path in paths:
+		index.add(path)
+		info = elf_reader.read_elf(path)
+		if info == None:
+			continue
+		by_name.setdefault(os.path.basename(path),path)
+		if info["soname"]:
+			by_name.setdefault(info["soname"],path)
+	for path in paths:
+		info = elf_reader.read_elf(path)
+		if info == None:
+			continue
+		for name in info["needed"]:
+			lib_path = by_name.get(name)
+			if lib_path != None and lib_path != path:
+				needed_by.setdefault(lib_path,[]).append(path)
+
+	unused = {}
+	while True:
+		#Every symbol imported by an object that is still used
+		imported = set()
+		for path in paths:
+			if path in unused:
+				continue
+			if path in index.objects:
+				imported |= index.imports(path)
+		found = False
+		for lib_path, users in needed_by.items():
+			if lib_path in unused or lib_path in keep or lib_path not in index.objects:
+				continue
+			if index.exports(lib_path).isdisjoint(imported):
+				unused[lib_path] = users
+				found = True
+		if not found:
+			break
+	return unused
+
+def remove_needed(path, names):
+	#Remove the DT_NEEDED entries for names from the ELF file at path.
+	#The later entries are moved up and the freed slots become DT_NULL.
+	#The file is rewritten as a new copy, so that anything hardlinked to
+	#it (such as a lib_store entry) is left alone.  Returns the number of
+	#entries removed.
+	f = open(path,"rb")
+	layout = read_layout(f)
+	if layout == None or layout["dynamic"] == None:
+		f.close()
+		return 0
+	dyn_offset, slots, entries = layout["dynamic"]
+	strtab = None
+	tags = dict(entries)
+	if elf_reader.DT_STRTAB in tags and elf_reader.DT_STRSZ in tags:
+		str_offset = elf_reader.vaddr_to_offset(layout["phdrs"],tags[elf_reader.DT_STRTAB])
+		if str_offset != None:
+			f.seek(str_offset)
+			strtab = f.read(tags[elf_reader.DT_STRSZ])
+	f.close()
+	if strtab == None:
+		return 0
+
+	kept = []
+	removed = 0
+	for d_tag, d_val in entries:
+		if d_tag == elf_reader.DT_NEEDED and elf_reader.read_cstr(strtab,d_val) in names:
+			removed += 1
+		elif d_tag != elf_reader.DT_NULL:
+			kept.append((d_tag,d_val))
+	if not removed:
+		return 0
+	data = b"".join(struct.pack(layout["dyn"],d_tag,d_val) for d_tag, d_val in kept)
+	data += struct.pack(layout["dyn"],elf_reader.DT_NULL,0)*(slots-len(kept))
+
+	tmp_path = path+".harvest_tmp"
+	shutil.copyfile(path,tmp_path)
+	shutil.copymode(path,tmp_path)
+	f = open(tmp_path,"r+b")
+	f.seek(dyn_offset)
+	f.write(data)
+	f.close()
+	os.replace(tmp_path,path)
+	#The cached information is no longer that of the file
+	elf_reader.forget(path)
+	symbol_cache.pop(path,None)
+	return removed
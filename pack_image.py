@@ -0,0 +1,436 @@
+## Copyright (c) 2022 Daniel Tabor
+##
+## Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions
+## are met:
+## 1. Redistributions of source code must retain the above copyright
+##    notice, this list of conditions and the following disclaimer.
+## 2. Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##
+## THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS "AS IS" AND
+## ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+## IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+## ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+## FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+## DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+## OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+## HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+## LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+## OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+## SUCH DAMAGE.
+##
+import concurrent.futures
+import collections
+import hashlib
+import re
+import os
+import archive
+import elf_reader
+import launcher
+
+#A pack image is a single file that runs the programs of a package without
+#extracting all of it.  It is laid out as:
+#  stub  : a /bin/sh script (STUB) that never reads past itself
+#  data  : every regular file, compressed on its own so that it can be
+#          extracted with tail, head and the decompressor alone
+#  index : one tab separated line per entry:
+#            f <n> <mode> <offset> <length> <path>
+#            d <n> <mode> - - <path>
+#            l <n> <mode> - - <path> <target>
+#          and one line per program (launcher script) with the numbers of
+#          the entries it needs:
+#            g <path> <n> <n> ...
+#
+#The stub extracts the entries of the program it is asked to run into a
+#cache directory (once per image) and runs it from there.
+
+#Commands the stub decompresses each method with
+DECOMPRESSORS = {
+	"gzip" : "gzip -dc",
+	"xz"   : "xz -dc",
+	"zstd" : "zstd -dc",
+}
+
+#Width of the numbers filled into the stub once the image is written
+FIELD_WIDTH = 16
+
+STUB = r'''#!/bin/sh
+# Harvested package image.  Run one of its programs with
+#   IMAGE [program] [args...]
+# or through a symlink to IMAGE named after the program.  Only the files
+# the program needs are extracted, once, below $HARVEST_CACHE (default
+# $XDG_CACHE_HOME/harvest or ~/.cache/harvest).
+#   IMAGE --list          : list the programs
+#   IMAGE --extract dir   : extract everything into dir
+PACK_ID=@ID@ #
+PACK_INDEX=@INDEX@ #
+PACK_INDEX_LENGTH=@INDEX_LENGTH@ #
+PACK_DECOMPRESS="@DECOMPRESS@"
+
+IMAGE=$0
+case $IMAGE in
+	/*) ;;
+	*) IMAGE=$PWD/$IMAGE ;;
+esac
+TAB=$(printf '\t')
+
+pack_index() {
+	tail -c +$((PACK_INDEX+1)) "$IMAGE" | head -c $PACK_INDEX_LENGTH
+}
+
+find_program() {
+	#The program whose path or name is $1
+	pack_index | awk -F "$TAB" -v name="$1" '$1 == "g" {
+		n = split($2,parts,"/")
+		if ($2 == name || parts[n] == name) { print $2; exit }
+	}'
+}
+
+extract() {
+	#Extract the entries numbered in $2 (everything if empty) into $1
+	pack_index | awk -F "$TAB" -v want="$2" 'BEGIN {
+		n = split(want,w," ")
+		for (i = 1; i <= n; i++) sel[w[i]] = 1
+	}
+	$1 != "g" && (want == "" || ($2 in sel))' |
+	while IFS=$TAB read -r type num mode offset length path target; do
+		dst=$1/$path
+		case $type in
+		d)
+			mkdir -p "$dst" || exit 1
+			;;
+		l)
+			[ -L "$dst" ] && continue
+			mkdir -p "$(dirname "$dst")" && ln -s "$target" "$dst" || exit 1
+			;;
+		f)
+			[ -e "$dst" ] && continue
+			mkdir -p "$(dirname "$dst")" || exit 1
+			if [ "$length" -eq 0 ]; then
+				: > "$dst.$$"
+			else
+				tail -c +$((offset+1)) "$IMAGE" | head -c $length | $PACK_DECOMPRESS > "$dst.$$"
+			fi &&
+			chmod $mode "$dst.$$" && mv -f "$dst.$$" "$dst" || { rm -f "$dst.$$"; exit 1; }
+			;;
+		esac
+	done
+}
+
+case $1 in
+--list)
+	pack_index | awk -F "$TAB" '$1 == "g" { print $2 }'
+	exit 0
+	;;
+--extract)
+	[ -n "$2" ] || { echo "Usage: $0 --extract dir" >&2; exit 1; }
+	extract "$2" ""
+	exit $?
+	;;
+esac
+
+PROGRAM=$(find_program "$(basename "$0")")
+if [ -z "$PROGRAM" ] && [ $# -gt 0 ]; then
+	PROGRAM=$(find_program "$1")
+	[ -n "$PROGRAM" ] && shift
+fi
+if [ -z "$PROGRAM" ]; then
+	PROGRAM=$(pack_index | awk -F "$TAB" '$1 == "g" { n++; p = $2 } END { if (n == 1) print p }')
+fi
+if [ -z "$PROGRAM" ]; then
+	echo "Usage: $0 program [args...]  (see $0 --list)" >&2
+	exit 1
+fi
+
+CACHE=${HARVEST_CACHE:-${XDG_CACHE_HOME:-$HOME/.cache}/harvest}/$PACK_ID
+DONE=$CACHE/.harvest_done/$(echo "$PROGRAM" | tr / _)
+if [ ! -e "$DONE" ]; then
+	ENTRIES=$(pack_index | awk -F "$TAB" -v name="$PROGRAM" '$1 == "g" && $2 == name { print $3; exit }')
+	if ! extract "$CACHE" "$ENTRIES"; then
+		echo "Unable to extract $PROGRAM to $CACHE" >&2
+		exit 1
+	fi
+	mkdir -p "$CACHE/.harvest_done" && touch "$DONE"
+fi
+exec "$CACHE/$PROGRAM" "$@"
+'''
+
+#References to paths in launcher scripts: $DIR/... (relative to the
+#script) or absolute paths (relative to the root of the tree)
+SCRIPT_MAX = 1<<16
+REF_RE = re.compile(r'(\$DIR/|\$\{DIR\}/|(?<![\w.$}])/)([^\s:;"\'$`|&<>()]+)')
+
+def fill(stub, fields):
+	for name, value in fields.items():
+		stub = stub.replace("@%s@" % name,str(value).ljust(FIELD_WIDTH))
+	return stub
+
+def script_refs(root_dir, rel_path):
+	#Returns the paths (relative to root_dir) a launcher script refers to,
+	#and those of them named in LD_LIBRARY_PATH.  A stub launcher is read
+	#as the sh script doing the same.
+	spec = launcher.read_stub(os.path.join(root_dir,rel_path))
+	if spec != None:
+		text = launcher.script("sh",spec)
+	else:
+		f = open(os.path.join(root_dir,rel_path),"rb")
+		text = f.read(SCRIPT_MAX).decode(errors="replace")
+		f.close()
+	script_dir = os.path.dirname(rel_path)
+	refs = []
+	lib_dirs = []
+	for line in text.split("\n"):
+		for match in REF_RE.finditer(line):
+			if match.group(1) == "/":
+				ref = match.group(2)
+			else:
+				ref = os.path.join(script_dir,match.group(2))
+			ref = os.path.normpath(ref)
+			if ref.startswith(".."):
+				continue
+			if "LD_LIBRARY_PATH=" in line:
+				lib_dirs.append(ref)
+			else:
+				refs.append(ref)
+	return refs, lib_dirs
+
+def is_program(path):
+	#Whether the file at path is a launcher: a script, or a stub launcher.
+	#Only small executables are looked at for a stub.
+	result = elf_reader.classify(path)
+	if result == None:
+		return False
+	if result["kind"] == "script":
+		return True
+	return result["kind"] in ("static","exec","pie") and \
+	       os.path.getsize(path) <= launcher.STUB_MAX and launcher.read_stub(path) != None
+
+def relative_script(root_dir, rel_path):
+	#The launcher at rel_path as it is stored in an image, when it refers
+	#to the tree with absolute paths (as those of a -gd root do), which
+	#would be looked for outside of the cache it is extracted to.  Those
+	#paths are made relative to the launcher, and a stub launcher becomes
+	#the sh script doing the same.  Returns None if the launcher can be
+	#stored as it is.
+	path = os.path.join(root_dir,rel_path)
+	size = os.path.getsize(path)
+	spec = None
+	if size <= launcher.STUB_MAX:
+		spec = launcher.read_stub(path)
+	if spec != None:
+		text = launcher.script("sh",spec)
+	else:
+		if size > SCRIPT_MAX:
+			return None
+		f = open(path,"rb")
+		text = f.read().decode(errors="surrogateescape")
+		f.close()
+	script_dir = os.path.dirname(rel_path)
+	changed = False
+	def relative(match):
+		nonlocal changed
+		ref = os.path.normpath(match.group(2))
+		if match.group(1) != "/" or not os.path.lexists(os.path.join(root_dir,ref)):
+			return match.group(0)
+		changed = True
+		return "$PACK_DIR/"+os.path.relpath(ref,script_dir or ".")
+	lines = text.split("\n")
+	#Leave the interpreter alone
+	first = 1 if lines[0].startswith("#!") else 0
+	for i in range(first,len(lines)):
+		lines[i] = REF_RE.sub(relative,lines[i])
+	if not changed:
+		return None
+	lines.insert(first,'case "$0" in */*) PACK_DIR="${0%/*}";; *) PACK_DIR=.;; esac')
+	return "\n".join(lines).encode(errors="surrogateescape")
+
+class PackIndex:
+	#The entries of a tree, by their path relative to it
+	def __init__(self, root_dir):
+		self.root_dir = root_dir
+		self.entries = []
+		self.numbers = {}
+		#Entries below each directory
+		self.children = collections.defaultdict(list)
+
+	def add(self, entry):
+		entry["n"] = len(self.entries)
+		self.entries.append(entry)
+		self.numbers[entry["path"]] = entry["n"]
+		self.children[os.path.dirname(entry["path"])].append(entry["n"])
+
+	def subtree(self, rel_path):
+		stack = [rel_path]
+		while len(stack):
+			path = stack.pop()
+			for n in self.children.get(path,()):
+				yield n
+				stack.append(self.entries[n]["path"])
+
+	def closure(self, program):
+		#The entries needed to run a launcher script: everything it
+		#refers to (whole trees for directories, such as plugins), and
+		#the libraries those need from its LD_LIBRARY_PATH, or from their
+		#DT_RUNPATH once patched (see elf_patch.py)
+		refs, lib_dirs = script_refs(self.root_dir,program)
+		needed = set()
+		pending = [program]+refs
+		while len(pending):
+			rel_path = pending.pop()
+			n = self.numbers.get(rel_path)
+			if n == None or n in needed:
+				continue
+			needed.add(n)
+			entry = self.entries[n]
+			if entry["type"] == "dir":
+				pending.extend(self.entries[x]["path"] for x in self.subtree(rel_path))
+			elif entry["type"] == "link":
+				target = os.path.normpath(os.path.join(os.path.dirname(rel_path),entry["target"]))
+				if not entry["target"].startswith("/"):
+					pending.append(target)
+			else:
+				info = elf_reader.read_elf(os.path.join(self.root_dir,rel_path))
+				if info == None:
+					continue
+				search_dirs = lib_dirs
+				if info["runpath"] != None:
+					origin = os.path.dirname(rel_path)
+					search_dirs = [os.path.normpath(os.path.join(origin,x[len("$ORIGIN"):].lstrip("/")))
+					               for x in info["runpath"].split(":") if x.startswith("$ORIGIN")]+lib_dirs
+				for lib_name in info["needed"]:
+					for lib_dir in search_dirs:
+						lib_path = os.path.join(lib_dir,lib_name)
+						if lib_path in self.numbers:
+							pending.append(lib_path)
+							break
+		return sorted(needed)
+
+	def programs(self):
+		#Launchers, which are what the stub runs
+		for entry in self.entries:
+			if entry["type"] == "file" and entry["mode"] & 0o111 and \
+			   is_program(os.path.join(self.root_dir,entry["path"])):
+				yield entry["path"]
+
+def write_pack(dst_path, root_dir, names=None, method="gzip", level=None, workers=None, verbose=False):
+	#Write the tree root_dir (or just names within it) to a pack image at
+	#dst_path.  Files hardlinked to each other are stored once.
+	root_dir = os.path.abspath(root_dir)
+	dst_path = os.path.abspath(dst_path)
+	tmp_path = dst_path+".tmp"
+	method = archive.available_method(method)
+	if names == None:
+		names = os.listdir(root_dir)
+	compress = archive.COMPRESSORS[method](level)
+	if workers == None:
+		workers = os.cpu_count() or 1
+	pool = concurrent.futures.ThreadPoolExecutor(workers)
+	index = PackIndex(root_dir)
+
+	stub = fill(STUB,{"ID":"","INDEX":0,"INDEX_LENGTH":0,"DECOMPRESS":DECOMPRESSORS[method]}).encode()
+	fp = open(tmp_path,"wb")
+	try:
+		fp.write(stub)
+		offset = len(stub)
+		#Compressed blocks of files, written in order as they complete
+		pending = collections.deque()
+		stored = {}
+		#The image is named by a digest of everything after the stub
+		digest = hashlib.sha256()
+		def flush(limit):
+			nonlocal offset
+			while len(pending) > limit:
+				entry, future = pending.popleft()
+				data = future.result()
+				fp.write(data)
+				digest.update(data)
+				if entry["offset"] == 0:
+					entry["offset"] = offset
+				entry["length"] += len(data)
+				offset += len(data)
+
+		for path, arcname in archive.walk_sorted(root_dir,names):
+			if path in (dst_path,tmp_path):
+				continue
+			if "\t" in arcname or "\n" in arcname:
+				print("WARNING: Unable to pack %s" % arcname)
+				continue
+			st = os.lstat(path)
+			if os.path.islink(path):
+				index.add({"type":"link", "path":arcname, "mode":0o777, "target":os.readlink(path)})
+				continue
+			if os.path.isdir(path):
+				index.add({"type":"dir", "path":arcname, "mode":0o755})
+				continue
+			if not os.path.isfile(path):
+				continue
+			if verbose:
+				print(arcname)
+			mode = 0o755 if st.st_mode & 0o111 else 0o644
+			text = None
+			if mode & 0o111 and is_program(path):
+				text = relative_script(root_dir,arcname)
+			if text != None:
+				#Stored on its own, whatever it is hardlinked to
+				entry = {"type":"file", "path":arcname, "mode":mode, "offset":0, "length":0}
+				entry["data"] = entry
+				index.add(entry)
+				pending.append((entry,pool.submit(compress,text)))
+				flush(2*workers)
+				continue
+			key = (st.st_dev,st.st_ino)
+			if key in stored:
+				index.add({"type":"file", "path":arcname, "mode":mode, "data":stored[key]})
+				continue
+			entry = {"type":"file", "path":arcname, "mode":mode, "offset":0, "length":0}
+			entry["data"] = entry
+			index.add(entry)
+			stored[key] = entry
+			f = open(path,"rb")
+			while True:
+				data = f.read(archive.BLOCK_SIZE)
+				if not len(data):
+					break
+				pending.append((entry,pool.submit(compress,data)))
+				flush(2*workers)
+			f.close()
+		flush(0)
+
+		lines = []
+		for entry in index.entries:
+			if entry["type"] == "file":
+				data = entry["data"]
+				fields = ["f",entry["n"],"%o" % entry["mode"],data["offset"],data["length"],entry["path"]]
+			elif entry["type"] == "dir":
+				fields = ["d",entry["n"],"%o" % entry["mode"],"-","-",entry["path"]]
+			else:
+				fields = ["l",entry["n"],"%o" % entry["mode"],"-","-",entry["path"],entry["target"]]
+			lines.append("\t".join(str(x) for x in fields))
+		programs = 0
+		for program in index.programs():
+			lines.append("g\t%s\t%s" % (program," ".join(str(x) for x in index.closure(program))))
+			programs += 1
+		if not programs:
+			print("WARNING: %s has no launchers, so the image has no programs to run" % root_dir)
+		data = ("\n".join(lines)+"\n").encode()
+		fp.write(data)
+		digest.update(data)
+
+		#Fill in where the index is, and the identity of the image used
+		#to name its cache
+		pack_id = digest.hexdigest()[:FIELD_WIDTH]
+		fp.seek(0)
+		fp.write(fill(STUB,{"ID":pack_id,"INDEX":offset,"INDEX_LENGTH":len(data),
+		                    "DECOMPRESS":DECOMPRESSORS[method]}).encode())
+	except:
+		fp.close()
+		pool.shutdown()
+		os.unlink(tmp_path)
+		raise
+	fp.close()
+	pool.shutdown()
+	os.chmod(tmp_path,0o755)
+	os.replace(tmp_path,dst_path)
+	return len([x for x in index.entries if x["type"] == "file"])
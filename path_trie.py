@@ -0,0 +1,88 @@
+## Copyright (c) 2022 Daniel Tabor
+##
+## Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions
+## are met:
+## 1. Redistributions of source code must retain the above copyright
+##    notice, this list of conditions and the following disclaimer.
+## 2. Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##
+## THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS "AS IS" AND
+## ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+## IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+## ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+## FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+## DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+## OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+## HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+## LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+## OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+## SUCH DAMAGE.
+##
+
+#Marks a node that is itself in the set.  Its value is the path as it
+#was added.
+END = None
+
+def components(path):
+	#"/usr/lib/" -> ["", "usr", "lib"], and "/" -> [""]
+	return path.rstrip("/").split("/")
+
+class PathTrie:
+	#A set of paths stored as a tree of their components, so finding
+	#whether a path, or any directory above it, is in the set takes a
+	#single walk down the path.
+	def __init__(self, paths=()):
+		self.root = {}
+		self.count = 0
+		for path in paths:
+			self.add(path)
+
+	def add(self, path):
+		#Returns True if path was not already in the set
+		node = self.root
+		for part in components(path):
+			child = node.get(part)
+			if child == None:
+				child = node[part] = {}
+			node = child
+		if END in node:
+			return False
+		node[END] = path
+		self.count += 1
+		return True
+
+	def __contains__(self, path):
+		node = self.root
+		for part in components(path):
+			node = node.get(part)
+			if node == None:
+				return False
+		return END in node
+
+	def covers(self, path):
+		#Returns the member of the set that is path or the closest
+		#directory above it, or None
+		node = self.root
+		for part in components(path):
+			node = node.get(part)
+			if node == None:
+				return None
+			if END in node:
+				return node[END]
+		return None
+
+	def __len__(self):
+		return self.count
+
+	def __iter__(self):
+		stack = [self.root]
+		while len(stack):
+			node = stack.pop()
+			for part, child in node.items():
+				if part == END:
+					yield child
+				else:
+					stack.append(child)
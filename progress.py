@@ -0,0 +1,268 @@
+## Copyright (c) 2022 Daniel Tabor
+##
+## Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions
+## are met:
+## 1. Redistributions of source code must retain the above copyright
+##    notice, this list of conditions and the following disclaimer.
+## 2. Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##
+## THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS "AS IS" AND
+## ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+## IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+## ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+## FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+## DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+## OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+## HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+## LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+## OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+## SUCH DAMAGE.
+##
+import threading
+import shutil
+import json
+import time
+import sys
+import os
+
+#Progress of a long run: counts of work done out of work expected, bytes
+#copied, the rate, an ETA and what each thread is working on.  It is shown
+#as a single status line on stderr that is redrawn at most every INTERVAL
+#seconds (or printed every LOG_INTERVAL seconds when stderr is not a
+#terminal), and can be written as JSON lines for scripts.  Until start()
+#is called, everything but message() and debug() does nothing.
+INTERVAL = 0.5
+LOG_INTERVAL = 10.0
+
+enabled = False
+tool = None
+
+#Print the debug() messages (one per file)
+debug_enabled = False
+
+#Draw the status line, or print a progress line now and then
+status = False
+log = False
+
+#File the JSON lines are written to
+events_fp = None
+
+#Counter name -> [done, total, time of the first change]
+counters = {}
+total_bytes = 0
+
+#Thread id -> what the thread is working on
+activities = {}
+
+lock = threading.RLock()
+start_time = 0.0
+last_log = 0.0
+last_event = None
+shown = False
+ticker = None
+stop = threading.Event()
+
+def start(name, console=True, events_path=None, debug=False):
+	global enabled
+	global tool
+	global debug_enabled
+	global status
+	global log
+	global events_fp
+	global start_time
+	global last_log
+	global ticker
+	enabled = True
+	tool = name
+	debug_enabled = debug
+	status = console and sys.stderr.isatty()
+	log = console and not status
+	if events_path != None:
+		#Line buffered, so that a reader (or a fork) never sees half a line
+		events_fp = open(events_path,"w",buffering=1)
+	start_time = time.monotonic()
+	last_log = start_time
+	emit("start")
+	stop.clear()
+	ticker = threading.Thread(target=tick_loop,daemon=True)
+	ticker.start()
+
+def finish():
+	#Stop reporting, leaving the final counts in the event stream
+	global enabled
+	global events_fp
+	if not enabled:
+		return
+	stop.set()
+	ticker.join()
+	with lock:
+		clear()
+		emit("finish",**snapshot())
+		if events_fp != None:
+			events_fp.close()
+			events_fp = None
+		enabled = False
+
+def expect(name, n=1):
+	#n more units of work named name are to be done
+	if not enabled:
+		return
+	with lock:
+		counter = counters.get(name)
+		if counter == None:
+			counter = counters[name] = [0,0,time.monotonic()]
+		counter[1] += n
+
+def advance(name, n=1, nbytes=0):
+	#n units of work named name are done (nbytes of them copied)
+	global total_bytes
+	if not enabled:
+		return
+	with lock:
+		counter = counters.get(name)
+		if counter == None:
+			counter = counters[name] = [0,0,time.monotonic()]
+		counter[0] += n
+		total_bytes += nbytes
+
+def working(text):
+	#What the calling thread is working on, or None once it is done
+	if not enabled:
+		return
+	with lock:
+		if text == None:
+			activities.pop(threading.get_ident(),None)
+		else:
+			activities[threading.get_ident()] = text
+
+def message(text):
+	#Print a line without mixing it into the status line
+	if not enabled:
+		print(text)
+		return
+	with lock:
+		clear()
+		print(text)
+		sys.stdout.flush()
+		emit("message",text=text)
+
+def debug(text):
+	if debug_enabled:
+		message(text)
+
+def size(n):
+	for unit in ["B","KB","MB","GB"]:
+		if n < 1000:
+			break
+		n /= 1000.0
+	else:
+		unit = "TB"
+	return "%.1f %s" % (n,unit)
+
+def clock(seconds):
+	seconds = int(seconds)
+	if seconds >= 3600:
+		return "%d:%02d:%02d" % (seconds//3600,seconds//60%60,seconds%60)
+	return "%d:%02d" % (seconds//60,seconds%60)
+
+def snapshot():
+	#Everything reported, as it is now.  The ETA is that of the counter
+	#expected to finish last, at the rate it has been going.
+	now = time.monotonic()
+	elapsed = now-start_time
+	eta = None
+	with lock:
+		counts = {}
+		for name, [done, total, first] in counters.items():
+			counts[name] = {"done":done, "total":total}
+			if done and done < total:
+				left = (now-first)*(total-done)/done
+				eta = left if eta == None else max(eta,left)
+		busy = sorted(set(activities.values()))
+		nbytes = total_bytes
+	return {
+		"elapsed": round(elapsed,3),
+		"counters": counts,
+		"bytes":    nbytes,
+		"rate":     round(nbytes/elapsed if elapsed > 0 else 0.0,1),
+		"eta":      None if eta == None else round(eta,1),
+		"working":  busy,
+	}
+
+def line(snap):
+	parts = []
+	for name, count in snap["counters"].items():
+		if count["total"]:
+			parts.append("%s %d/%d" % (name,count["done"],count["total"]))
+		else:
+			parts.append("%s %d" % (name,count["done"]))
+	if snap["bytes"]:
+		parts.append("%s (%s/s)" % (size(snap["bytes"]),size(snap["rate"])))
+	if snap["eta"] != None:
+		parts.append("ETA %s" % clock(snap["eta"]))
+	text = "%s %s: %s" % (clock(snap["elapsed"]),tool,"  ".join(parts))
+	if len(snap["working"]):
+		text += " | "+", ".join(snap["working"])
+	return text
+
+def emit(event, **fields):
+	if events_fp == None:
+		return
+	fields["event"] = event
+	fields["tool"] = tool
+	fields["time"] = round(time.time(),3)
+	with lock:
+		events_fp.write(json.dumps(fields,sort_keys=True)+"\n")
+
+def clear():
+	global shown
+	if shown:
+		sys.stderr.write("\r\x1b[K")
+		sys.stderr.flush()
+		shown = False
+
+def tick():
+	global shown
+	global last_log
+	global last_event
+	snap = snapshot()
+	with lock:
+		if status:
+			width = shutil.get_terminal_size().columns
+			sys.stderr.write("\r"+line(snap)[:width-1]+"\x1b[K")
+			sys.stderr.flush()
+			shown = True
+		elif log and snap["elapsed"] >= last_log-start_time+LOG_INTERVAL:
+			last_log = time.monotonic()
+			sys.stderr.write(line(snap)+"\n")
+			sys.stderr.flush()
+		#Only write an event when something changed
+		changed = [snap["counters"],snap["bytes"],snap["working"]]
+		if changed != last_event:
+			last_event = changed
+			emit("progress",**snap)
+
+def tick_loop():
+	while not stop.wait(INTERVAL):
+		tick()
+
+def forked():
+	#A forked worker process does not report, it only prints its messages.
+	#The lock may have been held by another thread at the fork.
+	global lock
+	global enabled
+	global status
+	global log
+	global events_fp
+	global shown
+	lock = threading.RLock()
+	enabled = False
+	status = False
+	log = False
+	events_fp = None
+	shown = False
+
+os.register_at_fork(after_in_child=forked)
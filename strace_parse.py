@@ -0,0 +1,164 @@
+## Copyright (c) 2022 Daniel Tabor
+##
+## Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions
+## are met:
+## 1. Redistributions of source code must retain the above copyright
+##    notice, this list of conditions and the following disclaimer.
+## 2. Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##
+## THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS "AS IS" AND
+## ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+## IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+## ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+## FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+## DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+## OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+## HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+## LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+## OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+## SUCH DAMAGE.
+##
+import codecs
+import re
+import instrument
+
+#Syscalls that name files
+FILE_SYSCALLS = {
+	"open", "openat", "openat2", "creat",
+	"access", "faccessat", "faccessat2",
+	"stat", "lstat", "stat64", "lstat64", "newfstatat", "fstatat64", "statx",
+	"readlink", "readlinkat",
+	"execve", "execveat",
+}
+
+#Syscalls whose first argument is a directory file descriptor
+AT_SYSCALLS = {
+	"openat", "openat2", "faccessat", "faccessat2", "newfstatat",
+	"fstatat64", "statx", "readlinkat", "execveat",
+}
+
+#Optional "[pid N] " or "N " prefix, then "syscall(" or "<... syscall resumed>"
+LINE_RE = re.compile(r'(?:\[pid\s+(\d+)\]\s*|(\d+)\s+)?(?:(\w+)\(|<\.\.\. (\w+) resumed>)')
+RESULT_RE = re.compile(r'\s*=\s*(0x[0-9a-fA-F]+|-?\d+|\?)')
+
+def split_args(text, start):
+	#Split the syscall arguments in text starting at start.  Returns the
+	#list of arguments and the index just past the closing parenthesis,
+	#or None if the call is unfinished.
+	args = []
+	depth = 0
+	arg_start = start
+	i = start
+	n = len(text)
+	while i < n:
+		c = text[i]
+		if c == '"':
+			#Skip over a quoted string, honoring escapes
+			i += 1
+			while i < n and text[i] != '"':
+				if text[i] == '\\':
+					i += 1
+				i += 1
+		elif c == "[" or c == "{" or c == "(":
+			depth += 1
+		elif c == "]" or c == "}" or (c == ")" and depth):
+			depth -= 1
+		elif c == "," and not depth:
+			args.append(text[arg_start:i].strip())
+			arg_start = i+1
+		elif c == ")":
+			arg = text[arg_start:i].strip()
+			if len(arg) or len(args):
+				args.append(arg)
+			return args, i+1
+		elif c == "<" and not depth and text.startswith("<unfinished",i):
+			arg = text[arg_start:i].strip()
+			if len(arg):
+				args.append(arg)
+			return args, None
+		i += 1
+	#Truncated line
+	arg = text[arg_start:].strip()
+	if len(arg):
+		args.append(arg)
+	return args, None
+
+def parse_result(text, end):
+	if end == None:
+		return None
+	m = RESULT_RE.match(text,end)
+	if not m or m.group(1) == "?":
+		return None
+	return int(m.group(1),0)
+
+def parse_lines(lines, syscalls=FILE_SYSCALLS):
+	#Parse strace output, yielding (pid, syscall, args, result) for each
+	#call to one of syscalls.  Lines for any other syscall are skipped
+	#without parsing their arguments.  pid is None when strace did not
+	#print one.  result is None when it is unknown.  Calls split into
+	#"<unfinished ...>" and "<... resumed>" lines are joined back
+	#together.
+	unfinished = {}
+	#Counted here and reported once, as this is called per line
+	line_count = 0
+	skipped = 0
+	for line in lines:
+		line_count += 1
+		if type(line) == bytes:
+			line = line.decode(errors="surrogateescape")
+		m = LINE_RE.match(line)
+		if not m:
+			skipped += 1
+			continue
+		pid = m.group(1) or m.group(2)
+		if pid != None:
+			pid = int(pid)
+		syscall = m.group(3)
+		if syscall != None:
+			if syscall not in syscalls:
+				skipped += 1
+				continue
+			args, end = split_args(line,m.end())
+			if end == None:
+				unfinished[(pid,syscall)] = args
+				continue
+			yield (pid,syscall,args,parse_result(line,end))
+		else:
+			syscall = m.group(4)
+			if syscall not in syscalls:
+				skipped += 1
+				continue
+			args = unfinished.pop((pid,syscall),[])
+			more, end = split_args(line,m.end())
+			args = args + more
+			yield (pid,syscall,args,parse_result(line,end))
+	instrument.count("strace.lines",line_count)
+	instrument.count("strace.skipped_lines",skipped)
+	instrument.count("strace.unresumed",len(unfinished))
+	#Calls that never resumed (the process was killed)
+	for (pid,syscall), args in unfinished.items():
+		yield (pid,syscall,args,None)
+
+def unquote(arg):
+	#Turn a quoted strace string into its value.  Raises ValueError if
+	#arg is not a complete quoted string.
+	if len(arg) < 2 or arg[0] != '"' or arg[-1] != '"':
+		raise ValueError("Not quoted %s" % arg)
+	s = arg[1:-1]
+	if "\\" not in s:
+		return s
+	data = codecs.escape_decode(s.encode(errors="surrogateescape"))[0]
+	return data.decode(errors="surrogateescape")
+
+def path_arg(syscall, args):
+	#Return the (quoted) path argument of a file syscall, or None
+	if syscall in AT_SYSCALLS:
+		idx = 1
+	else:
+		idx = 0
+	if len(args) <= idx:
+		return None
+	return args[idx]
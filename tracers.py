@@ -0,0 +1,611 @@
+## Copyright (c) 2022 Daniel Tabor
+##
+## Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions
+## are met:
+## 1. Redistributions of source code must retain the above copyright
+##    notice, this list of conditions and the following disclaimer.
+## 2. Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##
+## THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS "AS IS" AND
+## ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+## IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+## ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+## FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+## DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+## OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+## HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+## LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+## OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+## SUCH DAMAGE.
+##
+import subprocess
+import threading
+import tempfile
+import hashlib
+import shutil
+import struct
+import fcntl
+import stat
+import os
+import strace_parse
+
+#Tracers run a command and yield (pid, kind, path, ok) records for the
+#files it uses.  kind is one of:
+#  exec   : a program was executed
+#  open   : a file was opened
+#  access : a file was checked for with access()
+#  load   : a shared library was loaded by the dynamic loader
+#ok is False when the call is known to have failed.
+
+#Size of the reads from the trace output
+READ_BLOCK = 1<<20
+
+class TraceFifo:
+	#A FIFO that a traced program writes its trace into.  The read end is
+	#opened without waiting for a writer, and a write end is held until
+	#the traced program exits, so a program that fails early still
+	#results in EOF rather than a hang.  Reads are blocking, in large
+	#blocks.
+	def __init__(self):
+		self.tmp_dir = tempfile.mkdtemp()
+		self.path = os.path.join(self.tmp_dir,"trace")
+		os.mkfifo(self.path,0o600)
+		self.read_fd = os.open(self.path,os.O_RDONLY|os.O_NONBLOCK)
+		self.write_fd = os.open(self.path,os.O_WRONLY)
+		flags = fcntl.fcntl(self.read_fd,fcntl.F_GETFL)
+		fcntl.fcntl(self.read_fd,fcntl.F_SETFL,flags & ~os.O_NONBLOCK)
+		self.proc = None
+
+	def start(self, args, env=None):
+		try:
+			self.proc = subprocess.Popen(args,env=env)
+		except:
+			self.close()
+			raise
+		self.reaper = threading.Thread(target=self.reap)
+		self.reaper.start()
+		return self.proc
+
+	def reap(self):
+		self.proc.wait()
+		os.close(self.write_fd)
+
+	def blocks(self, log_path=None):
+		#Yield the data written to the FIFO, also saving it to log_path
+		if log_path:
+			log_fp = open(log_path,"wb")
+		else:
+			log_fp = None
+		try:
+			while True:
+				data = os.read(self.read_fd,READ_BLOCK)
+				if not len(data):
+					break
+				if log_fp:
+					log_fp.write(data)
+				yield data
+		finally:
+			self.reaper.join()
+			if log_fp:
+				log_fp.close()
+			self.close()
+
+	def close(self):
+		if self.proc == None:
+			os.close(self.write_fd)
+		os.close(self.read_fd)
+		os.unlink(self.path)
+		os.rmdir(self.tmp_dir)
+
+def split_lines(blocks):
+	rest = b""
+	for data in blocks:
+		lines = (rest+data).split(b"\n")
+		rest = lines.pop()
+		for line in lines:
+			yield line
+	if len(rest):
+		yield rest
+
+def which(name):
+	if "/" in name:
+		return name
+	found = shutil.which(name)
+	if found == None:
+		return name
+	return found
+
+#Syscalls traced by StraceTracer
+STRACE_KINDS = {
+	"execve" : "exec",
+	"open"   : "open",
+	"openat" : "open",
+	"access" : "access",
+}
+
+class StraceTracer:
+	#Trace with strace, asking it to only decode the syscalls that name
+	#files and to write them into a FIFO instead of sharing stderr with
+	#the traced program.
+	def __init__(self, strace_path, follow=True, log_path=None):
+		self.strace_path = strace_path
+		self.follow = follow
+		self.log_path = log_path
+
+	def records(self, cmd):
+		args = [self.strace_path]
+		if self.follow:
+			args.append("-f")
+		fifo = TraceFifo()
+		fifo.start(args+["-e","trace=file","-o",fifo.path]+cmd)
+		lines = split_lines(fifo.blocks(self.log_path))
+		for pid, syscall, args, result in strace_parse.parse_lines(lines,STRACE_KINDS):
+			path = strace_parse.path_arg(syscall,args)
+			if path == None:
+				continue
+			try:
+				path = strace_parse.unquote(path)
+			except ValueError:
+				continue
+			yield (pid,STRACE_KINDS[syscall],path,result != None and result >= 0)
+
+#Shim loaded as both LD_AUDIT (library loads, and the image of every
+#dynamically linked process) and LD_PRELOAD (open/access/exec calls made
+#through libc).  Records are collected in a per-process buffer of at
+#most PIPE_BUF bytes and written to the FIFO named by HARVEST_TRACE_LOG
+#in a single write, so records of concurrent processes never interleave.
+AUDIT_SOURCE = r"""
+#define _GNU_SOURCE
+#include <dlfcn.h>
+#include <errno.h>
+#include <fcntl.h>
+#include <limits.h>
+#include <link.h>
+#include <pthread.h>
+#include <spawn.h>
+#include <stdarg.h>
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <sys/syscall.h>
+#include <unistd.h>
+
+#define K_EXEC   1
+#define K_OPEN   2
+#define K_ACCESS 3
+#define K_LOAD   4
+#define K_IMAGE  5
+
+struct record {
+	int32_t pid;
+	int32_t result;
+	uint8_t kind;
+	uint8_t pad;
+	uint16_t len;
+};
+
+extern char **environ;
+
+static const char *env_names[] = {"HARVEST_TRACE_LOG", "LD_AUDIT", "LD_PRELOAD"};
+#define N_ENV (sizeof(env_names)/sizeof(env_names[0]))
+static char *env_saved[N_ENV];
+
+static char buf[PIPE_BUF];
+static size_t used;
+static int log_fd = -2;
+static pthread_mutex_t lock = PTHREAD_MUTEX_INITIALIZER;
+
+static void open_log(void)
+{
+	const char *path = getenv("HARVEST_TRACE_LOG");
+	log_fd = -1;
+	if (!path)
+		return;
+	/* Never block on a FIFO nobody reads any more */
+	int fd = syscall(SYS_openat, AT_FDCWD, path, O_WRONLY|O_NONBLOCK|O_CLOEXEC);
+	if (fd < 0)
+		return;
+	fcntl(fd, F_SETFL, fcntl(fd, F_GETFL) & ~O_NONBLOCK);
+	log_fd = fd;
+}
+
+static void flush_locked(void)
+{
+	size_t off = 0;
+	if (log_fd == -2)
+		open_log();
+	while (log_fd >= 0 && off < used) {
+		ssize_t n = write(log_fd, buf + off, used - off);
+		if (n < 0) {
+			if (errno == EINTR)
+				continue;
+			break;
+		}
+		off += n;
+	}
+	used = 0;
+}
+
+static void add_locked(int kind, const char *path, int result)
+{
+	struct record r;
+	size_t len = strlen(path);
+	if (len > sizeof(buf) - sizeof(r))
+		len = sizeof(buf) - sizeof(r);
+	if (used + sizeof(r) + len > sizeof(buf))
+		flush_locked();
+	r.pid = getpid();
+	r.result = result;
+	r.kind = kind;
+	r.pad = 0;
+	r.len = len;
+	memcpy(buf + used, &r, sizeof(r));
+	memcpy(buf + used + sizeof(r), path, len);
+	used += sizeof(r) + len;
+}
+
+static void add(int kind, const char *path, int result, int now)
+{
+	int saved = errno;
+	if (!path)
+		return;
+	pthread_mutex_lock(&lock);
+	add_locked(kind, path, result);
+	if (now)
+		flush_locked();
+	pthread_mutex_unlock(&lock);
+	errno = saved;
+}
+
+static void flush(void)
+{
+	int saved = errno;
+	pthread_mutex_lock(&lock);
+	flush_locked();
+	pthread_mutex_unlock(&lock);
+	errno = saved;
+}
+
+static void fork_prepare(void) { pthread_mutex_lock(&lock); flush_locked(); }
+static void fork_done(void) { pthread_mutex_unlock(&lock); }
+
+__attribute__((constructor)) static void init(void)
+{
+	size_t i;
+	for (i = 0; i < N_ENV; i++) {
+		const char *v = getenv(env_names[i]);
+		if (v)
+			env_saved[i] = strdup(v);
+	}
+	pthread_atfork(fork_prepare, fork_done, fork_done);
+}
+
+__attribute__((destructor)) static void fini(void)
+{
+	flush();
+}
+
+/* Put back any tracing variables dropped from envp */
+static char **fix_env(char *const envp[])
+{
+	size_t n = 0, i, j, extra = 0;
+	char **out;
+	if (!envp)
+		envp = environ;
+	while (envp[n])
+		n++;
+	out = malloc((n + N_ENV + 1) * sizeof(char *));
+	if (!out)
+		return (char **)envp;
+	memcpy(out, envp, n * sizeof(char *));
+	for (i = 0; i < N_ENV; i++) {
+		size_t len = strlen(env_names[i]);
+		if (!env_saved[i])
+			continue;
+		for (j = 0; j < n; j++)
+			if (!strncmp(envp[j], env_names[i], len) && envp[j][len] == '=')
+				break;
+		if (j < n)
+			continue;
+		out[n + extra] = malloc(len + strlen(env_saved[i]) + 2);
+		if (!out[n + extra])
+			continue;
+		sprintf(out[n + extra], "%s=%s", env_names[i], env_saved[i]);
+		extra++;
+	}
+	out[n + extra] = NULL;
+	return out;
+}
+
+/* The program execvp() will run, searched for the same way */
+static void add_exec_search(const char *file)
+{
+	char path[PATH_MAX];
+	const char *dirs, *end;
+	if (!file || strchr(file, '/')) {
+		add(K_EXEC, file, 0, 1);
+		return;
+	}
+	dirs = getenv("PATH");
+	if (!dirs)
+		dirs = "/bin:/usr/bin";
+	for (; *dirs; dirs = *end ? end + 1 : end) {
+		end = strchrnul(dirs, ':');
+		if (snprintf(path, sizeof(path), "%.*s/%s", (int)(end - dirs), dirs, file) >= (int)sizeof(path))
+			continue;
+		if (syscall(SYS_faccessat, AT_FDCWD, path, X_OK, 0) == 0) {
+			add(K_EXEC, path, 0, 1);
+			return;
+		}
+	}
+	add(K_EXEC, file, -1, 1);
+}
+
+#define REAL(name) \
+	static __typeof__(name) *real_##name; \
+	if (!real_##name) \
+		real_##name = (__typeof__(name) *)dlsym(RTLD_NEXT, #name)
+
+#define OPEN_MODE(flags, mode) \
+	mode_t mode = 0; \
+	if ((flags) & (O_CREAT | O_TMPFILE)) { \
+		va_list ap; \
+		va_start(ap, flags); \
+		mode = va_arg(ap, mode_t); \
+		va_end(ap); \
+	}
+
+int open(const char *path, int flags, ...)
+{
+	OPEN_MODE(flags, mode);
+	REAL(open);
+	int fd = real_open(path, flags, mode);
+	add(K_OPEN, path, fd, 0);
+	return fd;
+}
+
+int open64(const char *path, int flags, ...)
+{
+	OPEN_MODE(flags, mode);
+	REAL(open64);
+	int fd = real_open64(path, flags, mode);
+	add(K_OPEN, path, fd, 0);
+	return fd;
+}
+
+int openat(int dirfd, const char *path, int flags, ...)
+{
+	OPEN_MODE(flags, mode);
+	REAL(openat);
+	int fd = real_openat(dirfd, path, flags, mode);
+	if (dirfd == AT_FDCWD || path[0] == '/')
+		add(K_OPEN, path, fd, 0);
+	return fd;
+}
+
+int openat64(int dirfd, const char *path, int flags, ...)
+{
+	OPEN_MODE(flags, mode);
+	REAL(openat64);
+	int fd = real_openat64(dirfd, path, flags, mode);
+	if (dirfd == AT_FDCWD || path[0] == '/')
+		add(K_OPEN, path, fd, 0);
+	return fd;
+}
+
+/* Targets of _FORTIFY_SOURCE */
+int __open_2(const char *path, int flags) { return open(path, flags); }
+int __open64_2(const char *path, int flags) { return open64(path, flags); }
+int __openat_2(int dirfd, const char *path, int flags) { return openat(dirfd, path, flags); }
+int __openat64_2(int dirfd, const char *path, int flags) { return openat64(dirfd, path, flags); }
+
+FILE *fopen(const char *path, const char *mode)
+{
+	REAL(fopen);
+	FILE *fp = real_fopen(path, mode);
+	add(K_OPEN, path, fp ? 0 : -1, 0);
+	return fp;
+}
+
+FILE *fopen64(const char *path, const char *mode)
+{
+	REAL(fopen64);
+	FILE *fp = real_fopen64(path, mode);
+	add(K_OPEN, path, fp ? 0 : -1, 0);
+	return fp;
+}
+
+int access(const char *path, int amode)
+{
+	REAL(access);
+	int result = real_access(path, amode);
+	add(K_ACCESS, path, result, 0);
+	return result;
+}
+
+int execve(const char *path, char *const argv[], char *const envp[])
+{
+	REAL(execve);
+	add(K_EXEC, path, 0, 1);
+	return real_execve(path, argv, fix_env(envp));
+}
+
+int execv(const char *path, char *const argv[])
+{
+	return execve(path, argv, environ);
+}
+
+int execvpe(const char *file, char *const argv[], char *const envp[])
+{
+	REAL(execvpe);
+	add_exec_search(file);
+	return real_execvpe(file, argv, fix_env(envp));
+}
+
+int execvp(const char *file, char *const argv[])
+{
+	return execvpe(file, argv, environ);
+}
+
+int posix_spawn(pid_t *pid, const char *path,
+		const posix_spawn_file_actions_t *actions,
+		const posix_spawnattr_t *attr,
+		char *const argv[], char *const envp[])
+{
+	REAL(posix_spawn);
+	add(K_EXEC, path, 0, 1);
+	return real_posix_spawn(pid, path, actions, attr, argv, fix_env(envp));
+}
+
+int posix_spawnp(pid_t *pid, const char *file,
+		const posix_spawn_file_actions_t *actions,
+		const posix_spawnattr_t *attr,
+		char *const argv[], char *const envp[])
+{
+	REAL(posix_spawnp);
+	add_exec_search(file);
+	return real_posix_spawnp(pid, file, actions, attr, argv, fix_env(envp));
+}
+
+void _exit(int status)
+{
+	REAL(_exit);
+	flush();
+	real__exit(status);
+	for (;;);
+}
+
+/* LD_AUDIT interface */
+unsigned int la_version(unsigned int version)
+{
+	return version < LAV_CURRENT ? version : LAV_CURRENT;
+}
+
+unsigned int la_objopen(struct link_map *map, Lmid_t lmid, uintptr_t *cookie)
+{
+	char path[PATH_MAX];
+	ssize_t n;
+	if (lmid != LM_ID_BASE)
+		return 0;
+	if (map->l_name[0]) {
+		add(K_LOAD, map->l_name, 0, 0);
+		return 0;
+	}
+	/* The main program has no name */
+	n = syscall(SYS_readlinkat, AT_FDCWD, "/proc/self/exe", path, sizeof(path) - 1);
+	if (n > 0) {
+		path[n] = 0;
+		add(K_IMAGE, path, 0, 0);
+	}
+	return 0;
+}
+
+void la_activity(uintptr_t *cookie, unsigned int flag)
+{
+	/* Flush after every batch of loads, so a fork never duplicates them */
+	if (flag == LA_ACT_CONSISTENT)
+		flush();
+}
+"""
+
+AUDIT_RECORD = struct.Struct("=iiBxH")
+AUDIT_KINDS = {1:"exec", 2:"open", 3:"access", 4:"load", 5:"image"}
+
+def split_records(blocks):
+	#Yield (pid, kind, path, result) for each record in blocks
+	rest = b""
+	size = AUDIT_RECORD.size
+	for data in blocks:
+		data = rest+data
+		off = 0
+		while off+size <= len(data):
+			pid, result, kind, length = AUDIT_RECORD.unpack_from(data,off)
+			end = off+size+length
+			if end > len(data):
+				break
+			path = data[off+size:end].decode(errors="surrogateescape")
+			yield (pid,AUDIT_KINDS.get(kind),path,result)
+			off = end
+		rest = data[off:]
+
+def private_dir(path=None):
+	#The directory the programs compiled by the tools are kept in (by
+	#default below $XDG_CACHE_HOME or ~/.cache).  Whatever is found there
+	#is run, so it must be a directory only this user can write to.
+	if path == None:
+		base = os.getenv("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"),".cache")
+		path = os.path.join(base,"harvest","build")
+	os.makedirs(path,mode=0o700,exist_ok=True)
+	st = os.lstat(path)
+	if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+		raise OSError("%s is not a directory private to this user" % path)
+	return path
+
+class AuditTracer:
+	#Trace with a shim loaded through LD_AUDIT and LD_PRELOAD.  Nothing
+	#stops the traced processes, so the overhead is a buffered record per
+	#call instead of a ptrace stop per syscall.  Statically linked
+	#programs, and files opened with raw syscalls, are not seen.
+	def __init__(self, follow=True, log_path=None, cc="cc", build_dir=None):
+		self.follow = follow
+		self.log_path = log_path
+		self.cc = cc
+		self.build_dir = build_dir
+
+	def build(self):
+		#Compile the shim, once per version of its source
+		build_dir = private_dir(self.build_dir)
+		key = hashlib.sha1(AUDIT_SOURCE.encode()).hexdigest()[:16]
+		so_path = os.path.join(build_dir,"harvest_audit-%s.so" % key)
+		if os.path.exists(so_path):
+			return so_path
+		fd, src_path = tempfile.mkstemp(suffix=".c",dir=build_dir)
+		tmp_path = src_path[:-2]+".so"
+		try:
+			os.write(fd,AUDIT_SOURCE.encode())
+			os.close(fd)
+			subprocess.check_call([self.cc,"-shared","-fPIC","-O2","-o",tmp_path,src_path,"-ldl","-lpthread"])
+			os.replace(tmp_path,so_path)
+		finally:
+			os.unlink(src_path)
+			if os.path.exists(tmp_path):
+				os.unlink(tmp_path)
+		return so_path
+
+	def records(self, cmd):
+		so_path = self.build()
+		fifo = TraceFifo()
+		env = dict(os.environ)
+		env["HARVEST_TRACE_LOG"] = fifo.path
+		env["LD_AUDIT"] = so_path
+		env["LD_PRELOAD"] = so_path
+		exe_path = which(cmd[0])
+		proc = fifo.start([exe_path]+cmd[1:],env)
+		#The exec that started the program, as strace would report it
+		yield (proc.pid,"exec",exe_path,True)
+		last_exec = {proc.pid:exe_path}
+		for pid, kind, path, result in split_records(fifo.blocks(self.log_path)):
+			if not self.follow and pid != proc.pid:
+				continue
+			if kind == "load" and (path == so_path or path[:1] != "/"):
+				#The shim itself, or the vdso
+				continue
+			if kind == "exec":
+				last_exec[pid] = path
+			elif kind == "image":
+				#The new image of a process already reported through its
+				#exec call
+				prev = last_exec.pop(pid,None)
+				if prev != None and os.path.realpath(prev) == path:
+					continue
+				kind = "exec"
+			yield (pid,kind,path,result >= 0)
+
+TRACERS = {
+	"strace" : StraceTracer,
+	"audit"  : AuditTracer,
+}
@@ -0,0 +1,88 @@
+## Copyright (c) 2022 Daniel Tabor
+##
+## Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions
+## are met:
+## 1. Redistributions of source code must retain the above copyright
+##    notice, this list of conditions and the following disclaimer.
+## 2. Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##
+## THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS "AS IS" AND
+## ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+## IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+## ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+## FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+## DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+## OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+## HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+## LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+## OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+## SUCH DAMAGE.
+##
+import concurrent.futures
+import collections
+import os
+import instrument
+
+#A walk yields (path, kind) for every entry below its top directory, with
+#kind one of:
+#  dir   : a directory, which is also descended into
+#  link  : a symbolic link, which is never followed
+#  other : a device, FIFO or socket
+#or whatever the classify function returned for a regular file.
+
+def scan_dir(path, classify, prune):
+	#Scan a single directory, classifying all of its regular files.
+	#Returns its entries and the subdirectories to descend into.
+	entries = []
+	subdirs = []
+	try:
+		it = os.scandir(path)
+	except OSError:
+		return entries, subdirs
+	instrument.count("walk.dirs")
+	with it:
+		for entry in it:
+			full_path = os.path.join(path,entry.name)
+			if prune and prune(full_path):
+				continue
+			#The type comes from the directory itself, without a stat
+			try:
+				if entry.is_symlink():
+					kind = "link"
+				elif entry.is_dir():
+					kind = "dir"
+					subdirs.append(full_path)
+				elif entry.is_file():
+					kind = classify(full_path)
+				else:
+					kind = "other"
+			except OSError:
+				continue
+			if kind != None:
+				entries.append((full_path,kind))
+	instrument.count("walk.entries",len(entries))
+	return entries, subdirs
+
+def walk(top, classify, prune=None, workers=None):
+	#Walk the tree below top, scanning directories on a pool of threads.
+	#classify(path) is called for every regular file, and entries it
+	#returns None for are skipped.  Directories prune(path) is true for
+	#are not entered at all.  Every directory is yielded before anything
+	#inside it.
+	top = os.path.abspath(top)
+	pool = concurrent.futures.ThreadPoolExecutor(workers)
+	pending = collections.deque([pool.submit(scan_dir,top,classify,prune)])
+	try:
+		while len(pending):
+			entries, subdirs = pending.popleft().result()
+			for subdir in subdirs:
+				pending.append(pool.submit(scan_dir,subdir,classify,prune))
+			for entry in entries:
+				yield entry
+	finally:
+		for future in pending:
+			future.cancel()
+		pool.shutdown()